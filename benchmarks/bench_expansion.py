@@ -0,0 +1,82 @@
+"""Micro-benchmark for include expansion.
+
+Compares the old string concatenation (``temp_file += line`` threaded
+through every recursive call) with the chunk pipeline used by
+``BuildPlantumlPlugin._readFile``.
+
+    pip install -e .
+    python benchmarks/bench_expansion.py
+"""
+import re
+import tempfile
+import timeit
+import zlib
+from pathlib import Path
+
+from mkdocs_build_plantuml_plugin.plantuml import BuildPlantumlPlugin, PuElement
+
+LINES = 10000
+INCLUDES = 10
+
+
+def make_tree(directory):
+    """A diagram including INCLUDES files with LINES lines in total"""
+    per_file = LINES // INCLUDES
+    for i in range(INCLUDES):
+        (directory / f"inc{i}.puml").write_text(
+            "".join(f"skinparam Item{i}_{n} #{n:06d}\n" for n in range(per_file))
+        )
+    source = ["@startuml\n"] + [f"!include inc{i}.puml\n" for i in range(INCLUDES)] + ["@enduml\n"]
+    return source
+
+
+def old_expand(lines, temp_file, directory):
+    """The expansion as it was before, reduced to plain !include"""
+    for line in lines:
+        line = line.strip()
+        if re.match(r"^!include\s+\S+\s*$", line):
+            with (Path(directory) / line[9:].rstrip()).open("rt") as inc:
+                temp_file = old_expand(inc, temp_file, directory)
+        else:
+            temp_file += line
+        if "\n" not in line:
+            temp_file += "\n"
+    return temp_file
+
+
+def old_read_file(source, directory):
+    temp_file = old_expand(source, "", directory)
+    return zlib.compress(temp_file.encode("utf-8"))[2:-4]
+
+
+def new_read_file(plugin, source, directory):
+    # A fresh cache per run, otherwise only the first run would read the includes
+    plugin.include_cache.entries = {}
+    diagram = PuElement("bench.puml", str(directory))
+    diagram.root_dir = str(directory)
+    diagram.src_file = source
+    plugin._readFile(diagram, False)
+    return diagram
+
+
+def main():
+    plugin = BuildPlantumlPlugin()
+    # The defaults of BuildPlantumlPluginConfig, like an empty plugin entry in mkdocs.yml
+    errors, warnings = plugin.load_config({})
+    assert not errors, errors
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        source = make_tree(directory)
+
+        old = min(timeit.repeat(lambda: old_read_file(source, directory), number=5, repeat=5)) / 5
+        new = min(timeit.repeat(lambda: new_read_file(plugin, source, directory), number=5, repeat=5)) / 5
+
+    print(f"{LINES} lines in {INCLUDES} includes")
+    print(f"  string concatenation: {old * 1000:8.2f} ms")
+    print(f"  chunk pipeline:       {new * 1000:8.2f} ms")
+    print(f"  speedup:              {old / new:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
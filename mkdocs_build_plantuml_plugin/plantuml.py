@@ -1,22 +1,52 @@
 """ MKDocs Build Plantuml Plugin """
 import base64
+import contextlib
+import cProfile
+import contextvars
+import copy
+import errno
+import filecmp
+import fnmatch
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import math
 import os
 from pathlib import Path
 import httplib2
+import queue
 import re
 import shutil
 import six
+import socket
 import string
+import tempfile
+import threading
+import time
+import tracemalloc
 import zlib
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from mkdocs.config import config_options, base
 from mkdocs.plugins import BasePlugin
 import mkdocs.structure.files
-from subprocess import call
+from subprocess import DEVNULL, PIPE, Popen, call
+
+try:
+    # Like the livereload server, native file events don't arrive on bind mounts, WSL or network shares
+    from watchdog.observers.polling import PollingObserver
+except ImportError:
+    PollingObserver = None
 
 log = logging.getLogger(f"mkdocs.plugins.{__name__}")
 
+# Log records of the render job running in the current thread or task
+_job_records = contextvars.ContextVar("job_records", default=None)
+
 if six.PY2:
     from string import maketrans
 else:
@@ -31,6 +61,9 @@ b64_to_plantuml = maketrans(
     base64_alphabet.encode("utf-8"), plantuml_alphabet.encode("utf-8")
 )
 
+startsub_pattern = re.compile(r"^!startsub\s+(.+)$")
+endsub_pattern = re.compile(r"^(!endsub|@enduml)\s*$")
+
 
 class BuildPlantumlPluginConfig(base.Config):
     render = mkdocs.config.config_options.Type(str, default="server")
@@ -41,7 +74,7 @@ class BuildPlantumlPluginConfig(base.Config):
         bool, default=False
     )
     bin_path = mkdocs.config.config_options.Type(str, default=shutil.which('plantuml') or 'plantuml')
-    output_format = mkdocs.config.config_options.Type(str, default="png")
+    output_format = mkdocs.config.config_options.Type((str, list), default="png")
     allow_multiple_roots = mkdocs.config.config_options.Type(bool, default=False)
     diagram_root = mkdocs.config.config_options.Type(str, default="docs/diagrams")
     output_folder = mkdocs.config.config_options.Type(str, default="out")
@@ -52,7 +85,24 @@ class BuildPlantumlPluginConfig(base.Config):
     theme_folder = mkdocs.config.config_options.Type(str, default="include/themes/")
     theme_light = mkdocs.config.config_options.Type(str, default="light.puml")
     theme_dark = mkdocs.config.config_options.Type(str, default="dark.puml")
+    theme_variants = mkdocs.config.config_options.Type(list, default=[])
+    diagram_roots = mkdocs.config.config_options.Type(list, default=[])
+    respect_gitignore = mkdocs.config.config_options.Type(bool, default=False)
     exclude_dirs = mkdocs.config.config_options.Type(list, default=[".git"])
+    include_patterns = mkdocs.config.config_options.Type(list, default=[])
+    exclude_patterns = mkdocs.config.config_options.Type(list, default=[])
+    workers = mkdocs.config.config_options.Type(int, default=1)
+    prewarm_connections = mkdocs.config.config_options.Type(bool, default=True)
+    gzip_svg = mkdocs.config.config_options.Type(bool, default=True)
+    cache_dir = mkdocs.config.config_options.Type(str, default="")
+    cache_max_size = mkdocs.config.config_options.Type(int, default=256)
+    manifest_file = mkdocs.config.config_options.Type(str, default="")
+    dependency_graph_file = mkdocs.config.config_options.Type(str, default="")
+    local_server_instances = mkdocs.config.config_options.Type(int, default=1)
+    render_timeout = mkdocs.config.config_options.Type(int, default=60)
+    timing_report_file = mkdocs.config.config_options.Type(str, default="")
+    profile_dir = mkdocs.config.config_options.Type(str, default="")
+    profile_samples = mkdocs.config.config_options.Type(bool, default=False)
 
 
 class BuildPlantumlPlugin(BasePlugin[BuildPlantumlPluginConfig]):
@@ -60,62 +110,469 @@ class BuildPlantumlPlugin(BasePlugin[BuildPlantumlPluginConfig]):
 
     def __init__(self):
         self.total_time = 0
+        self.render_pool = None
+        self.local_batch = None
+        self.http_pool = None
+        self.pipe_renderers = {}
+        self.local_servers = None
+        self.local_servers_lock = threading.Lock()
+        self.prewarmed = False
+        self.theme_copies = None
+        self.render_owners = None
+        self.duplicates = None
+        self.variants = None
+        self.variants_key = None
+        self.file_matcher = None
+        self.stat_cache = StatCache()
+        self.build_stats = BuildStats()
+        self.profiler = None
+        self.made_dirs = set()
+        self.confirmed_outputs = {}
+        self.failed_outputs = set()
+        # The images of every diagram, checked on rebuilds that only look at changed files
+        self.output_index = {}
+        self.render_cache = None
+        self.manifest = None
+        self.dependency_graph = DependencyGraph()
+        self.include_cache = IncludeCache()
+        self.sub_index = {}
+        self.root_finder = None
+        self.diagram_roots = None
+        self.diagram_index = None
+        self.settings = None
+        self.serve_server = None
+        self.watched_dirs = set()
+        self.watcher = None
+        self.retry_sources = set()
+
+    def on_config(self, config):
+        # Compile the file patterns once, not for every file
+        self._file_matcher()
+        return config
+
+    def on_startup(self, command, dirty):
+        """Defining this keeps the plugin (and its connections) alive between `mkdocs serve` rebuilds"""
+
+    def on_shutdown(self):
+        if self.http_pool is not None:
+            self.http_pool.close()
+            self.http_pool = None
+        for renderer in self.pipe_renderers.values():
+            renderer.close()
+        self.pipe_renderers = {}
+        if self.local_servers is not None:
+            self.local_servers.close()
+            self.local_servers = None
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+    def on_serve(self, server, config, builder):
+        """Watches the diagrams, later rebuilds only render what the changed files affect"""
+        self.serve_server = server
+        if PollingObserver is not None and self.watcher is None:
+            self.watcher = ChangeWatcher()
+        self._watch_diagram_dirs()
+        return server
 
     def on_pre_build(self, config):
         """Checking given parameters and looking for files"""
+        # The variable turns profiling on without touching mkdocs.yml
+        profile_dir = os.environ.get("MKDOCS_PLANTUML_PROFILE") or self.config["profile_dir"]
+        if not profile_dir:
+            return self._pre_build(config)
+
+        settings = (Path.cwd() / profile_dir, self.config["profile_samples"])
+        if self.profiler is None or self.profiler.settings != settings:
+            self.profiler = BuildProfiler(*settings)
+        return self.profiler.run(self, self._pre_build, config)
+
+    def _pre_build(self, config):
+        self.build_stats = BuildStats()
+
+        self.prewarmed = False
+
+        # Under `mkdocs serve` only the changed diagrams and their dependents are looked at
+        changed = self._take_changes()
+        if changed:
+            # Diagrams that failed to render last time are tried again
+            changed |= self.retry_sources
+        elif changed is None:
+            with self.build_stats.stage("discovery"):
+                self.diagram_roots = self._find_diagram_roots()
+            self.diagram_index = None
+
+        if self.config["cache_dir"]:
+            self.render_cache = RenderCache(
+                Path.cwd() / self.config["cache_dir"],
+                self.config["cache_max_size"] * 1024 * 1024,
+            )
 
-        diagram_roots = []
-
-        exclude_dirs = self.config["exclude_dirs"]
+        self.dependency_graph.begin()
+        self.stat_cache.begin()
+        self.include_cache.begin(self.stat_cache)
+        self.made_dirs = set()
+        if self.config["manifest_file"]:
+            self._open_manifest()
+
+        if not changed:
+            # Without reported changes all diagrams are checked by their mtimes, the watcher
+            # may not have seen the change yet that triggered this rebuild
+            diagram_files = self._walk_diagrams(self.diagram_roots)
+        else:
+            diagram_files = self._changed_diagrams(changed)
+        # The walk is interleaved with the processing, only its own steps are timed
+        diagram_files = self.build_stats.timed("discovery", diagram_files)
 
-        if self.config["allow_multiple_roots"]:
-            # Run through cwd in search of diagram roots
-            for subdir, dirs, _ in os.walk(os.getcwd()):
-                dirs[:] = [d for d in dirs if d not in exclude_dirs]
-                for directory in dirs:
-                    my_subdir = f"{subdir}/{directory}"
-                    if my_subdir.endswith(self.config["diagram_root"]):
-                        diagram_roots.append(self._make_diagram_root(my_subdir))
+        self.theme_copies = []
+        self.render_owners = {}
+        self.duplicates = []
+        try:
+            self._build_sync(diagram_files)
+            # Duplicates first, a themed copy may be taken from one of them
+            self._link_duplicates()
+            self._copy_theme_outputs()
+        except BaseException:
+            # The changes were taken from the watcher, they are not lost with the build
+            if changed is not None:
+                self.retry_sources = changed | self.build_stats.failed
+            raise
         else:
-            diagram_roots.append(self._make_diagram_root(self.config["diagram_root"]))
+            self.retry_sources = set(self.build_stats.failed)
+        finally:
+            self.theme_copies = None
+            self.render_owners = None
+            self.duplicates = None
+
+        self.dependency_graph.prune()
+        if self.config["dependency_graph_file"]:
+            self.dependency_graph.dump(Path.cwd() / self.config["dependency_graph_file"])
+
+        if self.manifest is not None:
+            # Not recorded as current, so a failed render is tried again next time
+            for src_file in self.build_stats.failed:
+                self.manifest.forget(src_file)
+            self.manifest.save()
+
+        if self.render_cache is not None:
+            self.render_cache.evict()
+
+        self.stat_cache.end()
+
+        if self.serve_server is not None:
+            self._watch_diagram_dirs()
+
+        self.total_time = self.build_stats.finish()
+        self.build_stats.log_summary()
+        report_file = Path.cwd() / self.config["timing_report_file"]
+        # A build that only skipped diagrams keeps the report, rewriting it could trigger the next rebuild
+        if self.config["timing_report_file"] and (self.build_stats.handled or not report_file.exists()):
+            report = json.dumps(self.build_stats.report(), indent=1)
+            self._write_file(report_file, report.encode("utf-8"))
+
+        return config
+
+    def _settings_fingerprint(self):
+        """Outputs written with other settings can't be trusted"""
+        settings = {
+            key: self.config[key]
+            for key in (
+                "render", "server", "bin_path", "output_format", "output_folder",
+                "output_in_dir", "input_folder", "theme_enabled", "theme_light", "theme_dark",
+                "theme_variants",
+            )
+        }
+        return RenderCache.key(json.dumps(settings, sort_keys=True))
+
+    def _discovery_fingerprint(self):
+        """The diagrams found by a walk depend on these settings"""
+        settings = {
+            key: self.config[key]
+            for key in (
+                "diagram_root", "diagram_roots", "allow_multiple_roots", "input_folder",
+                "input_extensions", "include_patterns", "exclude_patterns", "exclude_dirs",
+                "respect_gitignore",
+            )
+        }
+        settings["cwd"] = os.getcwd()
+        return RenderCache.key(json.dumps(settings, sort_keys=True))
+
+    def _open_manifest(self):
+        """Loads the manifest once, it stays in memory between `mkdocs serve` rebuilds"""
+        path = Path.cwd() / self.config["manifest_file"]
+        fingerprint = self._settings_fingerprint()
+        if (
+            self.manifest is None
+            or self.manifest.path != path
+            or self.manifest.fingerprint != fingerprint
+        ):
+            self.manifest = BuildManifest(path, fingerprint)
+            for src_file, entry in self.manifest.entries.items():
+                self.dependency_graph.update(src_file, entry["includes"])
+        self.manifest.begin(self.dependency_graph, self.stat_cache)
+
+    def _find_diagram_roots(self):
+        if self.config["diagram_roots"]:
+            # Listed explicitly, nothing to search
+            return [self._make_diagram_root(subdir) for subdir in self.config["diagram_roots"]]
+
+        if not self.config["allow_multiple_roots"]:
+            return [self._make_diagram_root(self.config["diagram_root"])]
+
+        # Run through cwd in search of diagram roots, unless no folder changed since the last search
+        settings = (
+            os.getcwd(),
+            self.config["diagram_root"],
+            tuple(self.config["exclude_dirs"]),
+            self.config["respect_gitignore"],
+        )
+        if self.root_finder is None or self.root_finder.settings != settings:
+            self.root_finder = RootFinder(*settings)
+        return [self._make_diagram_root(subdir) for subdir in self.root_finder.find()]
+
+    def _build_sync(self, diagram_files):
+        # Server requests are handed to a thread pool if more than one worker is configured
+        if self.config["workers"] > 1 and self.config["render"] in ("server", "local-server"):
+            self.render_pool = RenderPool(self.config["workers"])
+        self._begin_local_batch()
 
+        try:
+            for root, subdir, file in diagram_files:
+                self._process_file(root, subdir, file)
+            self._render_local_batch()
+        finally:
+            self.local_batch = None
+            if self.render_pool is not None:
+                render_pool, self.render_pool = self.render_pool, None
+                render_pool.join()
+
+    def _walk_diagrams(self, diagram_roots):
+        """Yields (root, subdir, file) of every diagram and keeps them for incremental rebuilds"""
+        matcher = self._file_matcher()
+        index = {}
         # Run through input folders
         for root in diagram_roots:
+            prefix_length = len(root.src_dir) + 1
             for subdir, dirs, files in os.walk(root.src_dir):
-                dirs[:] = [d for d in dirs if d not in exclude_dirs]
+                rel_dir = subdir[prefix_length:] + "/" if len(subdir) > len(root.src_dir) else ""
+                # Folders without diagrams are not descended into
+                dirs[:] = [d for d in dirs if not matcher.prunes(d, rel_dir + d)]
                 for file in files:
-                    if self._file_matches_extension(file):
-                        diagram = PuElement(file, subdir)
-                        diagram.root_dir = root.root_dir
-                        diagram.out_dir = self._get_out_directory(root, subdir)
-
-                        # Handle to read source file
-                        with (Path(diagram.directory) / diagram.file).open("rt", encoding="utf-8") as f:
-                            diagram.src_file = f.readlines()
-
-                        # Search for start (@startuml <filename>)
-                        if not self._search_start_tag(diagram):
-                            # check the outfile (.ext will be set to .png or .svg etc.)
-                            self._build_out_filename(diagram)
-
-                        # Checks modification times for target and include files to know if we update
-                        self._build_mtimes(diagram)
-
-                        # Go through the file (only relevant for server rendering)
-                        self._readFile(diagram, False)
-
-                        # Finally convert
-                        self._convert(diagram)
-
-                        # Second time (if dark mode is enabled)
-                        if self.config["theme_enabled"]:
-                            # Go through the file a second time for themed option
-                            self._readFile(diagram, True)
+                    if matcher.matches(file, rel_dir + file):
+                        index[str(Path(subdir) / file)] = (root, subdir, file)
+                        yield root, subdir, file
+        self.diagram_index = index
+        self.output_index = {k: v for k, v in self.output_index.items() if k in index}
+        self.settings = (self._settings_fingerprint(), self._discovery_fingerprint())
+
+    def _take_changes(self):
+        """The files changed since the last build, None if the diagrams have to be walked again"""
+        if self.watcher is None:
+            return None
+        changed, rescan = self.watcher.take()
+        settings = (self._settings_fingerprint(), self._discovery_fingerprint())
+        if rescan or self.diagram_index is None or self.settings != settings:
+            return None
+        return changed
+
+    def _changed_diagrams(self, changed):
+        """Yields the diagrams affected by the changed files, all others are kept as they are"""
+        targets = {}
+        for path in changed:
+            if path in self.diagram_index:
+                if os.path.exists(path):
+                    targets[path] = self.diagram_index[path]
+                else:
+                    # Deleted, the graph and the manifest forget it since it isn't visited
+                    del self.diagram_index[path]
+                    self.output_index.pop(path, None)
+            else:
+                entry = self._new_diagram(path)
+                if entry is not None:
+                    self.diagram_index[path] = targets[path] = entry
+
+        # The include graph uses resolved paths
+        resolved = {os.path.realpath(path) for path in changed}
+        for src_file in self.dependency_graph.dependents_of(resolved):
+            if src_file in self.diagram_index:
+                targets[src_file] = self.diagram_index[src_file]
+
+        for src_file, entry in self.diagram_index.items():
+            if src_file in targets:
+                continue
+            # A deleted image is rendered again, even though its source didn't change
+            if not all(map(self.stat_cache.exists, self.output_index.get(src_file, ()))):
+                targets[src_file] = entry
+            else:
+                self.dependency_graph.visit(src_file)
+                if self.manifest is not None:
+                    self.manifest.keep(src_file)
+
+        log.debug(f"{len(changed)} files changed, {len(targets)} diagrams affected")
+        for src_file in sorted(targets):
+            yield targets[src_file]
+
+    def _new_diagram(self, path):
+        """(root, subdir, file) if a file that was not known before is a diagram"""
+        subdir, file = os.path.split(path)
+        if not os.path.isfile(path):
+            return None
+        matcher = self._file_matcher()
+        for root in self.diagram_roots:
+            try:
+                parts = Path(subdir).relative_to(root.src_dir).parts
+            except ValueError:
+                continue
+            rel_dir = ""
+            for part in parts:
+                if matcher.prunes(part, rel_dir + part):
+                    return None
+                rel_dir += part + "/"
+            if matcher.matches(file, rel_dir + file):
+                return root, subdir, file
+        return None
+
+    def _watch_diagram_dirs(self):
+        """Tells the livereload server (and our watcher) about the source and include folders"""
+        directories = {root.src_dir: True for root in self.diagram_roots or ()}
+        for include in self.dependency_graph.dependents:
+            directories.setdefault(os.path.dirname(include), False)
+        for directory, sources in directories.items():
+            if directory in self.watched_dirs or not os.path.isdir(directory):
+                continue
+            self.watched_dirs.add(directory)
+            # Include folders may be the project root, livereload must not see the plugin's own files
+            self.serve_server.watch(directory, recursive=sources)
+            if self.watcher is not None:
+                self.watcher.watch(directory, sources)
+
+    def _begin_local_batch(self):
+        # Every PlantUML run starts a JVM, so local renders are collected and run together
+        if self.config["render"] == "local":
+            self.local_batch = LocalBatch(
+                self.config["bin_path"].rsplit(), self._output_formats()[0]
+            )
 
-                            # Finally convert
-                            self._convert(diagram, True)
+    def _render_local_batch(self):
+        if self.local_batch is None:
+            return
+        batch, self.local_batch = self.local_batch, None
+        start = time.perf_counter()
+        rendered, failed = batch.run()
+        # One JVM run renders them all, each diagram gets its share of the time
+        share = (time.perf_counter() - start) / max(1, len(rendered) + len(failed))
+        for diagram in rendered:
+            self.build_stats.render(diagram, share)
+            self.failed_outputs.discard(diagram.out_file)
+            self._store_cached(diagram, diagram.out_file)
+        for diagram in failed:
+            self.build_stats.render(diagram, share, failed=True)
+            self.failed_outputs.add(diagram.out_file)
+            log.error(f"Could not render {Path(diagram.directory) / diagram.file}")
+
+    def _process_file(self, root, subdir, file):
+        # Nothing has changed since the last build, not even an include
+        src_file = str(Path(subdir) / file)
+        self.build_stats.count("diagrams")
+        if self.manifest is not None and self.manifest.is_fresh(src_file):
+            self.dependency_graph.visit(src_file)
+            self.output_index[src_file] = self.manifest.entries[src_file]["outputs"]
+            return
+
+        diagram = PuElement(file, subdir)
+        diagram.root_dir = root.root_dir
+        diagram.out_dir = self._get_out_directory(root, subdir)
+
+        # Handle to read source file
+        with self.build_stats.stage("read", diagram):
+            with (Path(diagram.directory) / diagram.file).open("rt", encoding="utf-8") as f:
+                diagram.src_file = f.readlines()
+
+        formats = self._output_formats()
+        for output_format in formats:
+            diagram.output_format = output_format
+
+            # Search for start (@startuml <filename>)
+            with self.build_stats.stage("start_tag", diagram):
+                named = self._search_start_tag(diagram)
+            if not named:
+                # check the outfile (.ext will be set to .png or .svg etc.)
+                self._build_out_filename(diagram)
+
+            # Checks modification times for target and include files to know if we update
+            self._build_mtimes(diagram)
+            diagram.formats[output_format] = (diagram.out_files, diagram.img_times)
+
+        self.output_index[src_file] = [
+            out_file
+            for out_files, _ in diagram.formats.values()
+            for out_file in (out_files if self.config["theme_enabled"] else out_files[:1])
+        ]
+
+        # The includes of the last expansion tell if anything changed, no need to expand again
+        if all(self._known_up_to_date(src_file, self._select_format(diagram, f)) for f in formats):
+            self.dependency_graph.visit(src_file)
+            if self.manifest is not None:
+                self.manifest.record(diagram, self.config["theme_enabled"])
+            return
+
+        # Connect to the server (or start the local ones) while the first stale diagram is expanded
+        self._prewarm()
+
+        # Go through the file (only relevant for server rendering)
+        self._readFile(diagram, 0)
+
+        # Finally convert, the encoded diagram is the same for every format
+        for output_format in formats:
+            self._convert(self._select_format(diagram, output_format))
+
+        # Once more for every other theme (if themes are enabled)
+        if self.config["theme_enabled"]:
+            for variant in range(1, len(self._variants())):
+                # Select the variant from the expansion of the first pass
+                self._readFile(diagram, variant)
+
+                # Finally convert
+                for output_format in formats:
+                    self._convert(self._select_format(diagram, output_format), variant)
+
+        self.dependency_graph.update(src_file, diagram.includes)
+        if self.manifest is not None:
+            self.manifest.record(diagram, self.config["theme_enabled"])
+
+    @staticmethod
+    def _select_format(diagram, output_format):
+        """Points the outputs of the diagram to the images of one format"""
+        diagram.output_format = output_format
+        diagram.out_files, diagram.img_times = diagram.formats[output_format]
+        return diagram
 
-        return config
+    def _known_up_to_date(self, src_file, diagram):
+        """True if all images are newer than the source and the includes it had last time"""
+        includes = self.dependency_graph.includes.get(src_file)
+        if includes is None:
+            # Never expanded, the includes are unknown
+            return False
+
+        mtimes = {}
+        for include in includes:
+            mtime = self._include_mtime(include)
+            if mtime is None:
+                return False
+            mtimes[include] = mtime
+        inc_time = max(mtimes.values(), default=0)
+
+        img_times = diagram.img_times if self.config["theme_enabled"] else diagram.img_times[:1]
+        if not all(diagram.src_time <= img_time and inc_time <= img_time for img_time in img_times):
+            return False
+
+        diagram.includes = mtimes
+        diagram.inc_time = inc_time
+        return True
+
+    def _include_mtime(self, include):
+        """Stats every include only once per build, None if it is gone"""
+        return self.stat_cache.mtime(include)
 
     def _make_diagram_root(self, subdir):
         diagram_root = DiagramRoot()
@@ -157,69 +614,156 @@ class BuildPlantumlPlugin(BasePlugin[BuildPlantumlPluginConfig]):
                     # we look for <filename> which starts after a whitespace
                     out_filename = line[ws + 1 :].strip().strip('"\'')
 
-                    diagram.out_file = str(outDir / f"{out_filename}.{self.config['output_format']}")
-                    if self.config["theme_enabled"]:
-                        diagram.out_file_dark = str(outDir / f"{out_filename}_dark.{self.config['output_format']}")
+                    diagram.out_files = [
+                        str(outDir / f"{out_filename}{suffix}.{self._output_format(diagram)}")
+                        for suffix in self._output_suffixes()
+                    ]
                     return True
         return False
 
     def _build_mtimes(self, diagram):
         # Compare the file mtimes between src and target
-        try:
-            diagram.img_time = Path(diagram.out_file).stat().st_mtime
-        except Exception:
-            diagram.img_time = 0
-
-        if self.config["theme_enabled"]:
-            try:
-                diagram.img_time_dark = Path(diagram.out_file_dark).stat().st_mtime
-            except Exception:
-                diagram.img_time_dark = 0
-
-        diagram.src_time = (Path(diagram.directory) / diagram.file).stat().st_mtime
+        diagram.img_times = []
+        for out_file in diagram.out_files:
+            img_time = self.stat_cache.mtime(out_file)
+            # An image rendered again with the same content kept its old mtime
+            confirmed = self.confirmed_outputs.get(out_file)
+            if confirmed is not None and img_time == confirmed[0]:
+                img_time = confirmed[1]
+            if out_file in self.failed_outputs:
+                # An error image, rendered again until it succeeds
+                img_time = None
+            diagram.img_times.append(0 if img_time is None else img_time)
+
+        diagram.src_time = self.stat_cache.stat(Path(diagram.directory) / diagram.file).st_mtime
 
         # Include time
         diagram.inc_time = 0
 
-    def _readFile(self, diagram, dark_mode):
+    def _readFile(self, diagram, variant):
         log.debug(f"Processing diagram {diagram.file}")
-        temp_file = self._readFileRecursively(
-            diagram.src_file, "", diagram, diagram.directory, dark_mode
-        )
         try:
-            compressed_str = zlib.compress(temp_file.encode("utf-8"))
-            compressed_string = compressed_str[2:-4]
+            if variant and diagram.template is not None:
+                # The light pass expanded the other themes as well, nothing is read again
+                template = diagram.template
+            else:
+                template = self._expand(diagram.src_file, diagram, diagram.directory, variant)
+                if not variant and self.config["theme_enabled"]:
+                    # Kept for the other themes
+                    with self.build_stats.stage("expand", diagram):
+                        template = diagram.template = list(template)
+
+            self._encode(diagram, template, variant)
+        except UnicodeEncodeError as _:
+            diagram.b64encoded = ""
+
+    def _encode(self, diagram, template, variant):
+        """Selects the variant from the expansion, hashes and encodes it for the server URL
+
+        template may still be expanding, every chunk is hashed and compressed as it arrives.
+        """
+        chunks = []
+        digest = hashlib.sha256()
+        # A variant is only compressed if it differs from the light diagram
+        compressor = None if variant else zlib.compressobj(-1, zlib.DEFLATED, -15)
+        compressed = []
+
+        # The expansion is timed on its own while it is pulled from template
+        start = time.perf_counter()
+        expanding = 0.0
+        selected = self._select(template, variant)
+        try:
+            while True:
+                pulled = time.perf_counter()
+                chunk = next(selected, None)
+                expanding += time.perf_counter() - pulled
+                if chunk is None:
+                    break
+                chunks.append(chunk)
+                data = chunk.encode("utf-8")
+                digest.update(data)
+                if compressor is not None:
+                    compressed.append(compressor.compress(data))
+
+            if variant:
+                diagram.variant_hashes[variant] = digest.hexdigest()
+                if diagram.variant_hashes[variant] == diagram.content_hash:
+                    # Doesn't use the theme, the light encoding is still in place
+                    return
+                compressor = zlib.compressobj(-1, zlib.DEFLATED, -15)
+                compressed = [compressor.compress(chunk.encode("utf-8")) for chunk in chunks]
+            else:
+                diagram.content_hash = digest.hexdigest()
+            compressed.append(compressor.flush())
+
             diagram.b64encoded = (
-                base64.b64encode(compressed_string)
+                base64.b64encode(b"".join(compressed))
                 .translate(b64_to_plantuml)
                 .decode("utf-8")
             )
-            diagram.concat_file = temp_file
-        except Exception as _:
-            diagram.b64encoded = ""
+            diagram.concat_file = "".join(chunks)
+        finally:
+            self.build_stats.add("expand", expanding, diagram)
+            self.build_stats.add("encode", time.perf_counter() - start - expanding, diagram)
 
     # Reads the file recursively
-    def _readFileRecursively(self, lines, temp_file, diagram, directory, dark_mode):
+    def _select(self, chunks, variant):
+        """Yields the text of one theme variant of expanded chunks"""
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                yield chunk
+            else:
+                yield from self._select(chunk.variants[variant], variant)
+
+    @staticmethod
+    def _compact(chunks):
+        """Joins neighbouring strings, the theme choices stay in between"""
+        template, text = [], []
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                text.append(chunk)
+            else:
+                if text:
+                    template.append("".join(text))
+                    text = []
+                template.append(chunk)
+        if text:
+            template.append("".join(text))
+        return tuple(template)
+
+    def _expand(self, lines, diagram, directory, variant):
+        """Yields the lines of the diagram with all includes expanded"""
         for line in lines:
             line = line.strip()
             if line.startswith("!include"):
-                temp_file = self._readIncludeLine(
-                    diagram, line, temp_file, directory, dark_mode
-                )
+                yield from self._expand_include_line(diagram, line, directory, variant)
             else:
-                temp_file += line
+                yield line
 
             if "\n" not in line:
-                temp_file += "\n"
-
-        return temp_file
+                yield "\n"
+
+    def _expand_include_line(self, diagram, line, directory, variant):
+        """Expands an include, a theme include is expanded for all themes in the light pass"""
+        if (
+            not variant
+            and self.config["theme_enabled"]
+            and self.config["theme_light"] in line
+            and not line.startswith("!includeurl")
+        ):
+            yield ThemeChoice(tuple(
+                self._compact(self._expand_include_target(diagram, line, directory, other))
+                for other in range(len(self._variants()))
+            ))
+        else:
+            yield from self._expand_include_target(diagram, line, directory, variant)
 
-    def _readIncludeLine(self, diagram, line, temp_file, directory, dark_mode):
+    def _expand_include_target(self, diagram, line, directory, variant):
         """Handles the different include types like !includeurl, !include and !includesub"""
         # If includeurl is found, we do not have to do anything here.
         # Server can handle that
         if re.match(r"^!includeurl\s+\S+\s*$", line):
-            temp_file += line
+            yield line
 
         elif re.match(r"^!includesub\s+\S+\s*$", line):
             # on the eleventh position starts the inluded file
@@ -228,26 +772,27 @@ class BuildPlantumlPlugin(BasePlugin[BuildPlantumlPluginConfig]):
                 inc_file = parts[0]  # Extract the file path
                 sub_name = parts[1]  # Extract the sub name after the '!'
 
-                if dark_mode:
+                if variant:
                     inc_file = inc_file.replace(
-                        self.config["theme_light"], self.config["theme_dark"]
+                        self.config["theme_light"], self._variants()[variant].theme
                     )
 
-                # Read sub contents of the included file
+                # Read sub contents of the included file, a failed attempt must not leave partial output
                 try:
-                    inc_file_abs = str((Path(directory) / inc_file).resolve())
-                    temp_file = self._read_incl_sub(
-                        diagram, temp_file, dark_mode, inc_file_abs, sub_name
-                    )
+                    inc_file_abs = self.stat_cache.resolve(Path(directory) / inc_file)
+                    chunks = list(self._expand_incl_sub(
+                        diagram, variant, inc_file_abs, sub_name
+                    ))
                 except Exception as e1:
                     try:
-                        inc_file_abs = str((Path(diagram.root_dir) / inc_file).resolve())
-                        temp_file = self._read_incl_sub(
-                            diagram, temp_file, dark_mode, inc_file_abs, sub_name
-                        )
+                        inc_file_abs = self.stat_cache.resolve(Path(diagram.root_dir) / inc_file)
+                        chunks = list(self._expand_incl_sub(
+                            diagram, variant, inc_file_abs, sub_name
+                        ))
                     except Exception as e2:
                         log.error("Could not find included file" + str(e1) + str(e2))
                         raise e2
+                yield from chunks
             else:
                 raise Exception(
                     "Invalid !includesub syntax. Expected: !includesub <filepath>!<sub_name>"
@@ -257,200 +802,596 @@ class BuildPlantumlPlugin(BasePlugin[BuildPlantumlPluginConfig]):
             # on the ninth position starts the filename
             inc_file = line[9:].rstrip()
 
-            if dark_mode:
+            if variant:
                 inc_file = inc_file.replace(
-                    self.config["theme_light"], self.config["theme_dark"]
+                    self.config["theme_light"], self._variants()[variant].theme
                 )
 
             # According to plantuml, simple !include can also have urls, or use the <> format to include stdlib files,
             # ignore that and continue
             if inc_file.startswith("http") or inc_file.startswith("<"):
-                temp_file += line
-                return temp_file
+                yield line
+                return
 
             # Read contents of the included file
+            chunks = []
             try:
-                inc_file_abs = (Path(directory) / inc_file).resolve()
-                if inc_file_abs.exists():
-                    temp_file = self._read_incl_line_file(
-                        diagram, temp_file, dark_mode, inc_file_abs
-                    )
+                inc_file_abs = Path(self.stat_cache.resolve(Path(directory) / inc_file))
+                if self.stat_cache.exists(inc_file_abs):
+                    chunks = list(self._expand_incl_line_file(
+                        diagram, variant, inc_file_abs
+                    ))
                 else:
                     log.error(f"Could not find include in primary location: {inc_file_abs}")
-                    inc_file_abs_alt = (Path(diagram.root_dir) / inc_file).resolve()
-                    if inc_file_abs_alt.exists():
-                        temp_file = self._read_incl_line_file(
-                            diagram, temp_file, dark_mode, inc_file_abs
-                        )
+                    inc_file_abs_alt = Path(self.stat_cache.resolve(Path(diagram.root_dir) / inc_file))
+                    if self.stat_cache.exists(inc_file_abs_alt):
+                        chunks = list(self._expand_incl_line_file(
+                            diagram, variant, inc_file_abs
+                        ))
                     else:
                         log.error(f"Could not find include in secondary location: {inc_file_abs}")
                         raise Exception(f"Include could not be resolved: {line}")
             except FileNotFoundError as fnfe:
                 log.error(f"Could not find include {fnfe}")
+            yield from chunks
         else:
             raise Exception(f"Unknown include type: {line}")
-        return temp_file
-
-    def _read_incl_line_file(self, diagram, temp_file, dark_mode, inc_file_abs):
-        """Save the mtime of the inc file to compare"""
-        try:
-            local_inc_time = inc_file_abs.stat().st_mtime
-        except Exception as _:
-            local_inc_time = 0
-
-        if local_inc_time > diagram.inc_time:
-            diagram.inc_time = local_inc_time
 
-        with inc_file_abs.open("rt") as inc:
-            temp_file = self._readFileRecursively(
-                inc,
-                temp_file,
-                diagram,
-                inc_file_abs.parent.resolve(),
-                dark_mode,
-            )
+    def _expand_incl_line_file(self, diagram, variant, inc_file_abs):
+        """Expands an included file, every file is only read once per build"""
+        # Nested includes may fall back to the diagram root and get the theme swapped
+        theme = (self.config["theme_enabled"], self._variants(), int(variant))
+        key = (str(inc_file_abs), diagram.root_dir, theme)
 
-        return temp_file
-
-    def _read_incl_sub(self, diagram, temp_file, dark_mode, inc_file_abs, inc_sub_name):
+        cached = self.include_cache.lookup(key)
+        if cached is None:
+            # Collect the includes of this file separately, so they can be cached with it
+            outer_includes, diagram.includes = diagram.includes, {}
+            try:
+                # Save the mtime of the inc file to compare
+                local_inc_time = self.stat_cache.mtime(inc_file_abs) or 0
+                diagram.includes[str(inc_file_abs)] = local_inc_time
+
+                with inc_file_abs.open("rt") as inc:
+                    template = self._compact(self._expand(
+                        inc,
+                        diagram,
+                        Path(self.stat_cache.resolve(inc_file_abs.parent)),
+                        variant,
+                    ))
+                cached = self.include_cache.store(key, template, diagram.includes)
+            finally:
+                diagram.includes = outer_includes
+
+        template, includes = cached
+        diagram.includes.update(includes)
+        diagram.inc_time = max(diagram.inc_time, *includes.values())
+
+        yield from template
+
+    def _expand_incl_sub(self, diagram, variant, inc_file_abs, inc_sub_name):
         """Handle !includesub statements"""
         # Save the mtime of the inc file to compare
         incFileAbs = Path(inc_file_abs)
-        try:
-            local_inc_time = incFileAbs.stat().st_mtime
-        except Exception as _:
-            local_inc_time = 0
+        local_inc_time = self.stat_cache.mtime(incFileAbs) or 0
+
+        temp_sub = self._index_subs(incFileAbs, local_inc_time).get(inc_sub_name, [])
 
+        # Only recorded once the file could be read, a missing primary location is no dependency
         if local_inc_time > diagram.inc_time:
             diagram.inc_time = local_inc_time
+        diagram.includes[str(incFileAbs)] = local_inc_time
+
+        yield from self._expand(
+            temp_sub,  # Do only use the subs for further recursion
+            diagram,
+            Path(self.stat_cache.resolve(incFileAbs.parent)),
+            variant,
+        )
+
+    def _index_subs(self, inc_file_abs, mtime):
+        """Collects the lines of all !startsub blocks of a file in one pass"""
+        cached = self.sub_index.get(inc_file_abs)
+        if cached is not None and mtime and cached[0] == mtime:
+            return cached[1]
 
-        temp_sub = []
-        add_following = False
-        with incFileAbs.open("rt") as inc:
+        subs = {}
+        open_subs = []
+        with inc_file_abs.open("rt") as inc:
             for line in inc:
                 line = line.strip()
-                if re.match(r"^!startsub\s+" + re.escape(inc_sub_name) + r"\s*$", line):
-                    add_following = True
-                elif re.match(r"^!endsub\s*$", line) or re.match(r"^@enduml\s*$", line):
-                    add_following = False
-                elif add_following:
-                    temp_sub.append(line)
-
-            temp_file = self._readFileRecursively(
-                temp_sub,  # Do only use the subs for further recursion
-                temp_file,
-                diagram,
-                incFileAbs.parent.resolve(),
-                dark_mode,
-            )
+                match = startsub_pattern.match(line)
+                if match:
+                    sub_name = match.group(1)
+                    # For the surrounding subs a nested !startsub line is plain content
+                    for name in open_subs:
+                        if name != sub_name:
+                            subs[name].append(line)
+                    if sub_name not in open_subs:
+                        open_subs.append(sub_name)
+                        subs.setdefault(sub_name, [])
+                elif endsub_pattern.match(line):
+                    open_subs = []
+                else:
+                    for name in open_subs:
+                        subs[name].append(line)
 
-        return temp_file
+        self.sub_index[inc_file_abs] = (mtime, subs)
+        return subs
 
     def _build_out_filename(self, diagram):
+        suffixes = self._output_suffixes()
+        names = [""] * len(suffixes)
         out_index = diagram.file.rfind(".")
         if out_index > -1:
-            diagram.out_file = (
-                diagram.file[: out_index + 1] + self.config["output_format"]
-            )
-            if self.config["theme_enabled"]:
-                diagram.out_file_dark = (
-                    diagram.file[:out_index] + "_dark." + self.config["output_format"]
-                )
+            names = [
+                diagram.file[:out_index] + suffix + "." + self._output_format(diagram)
+                for suffix in suffixes
+            ]
 
-        diagram.out_file = str(Path(diagram.out_dir) / diagram.out_file)
-        if self.config["theme_enabled"]:
-            diagram.out_file_dark = str(Path(diagram.out_dir) / diagram.out_file_dark)
+        diagram.out_files = [str(Path(diagram.out_dir) / name) for name in names]
 
         return diagram
 
-    def _convert(self, diagram, dark_mode=False):
-        if not dark_mode:
+    def _variants(self):
+        """The themes to render, the first is the light theme the diagrams include"""
+        key = (self.config["theme_light"], self.config["theme_dark"], repr(self.config["theme_variants"]))
+        if self.variants_key != key:
+            variants = [ThemeVariant("light", self.config["theme_light"], "")]
+            # Without a list, the dark theme is the only other one
+            entries = self.config["theme_variants"] or [
+                {"name": "dark", "theme": self.config["theme_dark"], "suffix": "_dark"}
+            ]
+            for entry in entries:
+                if not isinstance(entry, dict) or "name" not in entry or "theme" not in entry:
+                    raise Exception(f"theme_variants entries need a name and a theme: {entry}")
+                variants.append(
+                    ThemeVariant(entry["name"], entry["theme"], entry.get("suffix", "_" + entry["name"]))
+                )
+            self.variants, self.variants_key = tuple(variants), key
+        return self.variants
+
+    def _output_formats(self):
+        """output_format is one format or a list of them"""
+        formats = self.config["output_format"]
+        if isinstance(formats, str):
+            return [formats]
+        if not formats:
+            raise Exception("output_format needs at least one format")
+        return list(formats)
+
+    def _output_format(self, diagram):
+        return diagram.output_format or self._output_formats()[0]
+
+    def _output_suffixes(self):
+        if not self.config["theme_enabled"]:
+            return [""]
+        return [variant.suffix for variant in self._variants()]
+
+    def _convert(self, diagram, variant=0):
+        if not variant:
             if (diagram.img_time < diagram.src_time) or (
                 diagram.inc_time > diagram.img_time
             ):
                 diagramFile = Path(diagram.directory) / diagram.file
+                if self._deduplicated(diagram, diagram.out_file, variant):
+                    return
+                if self._restore_cached(diagram, diagram.out_file, variant):
+                    return
                 log.info(f"Converting {diagramFile} in {diagram.out_dir}")
-                if self.config["render"] == "local":
+                if self.config["render"] == "local" and self.local_batch is not None:
+                    self.local_batch.add(diagram)
+                elif self.config["render"] == "local":
                     command = self.config["bin_path"].rsplit()
-                    call(
+                    start = time.perf_counter()
+                    returncode = call(
                         [
                             *command,
-                            "-t" + self.config["output_format"],
+                            "-t" + self._output_format(diagram),
                             str(diagramFile),
                             "-o",
                             diagram.out_dir,
                         ]
                     )
+                    self.build_stats.render(
+                        diagram, time.perf_counter() - start, failed=returncode != 0
+                    )
+                    if returncode == 0:
+                        self.failed_outputs.discard(diagram.out_file)
+                        self._store_cached(diagram, diagram.out_file)
+                    else:
+                        self.failed_outputs.add(diagram.out_file)
+                elif self.config["render"] == "local-pipe":
+                    self._call_pipe(diagram, diagram.out_file)
+                else:
+                    self._dispatch_server(diagram, diagram.out_file)
+
+        # If another theme AND edit time of includes higher than its image
+        else:
+            out_file = diagram.out_files[variant]
+            img_time = diagram.img_times[variant] if variant < len(diagram.img_times) else 0
+            if img_time >= diagram.src_time and diagram.inc_time <= img_time:
+                return
+
+            variant_hash = diagram.variant_hashes.get(variant)
+            if variant_hash and variant_hash == diagram.content_hash:
+                self._copy_light_output(diagram, out_file)
+            elif self._deduplicated(diagram, out_file, variant):
+                return
+            elif not self._restore_cached(diagram, out_file, variant):
+                if self.config["render"] in ("local", "local-pipe"):
+                    # PlantUML renders files by their own name, so the themed source is piped in
+                    self._call_pipe(diagram, out_file)
                 else:
-                    self._call_server(diagram, diagram.out_file)
-
-        # If Dark mode AND edit time of includes higher than
-        # image AND server render
-        elif (
-            dark_mode
-            and (
-                (diagram.img_time_dark < diagram.src_time)
-                or (diagram.inc_time > diagram.img_time_dark)
+                    self._dispatch_server(diagram, out_file)
+
+    def _copy_light_output(self, diagram, out_file):
+        """Same source for all themes, so the light image is the themed one too"""
+        if self.theme_copies is None:
+            self._copy_theme_output(diagram.out_file, out_file)
+        else:
+            # The light image may still be rendering
+            self.theme_copies.append((diagram.out_file, out_file))
+
+    def _copy_theme_outputs(self):
+        copies, self.theme_copies = self.theme_copies, None
+        for light, themed in copies:
+            self._copy_theme_output(light, themed)
+        if copies:
+            log.debug(f"Copied {len(copies)} themed images of diagrams not using the theme")
+
+    def _copy_theme_output(self, light, themed):
+        self._copy_output(light, themed)
+        # A copy of an error image is rendered again together with the light one
+        if str(light) in self.failed_outputs:
+            self.failed_outputs.add(str(themed))
+        else:
+            self.failed_outputs.discard(str(themed))
+
+    def _copy_output(self, source, target):
+        # A copy and not a link, PlantUML overwrites the light image in place with render: local
+        try:
+            content = Path(source).read_bytes()
+        except FileNotFoundError:
+            log.warning(f"Could not copy {source} to {target}, the image is missing")
+            return
+        self._write_file(Path(target), content)
+
+    def _deduplicated(self, diagram, out_file, variant):
+        """True if the same source is already rendered in this build, the image is linked later"""
+        if self.render_owners is None:
+            return False
+        content_hash = diagram.variant_hashes.get(variant) if variant else diagram.content_hash
+        if not content_hash:
+            return False
+        key = (content_hash, self._output_format(diagram))
+        owner = self.render_owners.setdefault(key, out_file)
+        if owner == out_file:
+            return False
+        log.debug(f"{out_file} has the same source as {owner}")
+        self.duplicates.append((owner, out_file))
+        self.build_stats.count("deduplicated", diagram)
+        return True
+
+    def _link_duplicates(self):
+        duplicates, self.duplicates = self.duplicates, None
+        for owner, out_file in duplicates:
+            self._link_output(owner, Path(out_file))
+            if owner in self.failed_outputs:
+                self.failed_outputs.add(out_file)
+            else:
+                self.failed_outputs.discard(out_file)
+        if duplicates:
+            rendered = len(self.render_owners)
+            log.info(
+                f"Rendered {rendered} unique diagrams for {rendered + len(duplicates)} images, "
+                f"{len(duplicates) / (rendered + len(duplicates)):.0%} deduplicated"
             )
-            and self.config["render"] == "server"
-        ):
-            self._call_server(diagram, diagram.out_file_dark)
 
-    def _call_server(self, diagram, out_file):
-        http = httplib2.Http({})
+    def _link_output(self, source, target):
+        """Hardlinks the image of a diagram with the same source, or copies it"""
+        try:
+            if filecmp.cmp(source, target, shallow=False):
+                self._confirm_output(target)
+                return
+        except OSError:
+            pass
+        # PlantUML overwrites its images in place with render: local, which would change all links
+        if self.config["render"] != "local":
+            self._make_dirs(target.parent)
+            tmp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                os.link(source, tmp)
+                os.replace(tmp, target)
+            except OSError:
+                # Another file system, or no hardlinks there
+                tmp.unlink(missing_ok=True)
+            else:
+                self.stat_cache.invalidate(target)
+                self.confirmed_outputs.pop(str(target), None)
+                return
+        self._copy_output(source, target)
+
+    def _cache_key(self, diagram, variant):
+        """Everything the rendered image depends on"""
+        if self.config["render"] in ("local", "local-pipe", "local-server"):
+            renderer = self.config["bin_path"]
+        else:
+            renderer = self.config["server"]
+        theme = self._variants()[variant].theme
+        return RenderCache.key(
+            diagram.concat_file, self._output_format(diagram), renderer, theme
+        )
+
+    def _restore_cached(self, diagram, out_file, variant):
+        """Copies the image from the render cache, returns False on a miss"""
+        if self.render_cache is None:
+            return False
+        diagram.cache_key = self._cache_key(diagram, variant)
+        if self.render_cache.restore(diagram.cache_key, out_file, self._write_file):
+            log.debug(f"Restored {out_file} from render cache")
+            self.failed_outputs.discard(str(out_file))
+            self.build_stats.count("cache_hits", diagram)
+            return True
+        return False
 
-        if self.config["disable_ssl_certificate_validation"]:
-            http.disable_ssl_certificate_validation = True
+    def _store_cached(self, diagram, out_file):
+        if self.render_cache is not None and diagram.cache_key:
+            self.render_cache.store(diagram.cache_key, out_file)
 
-        url = (
-            self.config["server"]
+    def _dispatch_server(self, diagram, out_file):
+        """Call the server right away or queue the request on the render pool"""
+        if self.render_pool is None:
+            self._call_server(diagram, out_file)
+        else:
+            # The diagram gets re-encoded for the dark variant while the
+            # request is in flight, so the worker gets its own copy
+            self.render_pool.submit(self._call_server, copy.copy(diagram), out_file)
+
+    def _prewarm(self):
+        """Once per build, nothing happens in builds without stale diagrams"""
+        if self.prewarmed:
+            return
+        self.prewarmed = True
+        if self.config["render"] == "local-server":
+            # The JVMs start up in the background, the first request waits for them
+            self._local_servers()
+        elif self.config["render"] == "server" and self.config["prewarm_connections"]:
+            self._http_pool().warm(self.config["server"])
+
+    def _http_pool(self):
+        """Returns the shared client pool, sized to the number of workers"""
+        size = max(1, self.config["workers"])
+        disable_ssl = self.config["disable_ssl_certificate_validation"]
+        timeout = self.config["render_timeout"]
+        settings = (size, disable_ssl, timeout)
+        if self.http_pool is None or (self.http_pool.size, self.http_pool.disable_ssl, self.http_pool.timeout) != settings:
+            if self.http_pool is not None:
+                self.http_pool.close()
+            self.http_pool = HttpClientPool(size, disable_ssl, timeout)
+        return self.http_pool
+
+    def _pipe_renderer(self, output_format=None):
+        """Returns the PlantUML process of a format, it is started once and kept between rebuilds"""
+        command = self.config["bin_path"].rsplit()
+        formats = self._output_formats()
+        output_format = output_format or formats[0]
+        # -pipe renders every diagram in the same format, so each format gets its own process
+        timeout = self.config["render_timeout"]
+        for other in list(self.pipe_renderers):
+            renderer = self.pipe_renderers[other]
+            if (renderer.command, renderer.timeout) != (command, timeout) or other not in formats:
+                renderer.close()
+                del self.pipe_renderers[other]
+        if output_format not in self.pipe_renderers:
+            self.pipe_renderers[output_format] = PipeRenderer(command, output_format, timeout)
+        return self.pipe_renderers[output_format]
+
+    def _request_headers(self, diagram=None):
+        output_format = self._output_formats()[0] if diagram is None else self._output_format(diagram)
+        # PNGs are compressed already, so only ask for gzip where it pays off
+        if self.config["gzip_svg"] and output_format == "svg":
+            return {"accept-encoding": "gzip"}
+        return {"accept-encoding": "identity"}
+
+    def _local_servers(self):
+        """Returns the picoweb servers, they are launched once and kept between rebuilds"""
+        command = self.config["bin_path"].rsplit()
+        instances = max(1, self.config["local_server_instances"])
+        with self.local_servers_lock:
+            if (
+                self.local_servers is None
+                or (self.local_servers.command, self.local_servers.instances) != (command, instances)
+                or not self.local_servers.alive()
+            ):
+                if self.local_servers is not None:
+                    self.local_servers.close()
+                self.local_servers = LocalServerPool(command, instances)
+                self.local_servers.launch()
+            return self.local_servers
+
+    def _server_url(self, diagram):
+        if self.config["render"] == "local-server":
+            # Checked and launched by _prewarm, the render threads only pick a URL
+            servers = self.local_servers or self._local_servers()
+            server = servers.next_url()
+        else:
+            server = self.config["server"]
+        return (
+            server
             + "/"
-            + self.config["output_format"]
+            + self._output_format(diagram)
             + "/"
             + diagram.b64encoded
         )
 
+    def _call_server(self, diagram, out_file):
+        start = time.perf_counter()
         try:
-            response, content = http.request(url)
-            if response.status != 200:
+            response, content = self._http_pool().request(
+                self._server_url(diagram), self._request_headers(diagram)
+            )
+            failed = response.status != 200
+            self.build_stats.render(diagram, time.perf_counter() - start, failed)
+            if failed:
                 log.error(f"Wrong response status for {diagram.file}: {response.status}")
         except Exception as error:
+            self.build_stats.render(diagram, time.perf_counter() - start, failed=True)
             log.error(f"Server error while processing {diagram.file}: {error}")
             raise error
         else:
-            outDir = Path(diagram.out_dir)
-            outDir.mkdir(parents=True, exist_ok=True)
+            self._write_output(diagram, out_file, content, response.status == 200)
+            if response.status != 200:
+                self.failed_outputs.add(str(Path(diagram.out_dir) / out_file))
 
-            with (outDir / out_file).open("bw+") as out:
-                out.write(content)
+    def _call_pipe(self, diagram, out_file):
+        start = time.perf_counter()
+        try:
+            content = self._pipe_renderer(self._output_format(diagram)).render(diagram.concat_file)
+            if content is None:
+                log.warning(f"No @startuml ... @enduml block in {diagram.file}, nothing to render")
+                return
+            self.build_stats.render(diagram, time.perf_counter() - start)
+        except Exception as error:
+            self.build_stats.render(diagram, time.perf_counter() - start, failed=True)
+            log.error(f"PlantUML error while processing {diagram.file}: {error}")
+            raise error
+        else:
+            self._write_output(diagram, out_file, content, True)
+
+    def _write_output(self, diagram, out_file, content, cacheable=False):
+        target = Path(diagram.out_dir) / out_file
+        with self.build_stats.stage("write", diagram):
+            self._write_file(target, content)
+
+        # Error images are not worth keeping
+        if cacheable:
+            self.failed_outputs.discard(str(target))
+            self._store_cached(diagram, target)
+
+    def _write_file(self, target, content):
+        """Replaces target atomically, unless it already has this content.
+
+        content is bytes or an iterable of byte chunks, which is streamed to
+        disk. Returns False if the file was left alone.
+        """
+        if isinstance(content, (bytes, bytearray)):
+            if _same_content(target, content):
+                self._confirm_output(target)
+                return False
+            content = (content,)
+
+        self._make_dirs(target.parent)
+
+        # Next to the target, so os.replace doesn't have to cross file systems
+        tmp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with tmp.open("xb") as out:
+                for chunk in content:
+                    digest.update(chunk)
+                    size += out.write(chunk)
+            if _same_digest(target, digest, size):
+                tmp.unlink()
+                self._confirm_output(target)
+                return False
+            os.replace(tmp, target)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        self.stat_cache.invalidate(target)
+        self.confirmed_outputs.pop(str(target), None)
+        return True
+
+    def _make_dirs(self, directory):
+        """Creates every output folder only once per build"""
+        if directory not in self.made_dirs:
+            directory.mkdir(parents=True, exist_ok=True)
+            self.made_dirs.add(directory)
+
+    def _confirm_output(self, target):
+        """The image is current although its mtime is older than the source"""
+        if self.serve_server is None:
+            os.utime(target)
+            self.stat_cache.invalidate(target)
+        else:
+            # Touching it would make livereload reload the page for nothing
+            self.confirmed_outputs[str(target)] = (os.stat(target).st_mtime, time.time())
 
     def _file_matches_extension(self, file):
-        if len(self.config["input_extensions"]) == 0:
-            return True
-        extensions = self.config["input_extensions"].split(",")
-        for extension in extensions:
-            if file.endswith(extension):
-                return True
-        return False
+        return self._file_matcher().matches_extension(file)
+
+    def _file_matcher(self):
+        """The compiled input_extensions, include/exclude patterns and exclude_dirs"""
+        settings = (
+            self.config["input_extensions"],
+            tuple(self.config["include_patterns"]),
+            tuple(self.config["exclude_patterns"]),
+            tuple(self.config["exclude_dirs"]),
+        )
+        if self.file_matcher is None or self.file_matcher.settings != settings:
+            self.file_matcher = FileMatcher(*settings)
+        return self.file_matcher
+
+
+def _variant_slot(name, index, default):
+    """An attribute for one theme variant in a list with a value per variant"""
+
+    def get(self):
+        values = getattr(self, name)
+        return values[index] if index < len(values) else default
+
+    def set(self, value):
+        values = getattr(self, name)
+        values.extend([default] * (index + 1 - len(values)))
+        values[index] = value
+
+    return property(get, set)
 
 
 class PuElement:
     """plantuml helper object"""
 
+    # The light and the dark theme, as they were before there were more themes
+    out_file = _variant_slot("out_files", 0, "")
+    out_file_dark = _variant_slot("out_files", 1, "")
+    img_time = _variant_slot("img_times", 0, 0)
+    img_time_dark = _variant_slot("img_times", 1, 0)
+
     def __init__(self, file, subdir):
         self.file = file
         self.directory = subdir
         self.out_dir = ""
         self.root_dir = ""
-        self.img_time = 0
-        self.img_time_dark = 0
+        # One per theme variant, the light theme first
+        self.out_files = [""]
+        self.img_times = [0]
+        # The out_files and img_times of every output format
+        self.formats = {}
+        self.output_format = ""
         self.inc_time = 0
         self.src_time = 0
-        self.out_file = ""
-        self.out_file_dark = ""
         self.b64encoded = ""
         self.concat_file = ""
         self.src_file = ""
+        self.cache_key = ""
+        self.content_hash = ""
+        self.variant_hashes = {}
+        self.includes = {}
+        self.template = None
+
+
+ThemeVariant = namedtuple("ThemeVariant", "name theme suffix")
+
+
+class ThemeChoice:
+    """Part of an expanded diagram that differs between the theme variants"""
+
+    __slots__ = ("variants",)
+
+    def __init__(self, variants):
+        self.variants = variants
 
 
 class DiagramRoot:
@@ -459,3 +1400,1348 @@ class DiagramRoot:
     def __init__(self):
         self.root_dir = ""
         self.src_dir = ""
+
+
+class RootFinder:
+    """Searches a tree for the folders ending in diagram_root.
+
+    The folders are listed with os.scandir, excluded and git ignored folders
+    are not descended into. The result is kept together with the mtime of
+    every listed folder (and .gitignore file): as long as none of them
+    changed, no folder was added, removed or renamed and the search is skipped.
+    """
+
+    def __init__(self, top, diagram_root, exclude_dirs, respect_gitignore):
+        self.settings = (top, diagram_root, exclude_dirs, respect_gitignore)
+        self.top = top
+        self.diagram_root = diagram_root
+        self.name_suffix = diagram_root.rstrip("/").rsplit("/", 1)[-1]
+        self.excluded = re.compile("|".join(fnmatch.translate(p) for p in exclude_dirs) or "(?!)")
+        self.respect_gitignore = respect_gitignore
+        self.roots = None
+        self.mtimes = {}
+
+    def find(self):
+        if self.roots is None or not self._unchanged():
+            self.roots, self.mtimes = self._search()
+        return self.roots
+
+    def _unchanged(self):
+        for path, mtime in self.mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def _search(self):
+        roots = []
+        mtimes = {}
+        # Depth first in the order of os.walk, which found the roots before
+        stack = [(self.top, "", GitIgnore(), None)]
+        while stack:
+            directory, rel_dir, gitignore, mtime = stack.pop()
+            try:
+                mtimes[directory] = os.stat(directory).st_mtime_ns if mtime is None else mtime
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            if self.respect_gitignore:
+                gitignore = gitignore.extend(directory, rel_dir, mtimes)
+
+            children = []
+            for entry in entries:
+                try:
+                    if not entry.is_dir():
+                        continue
+                except OSError:
+                    continue
+                rel_path = f"{rel_dir}{entry.name}"
+                if self.excluded.match(entry.name) or self.excluded.match(rel_path):
+                    continue
+                if gitignore.ignored(rel_path):
+                    continue
+                path = f"{directory}/{entry.name}"
+                if entry.name.endswith(self.name_suffix) and path.endswith(self.diagram_root):
+                    roots.append(path)
+                if not entry.is_symlink():
+                    # The stat of the entry is free on Windows and costs the same as os.stat elsewhere
+                    try:
+                        mtime = entry.stat().st_mtime_ns
+                    except OSError:
+                        continue
+                    children.append((path, rel_path + "/", gitignore, mtime))
+            stack.extend(reversed(children))
+
+        log.debug(f"searched {len(mtimes)} folders for diagram roots, found {len(roots)}")
+        return roots, mtimes
+
+
+def _glob_regex(pattern):
+    """Translates a glob pattern to a regex, ** matches any number of folders, * stays in one"""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            members = pattern[i + 1:end].replace("\\", "\\\\")
+            if members.startswith("!"):
+                members = "^" + members[1:]
+            regex += "[" + members + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+class FileMatcher:
+    """Decides which files below a source folder are diagrams, and which folders to skip.
+
+    Paths are relative to the source folder and use "/". All patterns are
+    compiled into one regex each, so every file costs a single match.
+    """
+
+    def __init__(self, input_extensions, include_patterns, exclude_patterns, exclude_dirs):
+        self.settings = (input_extensions, include_patterns, exclude_patterns, exclude_dirs)
+        self.extensions = tuple(e for e in input_extensions.split(",") if e)
+        self.included = self._compile(include_patterns)
+        self.excluded = self._compile(exclude_patterns)
+        # A folder is skipped if it matches an exclude pattern without its trailing /**
+        self.excluded_dirs = self._compile(
+            p[:-3] if p.endswith("/**") else p for p in exclude_patterns
+        )
+        self.excluded_names = re.compile("|".join(fnmatch.translate(p) for p in exclude_dirs) or "(?!)")
+        # Below which folders an include pattern can match anything, None if anywhere
+        self.include_prefixes = None
+        if include_patterns:
+            prefixes = [self._literal_prefix(p) for p in include_patterns]
+            if "" not in prefixes:
+                self.include_prefixes = tuple(prefixes)
+
+    @staticmethod
+    def _compile(patterns):
+        regexes = [_glob_regex(p.lstrip("/")) for p in patterns]
+        if not regexes:
+            return None
+        return re.compile("(?:" + "|".join(regexes) + r")\Z")
+
+    @staticmethod
+    def _literal_prefix(pattern):
+        """The folders before the first wildcard, e.g. "docs/" for "docs/**/*.puml"""
+        parts = pattern.lstrip("/").split("/")[:-1]
+        prefix = ""
+        for part in parts:
+            if any(c in part for c in "*?["):
+                break
+            prefix += part + "/"
+        return prefix
+
+    def matches_extension(self, file):
+        return not self.extensions or file.endswith(self.extensions)
+
+    def matches(self, file, rel_path):
+        if not self.matches_extension(file):
+            return False
+        if self.included is not None and not self.included.match(rel_path):
+            return False
+        return self.excluded is None or not self.excluded.match(rel_path)
+
+    def prunes(self, name, rel_dir):
+        """True if nothing below the folder can be a diagram"""
+        if self.excluded_names.match(name):
+            return True
+        if self.excluded_dirs is not None and self.excluded_dirs.match(rel_dir):
+            return True
+        if self.include_prefixes is not None:
+            rel_dir += "/"
+            return not any(
+                rel_dir.startswith(prefix) or prefix.startswith(rel_dir) for prefix in self.include_prefixes
+            )
+        return False
+
+
+class GitIgnore:
+    """The .gitignore rules that apply to a folder, as far as they ignore folders"""
+
+    def __init__(self, rules=()):
+        self.rules = rules
+
+    def extend(self, directory, rel_dir, mtimes):
+        """Adds the rules of the .gitignore file in directory, if there is one"""
+        path = os.path.join(directory, ".gitignore")
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+            with open(path, "rt", encoding="utf-8", errors="replace") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return self
+        rules = list(self.rules)
+        for line in lines:
+            rule = self._parse(line, rel_dir)
+            if rule is not None:
+                rules.append(rule)
+        return GitIgnore(tuple(rules))
+
+    def ignored(self, rel_path):
+        """rel_path is a folder, relative to the top of the search"""
+        ignored = False
+        name = rel_path.rsplit("/", 1)[-1]
+        for pattern, negate, anchored in self.rules:
+            if pattern.match(rel_path if anchored else name):
+                ignored = not negate
+        return ignored
+
+    @staticmethod
+    def _parse(line, rel_dir):
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            return None
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        line = line.rstrip("/")
+        anchored = "/" in line
+        line = line.lstrip("/")
+        if not line:
+            return None
+
+        regex = _glob_regex(line)
+        if anchored:
+            # Patterns with a slash are relative to the folder of the .gitignore
+            regex = re.escape(rel_dir) + regex
+        return re.compile(regex + r"\Z"), negate, anchored
+
+
+class StatCache:
+    """Stats and resolves every path at most once per build.
+
+    Sources, outputs and includes don't change while a build runs, except for
+    the outputs it writes itself, these are forgotten with invalidate().
+    Outside of a build every lookup goes to the file system.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.stats = {}
+        self.resolved = {}
+        self.lookups = 0
+        self.calls = 0
+
+    def begin(self):
+        self.active = True
+        self.stats = {}
+        self.resolved = {}
+        self.lookups = 0
+        self.calls = 0
+
+    def end(self):
+        if self.lookups:
+            log.debug(
+                f"{self.lookups} stat/resolve lookups took {self.calls} system calls, "
+                f"{self.lookups - self.calls} saved"
+            )
+        self.active = False
+        self.stats = {}
+        self.resolved = {}
+
+    def stat(self, path):
+        """Like os.stat, a missing file raises FileNotFoundError on every lookup"""
+        path = os.fspath(path)
+        if not self.active:
+            return os.stat(path)
+        self.lookups += 1
+        try:
+            stat = self.stats[path]
+        except KeyError:
+            self.calls += 1
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            self.stats[path] = stat
+        if stat is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return stat
+
+    def mtime(self, path):
+        """None if the file is missing"""
+        try:
+            return self.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def exists(self, path):
+        return self.mtime(path) is not None
+
+    def resolve(self, path):
+        path = os.fspath(path)
+        if not self.active:
+            return str(Path(path).resolve())
+        self.lookups += 1
+        try:
+            return self.resolved[path]
+        except KeyError:
+            self.calls += 1
+            resolved = self.resolved[path] = str(Path(path).resolve())
+            return resolved
+
+    def invalidate(self, path):
+        self.stats.pop(os.fspath(path), None)
+
+
+class BuildStats:
+    """Times the stages of one build per diagram, and counts what happened to the diagrams.
+
+    Renders run on worker threads, so everything is recorded under a lock.
+    """
+
+    stages = ("discovery", "read", "start_tag", "expand", "encode", "render", "write")
+    slowest = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.total = 0
+        self.stage_times = dict.fromkeys(self.stages, 0.0)
+        self.counts = dict.fromkeys(("diagrams", "cache_hits", "deduplicated"), 0)
+        # Per source file: the seconds of every stage
+        self.diagrams = {}
+        # Seconds of every render (HTTP request or PlantUML run)
+        self.latencies = []
+        self.rendered = set()
+        self.failed = set()
+        self.handled = set()
+
+    @staticmethod
+    def _key(diagram):
+        return str(Path(diagram.directory) / diagram.file)
+
+    @contextlib.contextmanager
+    def stage(self, name, diagram=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, diagram)
+
+    def timed(self, name, iterable):
+        """Yields the items of iterable, the time spent producing them counts for the stage"""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def add(self, name, seconds, diagram=None):
+        with self.lock:
+            self.stage_times[name] += seconds
+            if diagram is not None:
+                stages = self.diagrams.setdefault(self._key(diagram), {})
+                stages[name] = stages.get(name, 0.0) + seconds
+
+    def count(self, name, diagram=None):
+        with self.lock:
+            self.counts[name] += 1
+            if diagram is not None:
+                self.handled.add(self._key(diagram))
+
+    def render(self, diagram, seconds, failed=False):
+        self.add("render", seconds, diagram)
+        with self.lock:
+            self.latencies.append(seconds)
+            key = self._key(diagram)
+            (self.failed if failed else self.rendered).add(key)
+            self.handled.add(key)
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        return self.total
+
+    def latency(self):
+        """p50, p95 and max of the render times (nearest rank)"""
+        values = sorted(self.latencies)
+        if not values:
+            return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+
+        def rank(q):
+            return values[max(0, math.ceil(q * len(values)) - 1)]
+
+        return {"p50": rank(0.5), "p95": rank(0.95), "max": values[-1]}
+
+    def report(self):
+        totals = {key: sum(stages.values()) for key, stages in self.diagrams.items()}
+        slowest = sorted(totals, key=totals.get, reverse=True)[: self.slowest]
+        return {
+            "total_seconds": self.total,
+            "counts": {
+                "diagrams": self.counts["diagrams"],
+                "rendered": len(self.rendered),
+                "skipped": self.counts["diagrams"] - len(self.handled),
+                "failed": len(self.failed),
+                "renders": len(self.latencies),
+                "cache_hits": self.counts["cache_hits"],
+                "deduplicated": self.counts["deduplicated"],
+            },
+            "stages": self.stage_times,
+            "render_latency": self.latency(),
+            "slowest": [
+                {"diagram": key, "seconds": totals[key], "stages": self.diagrams[key]} for key in slowest
+            ],
+            "diagrams": {
+                key: {"seconds": totals[key], "stages": stages} for key, stages in self.diagrams.items()
+            },
+        }
+
+    def log_summary(self):
+        report = self.report()
+        counts = report["counts"]
+        summary = (
+            f"PlantUML: {counts['diagrams']} diagrams, {counts['rendered']} rendered, "
+            f"{counts['skipped']} skipped, {counts['failed']} failed, "
+            f"{counts['cache_hits']} cache hits, {counts['deduplicated']} deduplicated "
+            f"in {self.total:.2f}s"
+        )
+        if not self.latencies:
+            # Nothing was rendered, e.g. a `mkdocs serve` rebuild for a markdown change
+            log.debug(summary)
+            return
+        log.info(summary)
+        log.info(
+            "PlantUML stages: "
+            + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stage_times.items())
+        )
+        latency = report["render_latency"]
+        log.info(
+            f"PlantUML render latency: p50 {latency['p50']:.2f}s, "
+            f"p95 {latency['p95']:.2f}s, max {latency['max']:.2f}s"
+        )
+        log.info(
+            "Slowest diagrams: "
+            + ", ".join(f"{entry['diagram']} {entry['seconds']:.2f}s" for entry in report["slowest"])
+        )
+
+
+class BuildProfiler:
+    """Profiles builds of the plugin, each one into its own set of files in directory.
+
+    Writes cProfile stats (.pstats) and a tracemalloc snapshot (.tracemalloc)
+    per build. With samples, the wall-clock time of every call of the sampled
+    methods is written as JSON lines, the render threads included.
+    """
+
+    sampled = ("_readFile", "_expand_incl_line_file", "_call_server", "_call_pipe")
+    # render: local runs PlantUML from the batch, which only exists during the build
+    sampled_batch = ("_render",)
+
+    def __init__(self, directory, samples):
+        self.directory = directory
+        self.samples = samples
+        self.settings = (directory, samples)
+        self.builds = 0
+        self.lock = threading.Lock()
+        self.records = []
+        self.start = 0
+
+    def run(self, plugin, build, *args):
+        self.builds += 1
+        stem = self.directory / f"build-{time.strftime('%Y%m%d-%H%M%S')}-{self.builds}"
+        self.records = []
+        self.start = time.perf_counter()
+
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        originals = None
+        if self.samples:
+            originals = [
+                (plugin, self._wrap(plugin, self.sampled)),
+                (LocalBatch, self._wrap(LocalBatch, self.sampled_batch)),
+            ]
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active already, e.g. mkdocs itself runs under cProfile
+            log.warning("Could not profile the build, another profiler is active")
+            profile = None
+
+        try:
+            return build(*args)
+        finally:
+            if profile is not None:
+                profile.disable()
+            if originals is not None:
+                for target, methods in originals:
+                    self._unwrap(target, methods)
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if not tracing:
+                tracemalloc.stop()
+            self._save(stem, profile, snapshot)
+            log.info(
+                f"Profile of the build written to {stem}.*, "
+                f"peak memory {peak / (1024 * 1024):.1f} MB"
+            )
+
+    def _save(self, stem, profile, snapshot):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if profile is not None:
+            profile.dump_stats(f"{stem}.pstats")
+        snapshot.dump(f"{stem}.tracemalloc")
+        if self.samples:
+            with open(f"{stem}.samples.jsonl", "w", encoding="utf-8") as f:
+                for record in self.records:
+                    f.write(json.dumps(record) + "\n")
+
+    def _wrap(self, target, names):
+        """Shadows the methods on target (an instance or a class), returns what was there before"""
+        originals = {name: target.__dict__.get(name) for name in names}
+        for name in names:
+            method = getattr(target, name)
+            if inspect.isgeneratorfunction(method):
+                setattr(target, name, self._generator_sampler(name, method))
+            else:
+                setattr(target, name, self._sampler(name, method))
+        return originals
+
+    def _unwrap(self, target, originals):
+        for name, original in originals.items():
+            if original is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+
+    def _sampler(self, name, method):
+        @functools.wraps(method)
+        def sampled(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._record(name, args, start)
+        return sampled
+
+    def _generator_sampler(self, name, method):
+        # Calling a generator does nothing yet, the time is taken until it is exhausted
+        @functools.wraps(method)
+        def sampled(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                yield from method(*args, **kwargs)
+            finally:
+                self._record(name, args, start)
+        return sampled
+
+    def _record(self, name, args, start):
+        diagrams = [arg for arg in args if isinstance(arg, PuElement)]
+        if not diagrams:
+            # A PlantUML run of render: local gets the list of its diagrams first
+            diagrams = next((arg for arg in args if isinstance(arg, list)), [])
+        files = [str(Path(d.directory) / d.file) for d in diagrams]
+        record = {
+            "function": name,
+            "diagram": files[0] if len(files) == 1 else None,
+            "thread": threading.current_thread().name,
+            "start": start - self.start,
+            "seconds": time.perf_counter() - start,
+        }
+        if len(files) > 1:
+            record["diagrams"] = files
+        with self.lock:
+            self.records.append(record)
+
+
+def _replace_file(target, content):
+    """Replaces target with a new file holding content"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        tmp.write_bytes(content)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _write_changed(target, content):
+    """Replaces target unless it holds content already, an unchanged file keeps its mtime"""
+    if not _same_content(target, content):
+        _replace_file(target, content)
+
+
+def _same_content(path, content):
+    """True if the file at path holds exactly content"""
+    try:
+        if os.stat(path).st_size != len(content):
+            return False
+        with open(path, "rb") as f:
+            return f.read() == content
+    except OSError:
+        return False
+
+
+def _same_digest(path, digest, size):
+    """True if the file at path has the given size and sha256"""
+    try:
+        if os.stat(path).st_size != size:
+            return False
+        existing = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                existing.update(chunk)
+    except OSError:
+        return False
+    return existing.digest() == digest.digest()
+
+
+def _stat(stats, path):
+    """Through the stat cache of the build, if there is one"""
+    return os.stat(path) if stats is None else stats.stat(path)
+
+
+class IncludeCache:
+    """Expanded include files, so shared includes are only read once per build.
+
+    An entry stays valid as long as neither the file nor any of its nested
+    includes has changed. That is checked once per build, which lets the
+    cache survive `mkdocs serve` rebuilds.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.generation = 0
+        self.stats = None
+
+    def begin(self, stats=None):
+        self.generation += 1
+        self.stats = stats
+
+    def lookup(self, key):
+        """Returns (text, includes) or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] != self.generation:
+            for include, mtime in entry[1].items():
+                try:
+                    if _stat(self.stats, include).st_mtime != mtime:
+                        break
+                except OSError:
+                    break
+            else:
+                entry[2] = self.generation
+                return entry[0], entry[1]
+            del self.entries[key]
+            return None
+        return entry[0], entry[1]
+
+    def store(self, key, text, includes):
+        self.entries[key] = [text, dict(includes), self.generation]
+        return text, includes
+
+
+class DependencyGraph:
+    """Which include files every diagram depends on (transitively) and the reverse."""
+
+    def __init__(self):
+        self.includes = {}
+        self.dependents = {}
+        self.visited = set()
+
+    def begin(self):
+        self.visited = set()
+
+    def visit(self, src_file):
+        self.visited.add(src_file)
+
+    def update(self, src_file, includes):
+        self.remove(src_file)
+        self.includes[src_file] = set(includes)
+        for include in includes:
+            self.dependents.setdefault(include, set()).add(src_file)
+        self.visit(src_file)
+
+    def remove(self, src_file):
+        for include in self.includes.pop(src_file, ()):
+            dependents = self.dependents[include]
+            dependents.discard(src_file)
+            if not dependents:
+                del self.dependents[include]
+
+    def prune(self):
+        """Forgets the diagrams that were not seen in this build"""
+        for src_file in list(self.includes):
+            if src_file not in self.visited:
+                self.remove(src_file)
+
+    def dependents_of(self, includes):
+        result = set()
+        for include in includes:
+            result |= self.dependents.get(include, set())
+        return result
+
+    def dump(self, path):
+        """Writes the graph as JSON, or as Graphviz DOT if the file ends with .dot"""
+        path = Path(path)
+        if path.suffix == ".dot":
+            lines = ["digraph plantuml_includes {"]
+            for src_file in sorted(self.includes):
+                lines.append(f"  {json.dumps(src_file)};")
+                for include in sorted(self.includes[src_file]):
+                    lines.append(f"  {json.dumps(src_file)} -> {json.dumps(include)};")
+            lines.append("}")
+            content = "\n".join(lines) + "\n"
+        else:
+            data = {
+                "diagrams": {k: sorted(v) for k, v in sorted(self.includes.items())},
+                "includes": {k: sorted(v) for k, v in sorted(self.dependents.items())},
+            }
+            content = json.dumps(data, indent=1)
+        _write_changed(path, content.encode("utf-8"))
+
+
+class BuildManifest:
+    """Remembers the state of every diagram after the last successful build.
+
+    A diagram whose source, includes and outputs are unchanged since then
+    can be skipped with a few stat calls, without reading or parsing it.
+    """
+
+    version = 1
+
+    def __init__(self, path, fingerprint):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.seen = {}
+        self.dirty = set()
+        self.stats = None
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") == self.version and data.get("fingerprint") == fingerprint:
+            self.entries = data.get("diagrams", {})
+
+    def begin(self, dependency_graph, stats=None):
+        """Stats every include once and marks the diagrams depending on changed ones"""
+        self.seen = {}
+        self.dirty = set()
+        self.stats = stats
+        changed = 0
+        for include, dependents in dependency_graph.dependents.items():
+            try:
+                mtime = _stat(self.stats, include).st_mtime
+            except OSError:
+                mtime = None
+            stale = {
+                src_file for src_file in dependents
+                if src_file in self.entries and self.entries[src_file]["includes"].get(include) != mtime
+            }
+            if stale:
+                changed += 1
+                self.dirty |= stale
+        if changed:
+            log.debug(f"{changed} includes changed, {len(self.dirty)} diagrams depend on them")
+
+    def is_fresh(self, src_file):
+        entry = self.entries.get(src_file)
+        if entry is None or src_file in self.dirty:
+            return False
+        try:
+            stat = _stat(self.stats, src_file)
+            if [stat.st_mtime, stat.st_size] != entry["src"]:
+                return False
+            for out_file in entry["outputs"]:
+                _stat(self.stats, out_file)
+        except OSError:
+            return False
+        self.seen[src_file] = entry
+        return True
+
+    def record(self, diagram, theme_enabled):
+        src_file = Path(diagram.directory) / diagram.file
+        stat = _stat(self.stats, src_file)
+        outputs = [
+            out_file
+            for out_files, _ in (diagram.formats.values() or [(diagram.out_files, None)])
+            for out_file in (out_files if theme_enabled else out_files[:1])
+        ]
+        self.seen[str(src_file)] = {
+            "src": [stat.st_mtime, stat.st_size],
+            "includes": dict(diagram.includes),
+            "outputs": outputs,
+            # Diagrams skipped before expanding keep the hash of their last expansion
+            "hash": diagram.content_hash or self.entries.get(str(src_file), {}).get("hash", ""),
+        }
+
+    def keep(self, src_file):
+        """Carries the entry of a diagram over that was not looked at in this build"""
+        if src_file in self.entries:
+            self.seen[src_file] = self.entries[src_file]
+
+    def forget(self, src_file):
+        """Drops a diagram from this build, e.g. because it failed to render"""
+        self.seen.pop(src_file, None)
+
+    def save(self):
+        """Writes the diagrams seen in this build, deleted sources are dropped"""
+        self.entries = self.seen
+        data = {"version": self.version, "fingerprint": self.fingerprint, "diagrams": self.entries}
+        _write_changed(self.path, json.dumps(data, indent=1).encode("utf-8"))
+
+
+class ChangeWatcher:
+    """Collects the files changed between two `mkdocs serve` rebuilds.
+
+    A folder created, deleted or moved below a source folder can change the
+    set of diagrams, the next build then walks all of them again.
+    """
+
+    event_types = ("created", "modified", "deleted", "moved", "closed")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.rescan = False
+        self.source_dirs = []
+        self.observer = PollingObserver(timeout=0.5)
+        self.observer.daemon = True
+        self.observer.start()
+
+    def watch(self, directory, sources):
+        if sources:
+            self.source_dirs.append(directory)
+        self.observer.schedule(self, directory, recursive=sources)
+
+    def dispatch(self, event):
+        """Called by the observer thread for every event"""
+        if event.event_type not in self.event_types:
+            return
+        paths = [event.src_path, getattr(event, "dest_path", "")]
+        paths = [os.fsdecode(path) for path in paths if path]
+        with self.lock:
+            if not event.is_directory:
+                self.changed.update(paths)
+            elif event.event_type != "modified" and any(
+                path.startswith(src_dir + os.sep) for path in paths for src_dir in self.source_dirs
+            ):
+                self.rescan = True
+
+    def take(self):
+        """Returns the changed files and whether to walk again, and starts collecting anew"""
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            rescan, self.rescan = self.rescan, False
+        return changed, rescan
+
+    def close(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+class RenderCache:
+    """On-disk store of rendered images, addressed by a hash of their input.
+
+    Entries are plain files, the least recently used ones are evicted once
+    the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return self.directory / key[:2] / key
+
+    def restore(self, key, out_file, write_file=None):
+        """Writes the cached image to out_file, returns False on a miss.
+
+        write_file(target, content) puts it in place, by default the target is
+        replaced, never written into, as it may be a hardlink to other images.
+        """
+        entry = self._entry(key)
+        try:
+            # Touching the entry marks it as recently used
+            os.utime(entry)
+            content = entry.read_bytes()
+        except FileNotFoundError:
+            return False
+        (write_file or _replace_file)(Path(out_file), content)
+        return True
+
+    def store(self, key, out_file):
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so concurrent readers never see half an entry
+        fd, tmp = tempfile.mkstemp(dir=entry.parent)
+        os.close(fd)
+        try:
+            shutil.copyfile(out_file, tmp)
+            os.replace(tmp, entry)
+        except Exception as error:
+            log.warning(f"Could not store {out_file} in render cache: {error}")
+            Path(tmp).unlink(missing_ok=True)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits max_size"""
+        entries = []
+        total = 0
+        for subdir, _, files in os.walk(self.directory):
+            for file in files:
+                stat = (Path(subdir) / file).stat()
+                entries.append((stat.st_mtime, stat.st_size, Path(subdir) / file))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+
+class LocalBatch:
+    """Stale diagrams of a build, rendered with one PlantUML run per output directory"""
+
+    # Stays well below the 32767 characters Windows allows for a command line
+    max_command_length = 30000
+
+    def __init__(self, command, output_format):
+        self.command = command
+        self.output_format = output_format
+        self.diagrams = {}
+
+    def add(self, diagram):
+        # -o and -t apply to all files of a run, so runs are grouped by output directory and format
+        key = (diagram.out_dir, diagram.output_format or self.output_format)
+        self.diagrams.setdefault(key, []).append(copy.copy(diagram))
+
+    def run(self):
+        """Renders all collected diagrams, returns the rendered and the failed ones"""
+        rendered, failed = [], []
+        for (out_dir, output_format), diagrams in self.diagrams.items():
+            for chunk in self._chunks(diagrams, out_dir):
+                self._render(chunk, out_dir, output_format, rendered, failed)
+        self.diagrams = {}
+        return rendered, failed
+
+    def _chunks(self, diagrams, out_dir):
+        length = sum(len(part) + 1 for part in self.command) + len(out_dir) + 40
+        chunk, chunk_length = [], length
+        for diagram in diagrams:
+            file_length = len(str(Path(diagram.directory) / diagram.file)) + 1
+            if chunk and chunk_length + file_length > self.max_command_length:
+                yield chunk
+                chunk, chunk_length = [], length
+            chunk.append(diagram)
+            chunk_length += file_length
+        if chunk:
+            yield chunk
+
+    def _render(self, diagrams, out_dir, output_format, rendered, failed):
+        returncode = call(
+            [
+                *self.command,
+                "-t" + output_format,
+                "-nbthread",
+                "auto",
+                *[str(Path(diagram.directory) / diagram.file) for diagram in diagrams],
+                "-o",
+                out_dir,
+            ]
+        )
+        if returncode == 0:
+            for diagram in diagrams:
+                (rendered if self._written(diagram) else failed).append(diagram)
+        elif len(diagrams) == 1:
+            failed.append(diagrams[0])
+        else:
+            # PlantUML only reports that something failed, halve the run to find out what
+            middle = len(diagrams) // 2
+            self._render(diagrams[:middle], out_dir, output_format, rendered, failed)
+            self._render(diagrams[middle:], out_dir, output_format, rendered, failed)
+
+    @staticmethod
+    def _written(diagram):
+        try:
+            return Path(diagram.out_file).stat().st_mtime != diagram.img_time
+        except OSError:
+            return False
+
+
+class PipeRenderer:
+    """A PlantUML process in -pipe mode, fed one diagram after the other"""
+
+    # Written by PlantUML after every image, so the images can be told apart on stdout
+    delimiter = b"___MKDOCS_BUILD_PLANTUML_END___"
+
+    def __init__(self, command, output_format, timeout=60):
+        self.command = command
+        self.output_format = output_format
+        self.timeout = timeout
+        self.process = None
+        self.output = None
+        self.buffer = b""
+        self.lock = threading.Lock()
+
+    def render(self, source):
+        """Returns the image of the first diagram in source, None if there is none"""
+        source = self._first_block(source)
+        if source is None:
+            # PlantUML would wait for a diagram that never comes
+            return None
+        with self.lock:
+            try:
+                return self._render(source)
+            except (BrokenPipeError, EOFError):
+                # The JVM is gone (crashed or killed), a new one gets another try
+                log.warning("PlantUML process exited, restarting it")
+                self._stop()
+                try:
+                    return self._render(source)
+                except (BrokenPipeError, EOFError):
+                    self._stop()
+                    raise Exception("PlantUML process exited while rendering")
+
+    def close(self):
+        with self.lock:
+            self._stop()
+
+    def _start(self):
+        self.process = Popen(
+            [
+                *self.command,
+                "-pipe",
+                "-t" + self.output_format,
+                "-charset",
+                "UTF-8",
+                "-pipedelimitor",
+                self.delimiter.decode(),
+            ],
+            stdin=PIPE,
+            stdout=PIPE,
+        )
+        # Read on a thread, so waiting for an answer can time out on every platform
+        self.output = queue.Queue()
+        threading.Thread(
+            target=self._read, args=(self.process.stdout, self.output), daemon=True
+        ).start()
+        self.buffer = b""
+
+    @staticmethod
+    def _read(stdout, output):
+        try:
+            while True:
+                chunk = stdout.read1(65536)
+                output.put(chunk)
+                if not chunk:
+                    break
+        except (OSError, ValueError):
+            output.put(b"")
+        finally:
+            stdout.close()
+
+    def _stop(self, kill=False):
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        if kill:
+            process.kill()
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=5)
+        except Exception:
+            process.kill()
+            process.wait()
+
+    @staticmethod
+    def _first_block(source):
+        """The first @startuml ... @enduml block, -pipe answers every block with an image"""
+        lines = source.splitlines(True)
+        start = next((i for i, line in enumerate(lines) if line.strip().startswith("@startuml")), None)
+        if start is None:
+            return None
+        for end in range(start, len(lines)):
+            if lines[end].strip().startswith("@enduml"):
+                return "".join(lines[start : end + 1])
+        return None
+
+    def _discard_output(self):
+        """Drops what is left of an earlier answer, only the next image is wanted"""
+        self.buffer = b""
+        while True:
+            try:
+                chunk = self.output.get_nowait()
+            except queue.Empty:
+                return
+            if not chunk:
+                # The end of the output, _render will see it
+                self.output.put(chunk)
+                return
+
+    def _render(self, source):
+        if self.process is None or self.process.poll() is not None:
+            self._stop()
+            self._start()
+        self._discard_output()
+
+        data = source.encode("utf-8")
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+        deadline = time.monotonic() + self.timeout
+        while self.delimiter not in self.buffer:
+            try:
+                chunk = self.output.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                # Stuck on this diagram, the next one gets a new process
+                self._stop(kill=True)
+                raise TimeoutError(f"PlantUML did not answer within {self.timeout} seconds")
+            if not chunk:
+                raise EOFError()
+            self.buffer += chunk
+
+        image, self.buffer = self.buffer.split(self.delimiter, 1)
+        # Drops the line break PlantUML writes after the previous delimiter
+        return image.lstrip(b"\r\n")
+
+
+class LocalServerPool:
+    """PlantUML picoweb servers running as child processes, used round-robin"""
+
+    def __init__(self, command, instances, start_timeout=60):
+        self.command = command
+        self.instances = instances
+        self.start_timeout = start_timeout
+        self.processes = []
+        self.urls = []
+        self.turn = itertools.count()
+        self.deadline = 0
+        self.ready = False
+        self.error = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts all servers and waits until every one of them answers"""
+        self.launch()
+        self.wait_ready()
+
+    def launch(self):
+        """Starts all servers without waiting for them"""
+        for _ in range(self.instances):
+            port = self._free_port()
+            self.processes.append(
+                Popen([*self.command, f"-picoweb:{port}:127.0.0.1"], stdout=DEVNULL)
+            )
+            self.urls.append(f"http://127.0.0.1:{port}/plantuml")
+        self.deadline = time.monotonic() + self.start_timeout
+
+    def wait_ready(self):
+        """Waits until every server answers, only the first caller actually waits"""
+        with self.lock:
+            if self.ready:
+                return
+            if self.error is not None:
+                raise self.error
+            try:
+                for process, url in zip(self.processes, self.urls):
+                    self._wait_until_healthy(process, url, self.deadline)
+            except Exception as error:
+                self.error = error
+                self.close()
+                raise
+            self.ready = True
+        log.debug(f"Started {self.instances} local PlantUML server(s): {', '.join(self.urls)}")
+
+    def next_url(self):
+        if not self.ready:
+            self.wait_ready()
+        # next() on itertools.count is atomic, so this is safe for the render threads
+        return self.urls[next(self.turn) % len(self.urls)]
+
+    def alive(self):
+        return bool(self.processes) and all(process.poll() is None for process in self.processes)
+
+    def close(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except Exception:
+                process.kill()
+                process.wait()
+        self.processes = []
+        self.urls = []
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    @staticmethod
+    def _wait_until_healthy(process, url, deadline):
+        http = httplib2.Http(timeout=1)
+        while True:
+            if process.poll() is not None:
+                raise Exception(f"Local PlantUML server exited with code {process.returncode}")
+            try:
+                # Any answer means the server is up, the status of an empty request doesn't matter
+                http.request(url + "/txt/", "HEAD")
+                return
+            except (OSError, httplib2.HttpLib2Error):
+                if time.monotonic() > deadline:
+                    raise Exception(f"Local PlantUML server at {url} did not start in time")
+                time.sleep(0.1)
+
+
+class HttpClientPool:
+    """Keep-alive HTTP clients shared by all requests of a build.
+
+    httplib2.Http keeps its connections open between requests but is not
+    thread safe, so every worker borrows its own client from the queue.
+    """
+
+    def __init__(self, size, disable_ssl=False, timeout=None):
+        self.size = size
+        self.disable_ssl = disable_ssl
+        self.timeout = timeout
+        self.clients = []
+        self.idle = queue.Queue()
+        self.warmed = False
+        for _ in range(size):
+            http = httplib2.Http({}, timeout=timeout)
+            if disable_ssl:
+                http.disable_ssl_certificate_validation = True
+            self.clients.append(http)
+            self.idle.put(http)
+
+    def request(self, url, headers=None, method="GET"):
+        http = self.idle.get()
+        try:
+            return http.request(url, method, headers=headers)
+        finally:
+            self.idle.put(http)
+
+    def warm(self, url):
+        """Connect every idle client in the background, once per pool, errors are ignored.
+
+        The connections are kept open, later calls (e.g. `mkdocs serve` rebuilds) do nothing.
+        """
+        if self.warmed:
+            return
+        self.warmed = True
+
+        def _connect():
+            # Only a client nobody is using right now
+            try:
+                http = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                http.request(url, "HEAD")
+            except Exception as error:
+                log.debug(f"Could not prewarm connection to {url}: {error}")
+            finally:
+                self.idle.put(http)
+
+        for _ in range(self.size):
+            threading.Thread(target=_connect, daemon=True).start()
+
+    def close(self):
+        for http in self.clients:
+            http.close()
+
+
+class RenderPool(logging.Filter):
+    """Runs render jobs on worker threads.
+
+    Log records emitted by a job are held back and replayed in submission
+    order by join(), so the build log reads the same as a sequential run.
+    """
+
+    def __init__(self, workers):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = []
+        log.addFilter(self)
+
+    def filter(self, record):
+        records = _job_records.get()
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+    def submit(self, func, diagram, out_file):
+        future = self.executor.submit(self._run, func, diagram, out_file)
+        self.jobs.append((diagram, out_file, future))
+
+    def _run(self, func, diagram, out_file):
+        records = []
+        token = _job_records.set(records)
+        try:
+            func(diagram, out_file)
+        except Exception as error:
+            return records, error
+        finally:
+            _job_records.reset(token)
+        return records, None
+
+    def join(self):
+        """Wait for all jobs, replay their logs and raise on the first failure"""
+        try:
+            results = [future.result() for _, _, future in self.jobs]
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            log.removeFilter(self)
+        self._report(results)
+
+    def _report(self, results):
+        failures = []
+        for (diagram, out_file, _), (records, error) in zip(self.jobs, results):
+            for record in records:
+                log.handle(record)
+            if error is not None:
+                failures.append((str(Path(diagram.directory) / diagram.file), out_file, error))
+
+        if failures:
+            failures.sort(key=lambda failure: failure[0])
+            log.error(f"{len(failures)} of {len(self.jobs)} diagrams failed to render:")
+            for src_file, out_file, error in failures:
+                log.error(f"  {src_file} -> {out_file}: {error}")
+            raise failures[0][2]
@@ -30,7 +30,24 @@ def plugin():
         "theme_folder": "include/themes/",
         "theme_light": "light.puml",
         "theme_dark": "dark.puml",
+        "theme_variants": [],
+        "diagram_roots": [],
+        "respect_gitignore": False,
         "exclude_dirs": [".git"],
+        "include_patterns": [],
+        "exclude_patterns": [],
+        "workers": 1,
+        "prewarm_connections": False,
+        "gzip_svg": True,
+        "cache_dir": "",
+        "cache_max_size": 256,
+        "manifest_file": "",
+        "dependency_graph_file": "",
+        "local_server_instances": 1,
+        "render_timeout": 60,
+        "timing_report_file": "",
+        "profile_dir": "",
+        "profile_samples": False,
     }
     return p
 
@@ -49,6 +66,31 @@ def plugin_svg_format(plugin):
     return plugin
 
 
+@pytest.fixture
+def diagram_tree(plugin, tmp_path, monkeypatch):
+    """Create a diagram root "diagrams" in the working directory and point the plugin at it.
+
+    src/a.puml includes include/style.puml, src/b.puml has no includes.
+    """
+    root = tmp_path / "diagrams"
+    (root / "src").mkdir(parents=True)
+    (root / "include").mkdir()
+    (root / "include" / "style.puml").write_text("skinparam Padding 4\n")
+    (root / "src" / "a.puml").write_text("@startuml\n!include ../include/style.puml\nactor A\n@enduml\n")
+    (root / "src" / "b.puml").write_text("@startuml\nactor B\n@enduml\n")
+    plugin.config["diagram_root"] = "diagrams"
+    monkeypatch.chdir(tmp_path)
+    return root
+
+
+@pytest.fixture
+def fake_render(plugin):
+    """Return a stand-in for _call_server that writes b"image of <encoded source>" to the output file."""
+    def render(diagram, out_file):
+        plugin._write_output(diagram, out_file, b"image of " + diagram.b64encoded.encode(), True)
+    return render
+
+
 @pytest.fixture
 def example_root():
     """Return Path to example/docs/diagrams."""
@@ -0,0 +1,104 @@
+"""Tests for the stage timings and the summary of a build."""
+import json
+import logging
+import os
+import pytest
+from unittest.mock import MagicMock, patch
+
+from mkdocs_build_plantuml_plugin.plantuml import BuildStats, PuElement
+
+
+@pytest.fixture
+def project(diagram_tree):
+    """The working directory, with a third diagram failing on the server."""
+    (diagram_tree / "src" / "broken.puml").write_text("@startuml\nactor\n@enduml\n")
+    return diagram_tree.parent
+
+
+@pytest.fixture
+def timed_plugin(plugin, project):
+    plugin.config["timing_report_file"] = "timings.json"
+    return plugin
+
+
+def _build(plugin, project):
+    """Builds with a server that rejects broken.puml and returns the timing report"""
+    def request(url, method, headers=None):
+        status = 400 if url.endswith(broken.b64encoded) else 200
+        return MagicMock(status=status), b"image"
+
+    broken = PuElement("broken.puml", str(project / "diagrams" / "src"))
+    broken.src_file = (project / "diagrams" / "src" / "broken.puml").read_text().splitlines(True)
+    plugin._readFile(broken, 0)
+
+    with patch("httplib2.Http") as mock_http_class:
+        mock_http_class.return_value.request.side_effect = request
+        plugin.on_pre_build({})
+    return json.loads((project / "timings.json").read_text())
+
+
+class TestBuildTimings:
+    """Tests for the timing report of on_pre_build."""
+
+    def test_counts(self, timed_plugin, project):
+        """Rendered, failed and skipped diagrams should be counted."""
+        report = _build(timed_plugin, project)
+        assert report["counts"]["diagrams"] == 3
+        assert report["counts"]["rendered"] == 2
+        assert report["counts"]["failed"] == 1
+        assert report["counts"]["skipped"] == 0
+        assert report["counts"]["renders"] == 3
+
+    def test_rebuild_skips(self, timed_plugin, project):
+        """A second build should only render the diagram that failed."""
+        _build(timed_plugin, project)
+        report = _build(timed_plugin, project)
+        assert report["counts"]["skipped"] == 2
+        assert report["counts"]["renders"] == 1
+
+    def test_report_kept_when_nothing_rendered(self, timed_plugin, project):
+        """A build that only skipped diagrams should not rewrite the report."""
+        with patch("httplib2.Http") as mock_http_class:
+            mock_http_class.return_value.request.return_value = (MagicMock(status=200), b"image")
+            timed_plugin.on_pre_build({})
+        os.utime(project / "timings.json", (1000, 1000))
+
+        timed_plugin.on_pre_build({})
+        assert (project / "timings.json").stat().st_mtime == 1000
+
+    def test_stages_per_diagram(self, timed_plugin, project):
+        """Each diagram should have its stages timed, the walk is timed for the build."""
+        report = _build(timed_plugin, project)
+        stages = report["diagrams"][str(project / "diagrams" / "src" / "a.puml")]["stages"]
+        assert {"read", "start_tag", "expand", "encode", "render", "write"} <= set(stages)
+        assert report["stages"]["discovery"] > 0
+        assert len(report["slowest"]) == 3
+        assert report["slowest"][0]["seconds"] >= report["slowest"][-1]["seconds"]
+
+    def test_summary_logged(self, timed_plugin, project, caplog):
+        """The counts and the latency should be logged at the end of the build."""
+        with caplog.at_level(logging.INFO):
+            _build(timed_plugin, project)
+        messages = [record.getMessage() for record in caplog.records]
+        assert any("3 diagrams, 2 rendered, 0 skipped, 1 failed" in m for m in messages)
+        assert any(m.startswith("PlantUML render latency: p50") for m in messages)
+        assert timed_plugin.total_time > 0
+
+
+class TestBuildStats:
+    """Tests for BuildStats on its own."""
+
+    def test_latency_percentiles(self):
+        stats = BuildStats()
+        diagram = PuElement("a.puml", "src")
+        for seconds in range(1, 101):
+            stats.render(diagram, seconds / 100)
+        assert stats.latency() == {"p50": 0.5, "p95": 0.95, "max": 1.0}
+
+    def test_no_renders(self):
+        assert BuildStats().latency() == {"p50": 0.0, "p95": 0.0, "max": 0.0}
+
+    def test_timed_iterable(self):
+        stats = BuildStats()
+        assert list(stats.timed("discovery", iter([1, 2]))) == [1, 2]
+        assert stats.stage_times["discovery"] > 0
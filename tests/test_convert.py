@@ -56,8 +56,8 @@ class TestConvert:
             plugin._convert(diagram, False)
             mock_server.assert_called_once()
 
-    def test_dark_mode_only_server(self, plugin, tmp_path):
-        """Dark mode with local render should skip."""
+    def test_dark_mode_local_uses_pipe(self, plugin, tmp_path):
+        """Dark mode with local render should pipe the dark source to PlantUML."""
         plugin.config["render"] = "local"
 
         diagram = PuElement("test.puml", str(tmp_path))
@@ -70,8 +70,10 @@ class TestConvert:
         diagram.inc_time = 0
 
         with patch.object(plugin, '_call_server') as mock_server:
-            plugin._convert(diagram, True)  # dark_mode=True
-            # Should not call server because render=local and dark_mode
+            with patch.object(plugin, '_call_pipe') as mock_pipe:
+                plugin._convert(diagram, True)  # dark_mode=True
+                # The dark source only exists in memory, so it can't be passed as a file
+                mock_pipe.assert_called_once_with(diagram, diagram.out_file_dark)
             mock_server.assert_not_called()
 
     def test_local_calls_subprocess(self, plugin, tmp_path):
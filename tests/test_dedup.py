@@ -0,0 +1,123 @@
+"""Tests for rendering identical diagrams only once."""
+import logging
+import os
+import shutil
+import pytest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+@pytest.fixture
+def monorepo(diagram_tree):
+    """diagram_tree with a copy of a.puml and a second root v2/diagrams holding a.puml and b.puml."""
+    shutil.copytree(diagram_tree, diagram_tree.parent / "v2" / "diagrams")
+    shutil.copy(diagram_tree / "src" / "a.puml", diagram_tree / "src" / "copy.puml")
+    return diagram_tree.parent
+
+
+@pytest.fixture
+def dedup_plugin(plugin, fake_render, monkeypatch):
+    plugin.config["allow_multiple_roots"] = True
+    monkeypatch.setattr(plugin, "_call_server", MagicMock(side_effect=fake_render))
+    return plugin
+
+
+def _build(plugin):
+    plugin._call_server.reset_mock()
+    plugin.on_pre_build({})
+    return [Path(args[1]) for args, _ in plugin._call_server.call_args_list]
+
+
+def _outputs(monorepo):
+    return sorted(monorepo.glob("**/diagrams/out/*.png"))
+
+
+class TestDeduplication:
+    """Tests for grouping the renders by their source."""
+
+    def test_unique_sources_rendered_once(self, dedup_plugin, monorepo):
+        rendered = _build(dedup_plugin)
+
+        assert len(rendered) == 2
+        assert len(_outputs(monorepo)) == 5
+        shared = (monorepo / "diagrams/out/a.png").read_bytes()
+        for name in ["diagrams/out/copy.png", "v2/diagrams/out/a.png"]:
+            assert (monorepo / name).read_bytes() == shared
+
+    def test_duplicates_hardlinked(self, dedup_plugin, monorepo):
+        _build(dedup_plugin)
+        inodes = {p.stat().st_ino for p in _outputs(monorepo)}
+        assert len(inodes) == 2
+
+    def test_copied_without_hardlinks(self, dedup_plugin, monorepo):
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.link", side_effect=OSError("cross-device link")):
+            _build(dedup_plugin)
+        inodes = {p.stat().st_ino for p in _outputs(monorepo)}
+        assert len(inodes) == 5
+        assert not list(monorepo.glob("**/diagrams/out/.*.tmp"))
+
+    def test_linked_image_replaced_not_modified(self, dedup_plugin, monorepo):
+        """Rendering one of the copies again should not change the others."""
+        _build(dedup_plugin)
+        copy = monorepo / "diagrams/src/copy.puml"
+        copy.write_text(copy.read_text().replace("actor A", "actor Changed"))
+        os.utime(copy, (4000000000, 4000000000))
+
+        _build(dedup_plugin)
+
+        assert (monorepo / "diagrams/out/copy.png").read_bytes() != (monorepo / "diagrams/out/a.png").read_bytes()
+
+    def test_other_format_not_shared(self, dedup_plugin, monorepo):
+        """Only renders of the same output format are the same image."""
+        dedup_plugin.config["output_format"] = "svg"
+        rendered = _build(dedup_plugin)
+        assert {p.suffix for p in rendered} == {".svg"}
+        assert len(rendered) == 2
+
+    def test_ratio_logged(self, dedup_plugin, monorepo, caplog):
+        with caplog.at_level(logging.INFO):
+            _build(dedup_plugin)
+        assert "Rendered 2 unique diagrams for 5 images, 60% deduplicated" in caplog.text
+
+    def test_local_render_copies(self, dedup_plugin, monorepo):
+        """PlantUML overwrites images in place with render: local, so no links."""
+        dedup_plugin.config["render"] = "local"
+
+        def fake_call(args):
+            files = args[args.index("auto") + 1:args.index("-o")]
+            out_dir = Path(args[-1])
+            out_dir.mkdir(parents=True, exist_ok=True)
+            for f in files:
+                (out_dir / (Path(f).stem + ".png")).write_bytes(b"PNG " + Path(f).read_bytes())
+            return 0
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call) as mock_call:
+            dedup_plugin.on_pre_build({})
+
+        rendered = sum(len(args[0][args[0].index("auto") + 1:args[0].index("-o")]) for args, _ in mock_call.call_args_list)
+        assert rendered == 2
+        assert len({p.stat().st_ino for p in _outputs(monorepo)}) == 5
+
+    def test_cache_restore_keeps_links_apart(self, dedup_plugin, monorepo):
+        """Restoring one copy from the render cache should not change its linked copies."""
+        dedup_plugin.config["cache_dir"] = ".cache"
+        copy = monorepo / "diagrams/src/copy.puml"
+        source = copy.read_text()
+        copy.write_text(source.replace("actor A", "actor Changed"))
+        _build(dedup_plugin)
+        changed = (monorepo / "diagrams/out/copy.png").read_bytes()
+
+        # All copies of the shared source linked to one image
+        copy.write_text(source)
+        for image in _outputs(monorepo):
+            image.unlink()
+        _build(dedup_plugin)
+        shared = (monorepo / "diagrams/out/a.png").read_bytes()
+
+        # Back to a source the cache knows
+        copy.write_text(source.replace("actor A", "actor Changed"))
+        os.utime(copy, (4000000000, 4000000000))
+        assert _build(dedup_plugin) == []
+
+        assert (monorepo / "diagrams/out/copy.png").read_bytes() == changed
+        for name in ["diagrams/out/a.png", "v2/diagrams/out/a.png"]:
+            assert (monorepo / name).read_bytes() == shared
@@ -0,0 +1,128 @@
+"""Tests for the include dependency graph."""
+import json
+import os
+import pytest
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import DependencyGraph
+
+
+class TestDependencyGraph:
+    """Tests for the DependencyGraph index."""
+
+    def test_reverse_index(self):
+        """Every include should know its dependents."""
+        graph = DependencyGraph()
+        graph.update("a.puml", ["light.puml", "general.puml"])
+        graph.update("b.puml", ["general.puml"])
+
+        assert graph.dependents["general.puml"] == {"a.puml", "b.puml"}
+        assert graph.dependents_of(["light.puml"]) == {"a.puml"}
+
+    def test_update_replaces_edges(self):
+        """Re-recording a diagram should drop includes it no longer uses."""
+        graph = DependencyGraph()
+        graph.update("a.puml", ["light.puml"])
+        graph.update("a.puml", ["dark.puml"])
+
+        assert "light.puml" not in graph.dependents
+        assert graph.dependents["dark.puml"] == {"a.puml"}
+
+    def test_prune_drops_unvisited(self):
+        """Diagrams not seen in a build should be forgotten."""
+        graph = DependencyGraph()
+        graph.update("a.puml", ["general.puml"])
+        graph.update("b.puml", ["general.puml"])
+        graph.begin()
+        graph.visit("a.puml")
+        graph.prune()
+
+        assert list(graph.includes) == ["a.puml"]
+        assert graph.dependents["general.puml"] == {"a.puml"}
+
+    def test_dump_json(self, tmp_path):
+        """The JSON dump should contain both directions."""
+        graph = DependencyGraph()
+        graph.update("a.puml", ["light.puml", "general.puml"])
+        graph.dump(tmp_path / "graph.json")
+
+        data = json.loads((tmp_path / "graph.json").read_text())
+        assert data["diagrams"] == {"a.puml": ["general.puml", "light.puml"]}
+        assert data["includes"] == {"general.puml": ["a.puml"], "light.puml": ["a.puml"]}
+
+    def test_dump_dot(self, tmp_path):
+        """A .dot file should be written as a Graphviz digraph."""
+        graph = DependencyGraph()
+        graph.update("a.puml", ["light.puml"])
+        graph.dump(tmp_path / "graph.dot")
+
+        content = (tmp_path / "graph.dot").read_text()
+        assert content.startswith("digraph")
+        assert '"a.puml" -> "light.puml";' in content
+
+    def test_unchanged_dump_not_rewritten(self, tmp_path):
+        """Dumping the same graph again should keep the file and its mtime."""
+        graph = DependencyGraph()
+        graph.update("a.puml", ["light.puml"])
+        graph.dump(tmp_path / "graph.json")
+        os.utime(tmp_path / "graph.json", (1000, 1000))
+
+        graph.dump(tmp_path / "graph.json")
+        assert (tmp_path / "graph.json").stat().st_mtime == 1000
+
+
+class TestPluginDependencyGraph:
+    """Tests for the dependency graph built by on_pre_build."""
+
+    @pytest.fixture
+    def project(self, plugin, tmp_path, monkeypatch):
+        root = tmp_path / "diagrams"
+        themes = root / "include" / "themes"
+        themes.mkdir(parents=True)
+        (themes / "general.puml").write_text("skinparam Padding 4\n")
+        (themes / "light.puml").write_text("!include general.puml\n")
+        (root / "src").mkdir()
+        (root / "src" / "a.puml").write_text("@startuml\n!include ../include/themes/light.puml\n@enduml\n")
+        (root / "src" / "b.puml").write_text("@startuml\n!include ../include/themes/general.puml\n@enduml\n")
+        (root / "src" / "c.puml").write_text("@startuml\nactor C\n@enduml\n")
+        plugin.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+        return root
+
+    def test_transitive_includes_recorded(self, plugin, project, fake_render):
+        """Nested includes should be recorded for the including diagram."""
+        with patch.object(plugin, "_call_server", side_effect=fake_render):
+            plugin.on_pre_build({})
+
+        general = str((project / "include" / "themes" / "general.puml").resolve())
+        assert plugin.dependency_graph.dependents[general] == {
+            str(project / "src" / "a.puml"),
+            str(project / "src" / "b.puml"),
+        }
+
+    def test_graph_file_written(self, plugin, project, fake_render):
+        """dependency_graph_file should dump the graph after the build."""
+        plugin.config["dependency_graph_file"] = "site/deps.json"
+        with patch.object(plugin, "_call_server", side_effect=fake_render):
+            plugin.on_pre_build({})
+
+        data = json.loads((project.parent / "site" / "deps.json").read_text())
+        assert str(project / "src" / "c.puml") in data["diagrams"]
+
+    def test_edit_include_rerenders_dependents_only(self, plugin, project, fake_render):
+        """Editing general.puml should only re-read its dependents."""
+        plugin.config["manifest_file"] = "manifest.json"
+        with patch.object(plugin, "_call_server", side_effect=fake_render):
+            plugin.on_pre_build({})
+
+        general = project / "include" / "themes" / "general.puml"
+        stat = general.stat()
+        os.utime(general, (stat.st_atime, stat.st_mtime + 10))
+
+        with patch.object(plugin, "_call_server", side_effect=fake_render) as mock_server:
+            with patch.object(plugin, "_readFile", wraps=plugin._readFile) as mock_read:
+                plugin.on_pre_build({})
+
+        read = sorted(args[0].file for args, _ in mock_read.call_args_list)
+        assert read == ["a.puml", "b.puml"]
+        assert mock_server.call_count == 2
@@ -0,0 +1,115 @@
+"""Tests for the include_patterns and exclude_patterns options."""
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import FileMatcher
+
+
+@pytest.fixture
+def tree(diagram_tree):
+    """The diagrams of diagram_tree next to notes, drafts and a big asset folder."""
+    src = diagram_tree / "src"
+    for name in [
+        "notes.txt",
+        "arch/c.puml",
+        "arch/drafts/d.puml",
+        "drafts/e.puml",
+        "assets/img/f.puml",
+    ]:
+        (src / name).parent.mkdir(parents=True, exist_ok=True)
+        (src / name).write_text("@startuml\n@enduml\n")
+    return src
+
+
+def _walk(plugin):
+    """Returns the diagrams found and the folders listed by os.walk"""
+    plugin.on_config({})
+    walked = []
+    original_walk = os.walk
+
+    def recording_walk(path, *args, **kwargs):
+        for subdir, dirs, files in original_walk(path, *args, **kwargs):
+            walked.append(Path(subdir).name)
+            yield subdir, dirs, files
+
+    with patch("mkdocs_build_plantuml_plugin.plantuml.os.walk", side_effect=recording_walk):
+        roots = plugin._find_diagram_roots()
+        found = sorted(
+            (Path(subdir) / file).relative_to(roots[0].src_dir).as_posix()
+            for _, subdir, file in plugin._walk_diagrams(roots)
+        )
+    return found, walked
+
+
+class TestFileMatcher:
+    """Tests for FileMatcher."""
+
+    def test_include_patterns(self):
+        matcher = FileMatcher("", ("**/*.puml",), (), ())
+        assert matcher.matches("a.puml", "a.puml")
+        assert matcher.matches("b.puml", "x/y/b.puml")
+        assert not matcher.matches("a.txt", "a.txt")
+
+    def test_exclude_patterns(self):
+        matcher = FileMatcher("", (), ("**/drafts/**", "*.tmp.puml"), ())
+        assert not matcher.matches("c.puml", "arch/drafts/c.puml")
+        assert not matcher.matches("x.tmp.puml", "x.tmp.puml")
+        assert matcher.matches("x.puml", "arch/x.puml")
+        assert matcher.prunes("drafts", "arch/drafts")
+        assert not matcher.prunes("arch", "arch")
+
+    def test_extensions_combined(self):
+        """input_extensions should still apply next to the patterns."""
+        matcher = FileMatcher("puml,iuml", ("arch/**",), (), ())
+        assert matcher.matches("b.puml", "arch/b.puml")
+        assert not matcher.matches("b.txt", "arch/b.txt")
+        assert not matcher.matches("a.puml", "a.puml")
+
+    def test_include_prefix_prunes(self):
+        """Folders outside of all include patterns should not be walked."""
+        matcher = FileMatcher("", ("arch/**/*.puml", "shared/*.puml"), (), ())
+        assert not matcher.prunes("arch", "arch")
+        assert not matcher.prunes("drafts", "arch/drafts")
+        assert matcher.prunes("assets", "assets")
+        assert not matcher.prunes("shared", "shared")
+
+    def test_exclude_dirs_by_name(self):
+        matcher = FileMatcher("", (), (), (".git", "node_*"))
+        assert matcher.prunes(".git", "a/.git")
+        assert matcher.prunes("node_modules", "node_modules")
+        assert not matcher.prunes("nodes", "nodes")
+
+
+class TestPluginPatterns:
+    """Tests for the patterns in the walk over the source folders."""
+
+    def test_default_finds_everything(self, plugin, tree):
+        found, _ = _walk(plugin)
+        assert found == [
+            "a.puml", "arch/c.puml", "arch/drafts/d.puml", "assets/img/f.puml", "b.puml", "drafts/e.puml", "notes.txt",
+        ]
+
+    def test_excluded_folders_not_descended(self, plugin, tree):
+        """**/drafts/** should skip both drafts folders without listing them."""
+        plugin.config["include_patterns"] = ["**/*.puml"]
+        plugin.config["exclude_patterns"] = ["**/drafts/**", "assets/**"]
+        found, walked = _walk(plugin)
+        assert found == ["a.puml", "arch/c.puml", "b.puml"]
+        assert "drafts" not in walked and "assets" not in walked
+
+    def test_include_prefix_not_descending_elsewhere(self, plugin, tree):
+        plugin.config["include_patterns"] = ["arch/**/*.puml"]
+        found, walked = _walk(plugin)
+        assert found == ["arch/c.puml", "arch/drafts/d.puml"]
+        assert sorted(walked) == ["arch", "drafts", "src"]
+
+    def test_matcher_compiled_once(self, plugin, tree):
+        """The patterns should not be compiled again for every file."""
+        plugin.config["include_patterns"] = ["**/*.puml"]
+        with patch("mkdocs_build_plantuml_plugin.plantuml.FileMatcher", wraps=FileMatcher) as mock_matcher:
+            _walk(plugin)
+            for name in ["a.puml", "b.puml", "c.txt"]:
+                plugin._file_matches_extension(name)
+        assert mock_matcher.call_count == 1
@@ -0,0 +1,226 @@
+"""Tests for the shared HttpClientPool."""
+import threading
+import time
+import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch, MagicMock
+
+from mkdocs_build_plantuml_plugin.plantuml import HttpClientPool, PuElement
+
+
+class TestHttpClientPool:
+    """Tests for HttpClientPool."""
+
+    def test_creates_one_client_per_slot(self):
+        """Pool should hold as many clients as requested."""
+        with patch('httplib2.Http') as mock_http_class:
+            pool = HttpClientPool(4)
+
+        assert mock_http_class.call_count == 4
+        assert len(pool.clients) == 4
+
+    def test_ssl_validation_disabled_on_all_clients(self):
+        """Every client should have certificate validation disabled."""
+        with patch('httplib2.Http', side_effect=lambda *a, **k: MagicMock()):
+            pool = HttpClientPool(2, disable_ssl=True)
+
+        assert all(c.disable_ssl_certificate_validation is True for c in pool.clients)
+
+    def test_timeout_passed_to_clients(self):
+        """Every client should give up after the timeout."""
+        with patch('httplib2.Http') as mock_http_class:
+            HttpClientPool(2, timeout=5)
+
+        mock_http_class.assert_called_with({}, timeout=5)
+
+    def test_request_returns_client_to_pool(self):
+        """Client should be reusable after a request, also after errors."""
+        with patch('httplib2.Http') as mock_http_class:
+            mock_http = mock_http_class.return_value
+            pool = HttpClientPool(1)
+
+        mock_http.request.side_effect = Exception("Network error")
+        with pytest.raises(Exception):
+            pool.request("http://server/png/abc")
+
+        mock_http.request.side_effect = None
+        mock_http.request.return_value = (MagicMock(status=200), b"content")
+        assert pool.request("http://server/png/abc")[1] == b"content"
+
+    def test_warm_sends_head_requests(self):
+        """warm() should connect every client in the background."""
+        done = threading.Event()
+        calls = []
+
+        def fake_request(url, method, headers=None):
+            calls.append(method)
+            if len(calls) == 2:
+                done.set()
+            return MagicMock(status=200), b""
+
+        with patch('httplib2.Http', side_effect=lambda *a, **k: MagicMock(request=fake_request)):
+            pool = HttpClientPool(2)
+            pool.warm("http://server")
+
+        assert done.wait(5)
+        assert calls == ["HEAD", "HEAD"]
+
+    def test_warm_once_per_pool(self):
+        """The connections stay open, so a pool should only be warmed once."""
+        with patch('httplib2.Http') as mock_http_class:
+            pool = HttpClientPool(1)
+        with patch('mkdocs_build_plantuml_plugin.plantuml.threading.Thread') as mock_thread:
+            pool.warm("http://server")
+            pool.warm("http://server")
+        assert mock_thread.call_count == 1
+
+    def test_close_closes_clients(self):
+        """close() should drop the persistent connections."""
+        with patch('httplib2.Http') as mock_http_class:
+            pool = HttpClientPool(1)
+        pool.close()
+        mock_http_class.return_value.close.assert_called_once()
+
+
+class TestPluginHttpPool:
+    """Tests for the pool handling in BuildPlantumlPlugin."""
+
+    def test_pool_reused_between_requests(self, plugin, tmp_path):
+        """Consecutive server calls should share one client."""
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.out_dir = str(tmp_path / "out")
+        diagram.b64encoded = "SomeEncodedContent"
+
+        with patch('httplib2.Http') as mock_http_class:
+            mock_http_class.return_value.request.return_value = (MagicMock(status=200), b"content")
+            plugin._call_server(diagram, str(tmp_path / "out" / "a.png"))
+            plugin._call_server(diagram, str(tmp_path / "out" / "b.png"))
+
+        assert mock_http_class.call_count == 1
+        assert mock_http_class.return_value.request.call_count == 2
+
+    def test_pool_sized_to_workers(self, plugin):
+        """Pool size should follow the workers setting."""
+        plugin.config["workers"] = 8
+        with patch('httplib2.Http'):
+            assert plugin._http_pool().size == 8
+
+    def test_pool_recreated_on_config_change(self, plugin):
+        """A changed worker count should replace the pool."""
+        with patch('httplib2.Http'):
+            first = plugin._http_pool()
+            plugin.config["workers"] = 2
+            second = plugin._http_pool()
+
+        assert first is not second
+        assert plugin._http_pool() is second
+
+    def test_gzip_requested_for_svg(self, plugin_svg_format):
+        """SVG requests should accept gzip."""
+        assert plugin_svg_format._request_headers() == {"accept-encoding": "gzip"}
+
+    def test_no_gzip_for_png(self, plugin):
+        """PNG requests should not ask for compression."""
+        assert plugin._request_headers() == {"accept-encoding": "identity"}
+
+    def test_gzip_can_be_disabled(self, plugin_svg_format):
+        """gzip_svg: false should request identity encoding."""
+        plugin_svg_format.config["gzip_svg"] = False
+        assert plugin_svg_format._request_headers() == {"accept-encoding": "identity"}
+
+    def test_shutdown_closes_pool(self, plugin):
+        """on_shutdown should close the connections."""
+        with patch('httplib2.Http') as mock_http_class:
+            plugin._http_pool()
+        plugin.on_shutdown()
+
+        mock_http_class.return_value.close.assert_called_once()
+        assert plugin.http_pool is None
+
+
+class TestPrewarm:
+    """Tests for warming the connections during on_pre_build."""
+
+    @pytest.fixture
+    def warm_plugin(self, plugin, tmp_path, monkeypatch):
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        (src / "a.puml").write_text("@startuml\nactor A\n@enduml\n")
+        plugin.config["diagram_root"] = "diagrams"
+        plugin.config["prewarm_connections"] = True
+        monkeypatch.chdir(tmp_path)
+        return plugin
+
+    def _build(self, plugin):
+        with patch.object(HttpClientPool, "warm") as mock_warm:
+            with patch('httplib2.Http') as mock_http_class:
+                mock_http_class.return_value.request.return_value = (MagicMock(status=200), b"image")
+                plugin.on_pre_build({})
+        return mock_warm.call_count
+
+    def test_warmed_for_stale_diagram(self, warm_plugin):
+        assert self._build(warm_plugin) == 1
+
+    def test_not_warmed_without_stale_diagrams(self, warm_plugin):
+        """Up-to-date builds should not send anything to the server."""
+        self._build(warm_plugin)
+        assert self._build(warm_plugin) == 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith("/moved"):
+            self.send_response(301)
+            self.send_header("Location", self.path[len("/moved"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path.startswith("/stalled"):
+            time.sleep(2)
+        body = f"rendered {self.path}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestServerRequests:
+    """Tests for on_pre_build against a real HTTP server."""
+
+    @pytest.fixture
+    def http_server(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        server.paths = []
+        thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{server.server_address[1]}", server.paths
+        server.shutdown()
+        server.server_close()
+
+    def test_redirect_followed(self, plugin, diagram_tree, http_server):
+        """A server behind a redirect should render."""
+        url, paths = http_server
+        plugin.config["server"] = url + "/moved/plantuml"
+        plugin.config["workers"] = 2
+        plugin.on_pre_build({})
+
+        assert (diagram_tree / "out" / "a.png").read_bytes().startswith(b"rendered /plantuml/png/")
+        assert len(paths) == 4
+
+    def test_stalled_server_times_out(self, plugin, diagram_tree, http_server):
+        """A request should give up after render_timeout seconds."""
+        url, _ = http_server
+        plugin.config["server"] = url + "/stalled/plantuml"
+        plugin.config["render_timeout"] = 1
+        start = time.perf_counter()
+        with pytest.raises(Exception):
+            plugin.on_pre_build({})
+
+        assert time.perf_counter() - start < 2
+        assert not (diagram_tree / "out" / "a.png").exists()
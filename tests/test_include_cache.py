@@ -0,0 +1,122 @@
+"""Tests for memoizing expanded include files."""
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import IncludeCache, PuElement
+
+
+@pytest.fixture
+def themes(tmp_path):
+    """Theme files where light.puml includes general.puml."""
+    themes = tmp_path / "themes"
+    themes.mkdir()
+    (themes / "general.puml").write_text("skinparam Padding 4\n")
+    (themes / "light.puml").write_text("' light\n!include general.puml\n")
+    (themes / "dark.puml").write_text("' dark\n!include general.puml\n")
+    return themes
+
+
+def _diagram(tmp_path, name="test.puml"):
+    diagram = PuElement(name, str(tmp_path))
+    diagram.root_dir = str(tmp_path)
+    diagram.src_file = ["@startuml\n", "!include themes/light.puml\n", "@enduml\n"]
+    return diagram
+
+
+def _count_opens(plugin, func):
+    """Run func and return how often each include file was opened."""
+    opened = []
+    original_open = Path.open
+
+    def recording_open(self, *args, **kwargs):
+        opened.append(self.name)
+        return original_open(self, *args, **kwargs)
+
+    with patch.object(Path, "open", recording_open):
+        func()
+    return opened
+
+
+class TestIncludeCache:
+    """Tests for the IncludeCache store."""
+
+    def test_lookup_miss(self):
+        """Unknown keys should return None."""
+        assert IncludeCache().lookup(("a.puml", "", None)) is None
+
+    def test_entry_valid_while_files_unchanged(self, tmp_path):
+        """An entry should survive a new build if no file changed."""
+        inc = tmp_path / "a.puml"
+        inc.write_text("x\n")
+        cache = IncludeCache()
+        cache.store("key", "x\n", {str(inc): inc.stat().st_mtime})
+
+        cache.begin()
+        assert cache.lookup("key") == ("x\n", {str(inc): inc.stat().st_mtime})
+
+    def test_entry_dropped_when_nested_include_changes(self, tmp_path):
+        """A change in any nested include should invalidate the entry."""
+        inc = tmp_path / "a.puml"
+        nested = tmp_path / "b.puml"
+        inc.write_text("x\n")
+        nested.write_text("y\n")
+        cache = IncludeCache()
+        cache.store("key", "x\ny\n", {str(inc): inc.stat().st_mtime, str(nested): nested.stat().st_mtime})
+
+        os.utime(nested, (1, 1))
+        # Within the same build the entry is trusted
+        assert cache.lookup("key") is not None
+        cache.begin()
+        assert cache.lookup("key") is None
+
+
+class TestPluginIncludeCache:
+    """Tests for the include memoization in BuildPlantumlPlugin."""
+
+    def test_shared_include_read_once(self, plugin, tmp_path, themes):
+        """Many diagrams including the same theme should read it once."""
+        def expand_all():
+            for i in range(5):
+                plugin._readFile(_diagram(tmp_path, f"d{i}.puml"), False)
+
+        opened = _count_opens(plugin, expand_all)
+        assert opened.count("light.puml") == 1
+        assert opened.count("general.puml") == 1
+
+    def test_cached_expansion_identical(self, plugin, tmp_path, themes):
+        """A cached include should produce the same text and includes."""
+        first = _diagram(tmp_path, "a.puml")
+        second = _diagram(tmp_path, "b.puml")
+        plugin._readFile(first, False)
+        plugin._readFile(second, False)
+
+        assert first.concat_file == second.concat_file
+        assert "skinparam Padding 4" in second.concat_file
+        assert second.includes == first.includes
+        assert str((themes / "general.puml").resolve()) in second.includes
+        assert second.inc_time == first.inc_time > 0
+
+    def test_dark_variant_cached_separately(self, plugin, tmp_path, themes):
+        """The dark expansion should not come from the light cache entry."""
+        plugin._readFile(_diagram(tmp_path), False)
+        diagram = _diagram(tmp_path)
+        plugin._readFile(diagram, True)
+
+        assert "' dark" in diagram.concat_file
+        assert "' light" not in diagram.concat_file
+
+    def test_changed_include_reread_in_next_build(self, plugin, tmp_path, themes):
+        """Editing an include should be picked up after begin()."""
+        plugin._readFile(_diagram(tmp_path), False)
+
+        general = themes / "general.puml"
+        general.write_text("skinparam Padding 8\n")
+        stat = general.stat()
+        os.utime(general, (stat.st_atime, stat.st_mtime + 10))
+        plugin.include_cache.begin()
+
+        diagram = _diagram(tmp_path)
+        plugin._readFile(diagram, False)
+        assert "skinparam Padding 8" in diagram.concat_file
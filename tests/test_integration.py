@@ -25,7 +25,24 @@ def get_default_config(**overrides):
         "theme_folder": "include/themes/",
         "theme_light": "light.puml",
         "theme_dark": "dark.puml",
+        "theme_variants": [],
+        "diagram_roots": [],
+        "respect_gitignore": False,
         "exclude_dirs": [".git"],
+        "include_patterns": [],
+        "exclude_patterns": [],
+        "workers": 1,
+        "prewarm_connections": True,
+        "gzip_svg": True,
+        "cache_dir": "",
+        "cache_max_size": 256,
+        "manifest_file": "",
+        "dependency_graph_file": "",
+        "local_server_instances": 1,
+        "render_timeout": 60,
+        "timing_report_file": "",
+        "profile_dir": "",
+        "profile_samples": False,
     }
     config.update(overrides)
     return config
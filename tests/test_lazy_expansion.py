@@ -0,0 +1,80 @@
+"""Tests for deciding staleness before expanding a diagram."""
+import os
+import pytest
+from unittest.mock import patch
+
+
+@pytest.fixture
+def lazy_plugin(plugin, diagram_tree, fake_render, monkeypatch):
+    monkeypatch.setattr(plugin, "_call_server", fake_render)
+    return plugin
+
+
+def _expanded(plugin):
+    """Builds and returns the files that were expanded"""
+    with patch.object(plugin, "_readFile", wraps=plugin._readFile) as mock_read:
+        plugin.on_pre_build({})
+    return sorted({args[0].file for args, _ in mock_read.call_args_list})
+
+
+def _touch(path, offset=10):
+    stat = path.stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + offset))
+
+
+class TestLazyExpansion:
+    """Tests for skipping the expansion of up-to-date diagrams."""
+
+    def test_first_build_expands_all(self, lazy_plugin, diagram_tree):
+        """Without known includes every diagram has to be expanded."""
+        assert _expanded(lazy_plugin) == ["a.puml", "b.puml"]
+
+    def test_unchanged_tree_not_expanded(self, lazy_plugin, diagram_tree):
+        """A rebuild without changes should not expand or encode anything."""
+        _expanded(lazy_plugin)
+        assert _expanded(lazy_plugin) == []
+
+    def test_changed_include_expands_dependent(self, lazy_plugin, diagram_tree):
+        """Touching an include should only expand the diagrams using it."""
+        _expanded(lazy_plugin)
+        _touch(diagram_tree / "include" / "style.puml")
+        assert _expanded(lazy_plugin) == ["a.puml"]
+
+    def test_changed_source_expanded(self, lazy_plugin, diagram_tree):
+        """Touching a source should expand it."""
+        _expanded(lazy_plugin)
+        _touch(diagram_tree / "src" / "b.puml")
+        assert _expanded(lazy_plugin) == ["b.puml"]
+
+    def test_missing_output_expanded(self, lazy_plugin, diagram_tree):
+        """A deleted image should be rendered again."""
+        _expanded(lazy_plugin)
+        (diagram_tree / "out" / "b.png").unlink()
+        assert _expanded(lazy_plugin) == ["b.puml"]
+
+    def test_deleted_include_expanded(self, lazy_plugin, diagram_tree):
+        """A diagram whose include is gone should be expanded to report it."""
+        _expanded(lazy_plugin)
+        (diagram_tree / "include" / "style.puml").unlink()
+        with pytest.raises(Exception, match="Include could not be resolved"):
+            _expanded(lazy_plugin)
+
+    def test_missing_theme_output_expanded(self, lazy_plugin, diagram_tree):
+        """With themes, every variant's image has to be current."""
+        lazy_plugin.config["theme_enabled"] = True
+        _expanded(lazy_plugin)
+        (diagram_tree / "out" / "a_dark.png").unlink()
+        assert _expanded(lazy_plugin) == ["a.puml"]
+
+    def test_include_stat_once_per_build(self, lazy_plugin, diagram_tree):
+        """A shared include should be checked once, not once per diagram."""
+        (diagram_tree / "src" / "c.puml").write_text("@startuml\n!include ../include/style.puml\n@enduml\n")
+        _expanded(lazy_plugin)
+
+        with patch.object(lazy_plugin, "_include_mtime", wraps=lazy_plugin._include_mtime) as mock_mtime:
+            with patch("mkdocs_build_plantuml_plugin.plantuml.os.stat", wraps=os.stat) as mock_stat:
+                _expanded(lazy_plugin)
+
+        style = str((diagram_tree / "include" / "style.puml").resolve())
+        assert mock_mtime.call_count == 2
+        assert [args[0] for args, _ in mock_stat.call_args_list].count(style) == 1
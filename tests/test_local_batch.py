@@ -0,0 +1,156 @@
+"""Tests for batched local rendering."""
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import LocalBatch, PuElement
+
+
+def _fake_plantuml(bad=()):
+    """A stand-in for the PlantUML binary, writing one png per input file"""
+    runs = []
+
+    def fake_call(args):
+        files = args[args.index("auto") + 1:args.index("-o")]
+        out_dir = Path(args[-1])
+        runs.append([Path(f).name for f in files])
+        returncode = 0
+        for f in files:
+            if Path(f).name in bad:
+                returncode = 200
+                continue
+            out_dir.mkdir(parents=True, exist_ok=True)
+            (out_dir / (Path(f).stem + ".png")).write_bytes(b"PNG " + Path(f).name.encode())
+        return returncode
+
+    return fake_call, runs
+
+
+@pytest.fixture
+def project(diagram_tree):
+    """diagram_tree with a second source folder sub holding c.puml."""
+    (diagram_tree / "src" / "sub").mkdir()
+    (diagram_tree / "src" / "sub" / "c.puml").write_text("@startuml\nactor C\n@enduml\n")
+    return diagram_tree.parent
+
+
+@pytest.fixture
+def local_plugin(plugin):
+    plugin.config["render"] = "local"
+    return plugin
+
+
+class TestLocalBatch:
+    """Tests for LocalBatch."""
+
+    def _diagram(self, tmp_path, name, out_dir):
+        diagram = PuElement(name, str(tmp_path))
+        diagram.out_dir = str(out_dir)
+        diagram.out_file = str(Path(out_dir) / (Path(name).stem + ".png"))
+        return diagram
+
+    def test_one_run_per_output_directory(self, tmp_path):
+        """Diagrams sharing an output directory should be rendered together."""
+        batch = LocalBatch(["plantuml"], "png")
+        for name in ["a.puml", "b.puml"]:
+            batch.add(self._diagram(tmp_path, name, tmp_path / "out"))
+        batch.add(self._diagram(tmp_path, "c.puml", tmp_path / "out2"))
+
+        fake_call, runs = _fake_plantuml()
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call):
+            rendered, failed = batch.run()
+
+        assert runs == [["a.puml", "b.puml"], ["c.puml"]]
+        assert len(rendered) == 3
+        assert failed == []
+
+    def test_command_line(self, tmp_path):
+        """The run should pass the format, the thread count and the output directory."""
+        batch = LocalBatch(["java", "-jar", "plantuml.jar"], "svg")
+        batch.add(self._diagram(tmp_path, "a.puml", tmp_path / "out"))
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", return_value=0) as mock_call:
+            batch.run()
+
+        assert mock_call.call_args[0][0] == [
+            "java", "-jar", "plantuml.jar", "-tsvg", "-nbthread", "auto",
+            str(tmp_path / "a.puml"), "-o", str(tmp_path / "out"),
+        ]
+
+    def test_failure_mapped_to_source(self, tmp_path):
+        """A failing run should be split until the broken diagram is found."""
+        batch = LocalBatch(["plantuml"], "png")
+        for name in ["a.puml", "b.puml", "c.puml", "d.puml"]:
+            batch.add(self._diagram(tmp_path, name, tmp_path / "out"))
+
+        fake_call, runs = _fake_plantuml(bad={"c.puml"})
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call):
+            rendered, failed = batch.run()
+
+        assert [d.file for d in failed] == ["c.puml"]
+        assert sorted(d.file for d in rendered) == ["a.puml", "b.puml", "d.puml"]
+        assert runs[0] == ["a.puml", "b.puml", "c.puml", "d.puml"]
+
+    def test_missing_output_is_failure(self, tmp_path):
+        """A diagram without an output after a clean run should be reported."""
+        batch = LocalBatch(["plantuml"], "png")
+        batch.add(self._diagram(tmp_path, "a.puml", tmp_path / "out"))
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", return_value=0):
+            rendered, failed = batch.run()
+
+        assert rendered == []
+        assert [d.file for d in failed] == ["a.puml"]
+
+    def test_long_command_lines_split(self, tmp_path):
+        """Runs should be split before the command line gets too long."""
+        batch = LocalBatch(["plantuml"], "png")
+        batch.max_command_length = 200 + len(str(tmp_path)) * 3
+        for i in range(10):
+            batch.add(self._diagram(tmp_path, f"diagram_{i:02d}.puml", tmp_path / "out"))
+
+        fake_call, runs = _fake_plantuml()
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call):
+            rendered, _ = batch.run()
+
+        assert len(runs) > 1
+        assert sum(len(run) for run in runs) == 10
+        assert len(rendered) == 10
+
+
+class TestPluginLocalBatch:
+    """Tests for batched local rendering in on_pre_build."""
+
+    def test_build_uses_one_run_per_directory(self, local_plugin, project):
+        """A build should start PlantUML once per output directory."""
+        fake_call, runs = _fake_plantuml()
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call):
+            local_plugin.on_pre_build({})
+
+        assert sorted(sorted(run) for run in runs) == [["a.puml", "b.puml"], ["c.puml"]]
+        out = project / "diagrams" / "out"
+        assert (out / "a.png").exists()
+        assert (out / "sub" / "c.png").exists()
+        assert local_plugin.local_batch is None
+
+    def test_failures_logged_per_source(self, local_plugin, project, caplog):
+        """Each failing diagram should be named in the log."""
+        fake_call, _ = _fake_plantuml(bad={"b.puml"})
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call):
+            local_plugin.on_pre_build({})
+
+        errors = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+        assert errors == [f"Could not render {project / 'diagrams' / 'src' / 'b.puml'}"]
+
+    def test_rendered_outputs_cached(self, local_plugin, project):
+        """Successful outputs of a batch should be stored in the render cache."""
+        local_plugin.config["cache_dir"] = ".cache"
+        fake_call, runs = _fake_plantuml()
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", side_effect=fake_call):
+            local_plugin.on_pre_build({})
+            for png in (project / "diagrams" / "out").rglob("*.png"):
+                png.unlink()
+            local_plugin.on_pre_build({})
+
+        assert len(runs) == 2
+        assert (project / "diagrams" / "out" / "sub" / "c.png").exists()
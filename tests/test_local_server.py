@@ -0,0 +1,182 @@
+"""Tests for the managed local PlantUML servers of render: local-server."""
+import os
+import sys
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import LocalServerPool, PuElement
+
+# Behaves like `plantuml -picoweb:PORT:IP`, answering every request with its path and port
+FAKE_PICOWEB = r'''
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+port, ip = sys.argv[-1].split(":")[1:]
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        body = f"{port} {self.path}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+HTTPServer((ip, int(port)), Handler).serve_forever(0.01)
+'''
+
+
+@pytest.fixture
+def fake_bin(tmp_path):
+    script = tmp_path / "fake_picoweb.py"
+    script.write_text(FAKE_PICOWEB)
+    return [sys.executable, str(script)]
+
+
+class TestLocalServerPool:
+    """Tests for LocalServerPool."""
+
+    def test_start_and_round_robin(self, fake_bin):
+        """Requests should alternate between the started servers."""
+        pool = LocalServerPool(fake_bin, 2, start_timeout=20)
+        try:
+            pool.start()
+            assert pool.alive()
+            urls = [pool.next_url() for _ in range(4)]
+        finally:
+            pool.close()
+
+        assert len(set(urls)) == 2
+        assert urls[:2] == urls[2:]
+        assert all(url.startswith("http://127.0.0.1:") for url in urls)
+        assert pool.processes == []
+
+    def test_picoweb_arguments(self, fake_bin):
+        """Servers should only listen on the loopback interface."""
+        pool = LocalServerPool(fake_bin, 1, start_timeout=20)
+        try:
+            pool.start()
+            port = pool.urls[0].split(":")[2].split("/")[0]
+            assert pool.processes[0].args[-1] == f"-picoweb:{port}:127.0.0.1"
+        finally:
+            pool.close()
+
+    def test_exited_server_raises(self):
+        """A server that exits during startup should fail the start."""
+        pool = LocalServerPool([sys.executable, "-c", "import sys; sys.exit(3)"], 1, start_timeout=20)
+        with pytest.raises(Exception, match="exited with code 3"):
+            pool.start()
+        assert pool.processes == []
+
+    def test_start_timeout(self):
+        """A server that never answers should fail the start."""
+        pool = LocalServerPool([sys.executable, "-c", "import time; time.sleep(30)"], 1, start_timeout=0.3)
+        with pytest.raises(Exception, match="did not start in time"):
+            pool.start()
+        assert pool.processes == []
+
+    def test_failed_start_raised_for_every_request(self):
+        """After a failed start, waiting requests should get the error instead of an empty list."""
+        pool = LocalServerPool([sys.executable, "-c", "import sys; sys.exit(3)"], 1, start_timeout=20)
+        pool.launch()
+        for _ in range(2):
+            with pytest.raises(Exception, match="exited with code 3"):
+                pool.next_url()
+        assert not pool.alive()
+
+
+class TestPluginLocalServer:
+    """Tests for render: local-server in BuildPlantumlPlugin."""
+
+    @pytest.fixture
+    def local_server_plugin(self, plugin, fake_bin):
+        plugin.config["render"] = "local-server"
+        plugin.config["bin_path"] = " ".join(fake_bin)
+        yield plugin
+        plugin.on_shutdown()
+
+    def test_renders_through_local_server(self, local_server_plugin, tmp_path):
+        """_convert should fetch the image from the local server."""
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.out_dir = str(tmp_path / "out")
+        diagram.out_file = str(tmp_path / "out" / "test.png")
+        diagram.b64encoded = "SyfFKj2rKt3CoKnELR1Io4ZDoSa70000"
+        diagram.src_time = 1000.0
+
+        local_server_plugin._convert(diagram)
+
+        port = local_server_plugin.local_servers.urls[0].split(":")[2].split("/")[0]
+        assert (tmp_path / "out" / "test.png").read_bytes() == (
+            f"{port} /plantuml/png/SyfFKj2rKt3CoKnELR1Io4ZDoSa70000".encode()
+        )
+
+    def test_dark_variant_rendered(self, local_server_plugin, tmp_path):
+        """Unlike render: local, the dark variant should be rendered too."""
+        local_server_plugin.config["theme_enabled"] = True
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.out_dir = str(tmp_path / "out")
+        diagram.out_file_dark = str(tmp_path / "out" / "test_dark.png")
+        diagram.b64encoded = "DarkContent"
+        diagram.src_time = 1000.0
+
+        with patch.object(local_server_plugin, "_call_server") as mock_server:
+            local_server_plugin._convert(diagram, True)
+            mock_server.assert_called_once_with(diagram, diagram.out_file_dark)
+
+    def test_servers_kept_between_builds(self, local_server_plugin, tmp_path, monkeypatch):
+        """Rebuilds should reuse the running servers, shutdown should stop them."""
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        (src / "a.puml").write_text("@startuml\nactor A\n@enduml\n")
+        local_server_plugin.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+
+        local_server_plugin.on_pre_build({})
+        servers = local_server_plugin.local_servers
+        processes = list(servers.processes)
+        (src / "a.puml").write_text("@startuml\nactor B\n@enduml\n")
+        os.utime(src / "a.puml", (4000000000, 4000000000))
+        local_server_plugin.on_pre_build({})
+        assert local_server_plugin.local_servers is servers
+
+        local_server_plugin.on_shutdown()
+        assert local_server_plugin.local_servers is None
+        assert all(process.poll() is not None for process in processes)
+
+    def test_not_started_without_stale_diagrams(self, local_server_plugin, tmp_path, monkeypatch):
+        """A build with nothing to render should not start any JVM."""
+        (tmp_path / "diagrams" / "src").mkdir(parents=True)
+        local_server_plugin.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.Popen") as mock_popen:
+            local_server_plugin.on_pre_build({})
+        mock_popen.assert_not_called()
+        assert local_server_plugin.local_servers is None
+
+    def test_launched_once_for_threads(self, local_server_plugin):
+        """Render threads asking for a URL at the same time should share one start."""
+        with patch.object(LocalServerPool, "launch") as mock_launch:
+            with patch.object(LocalServerPool, "alive", return_value=True):
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    pools = list(executor.map(lambda _: local_server_plugin._local_servers(), range(8)))
+        assert mock_launch.call_count == 1
+        assert len({id(pool) for pool in pools}) == 1
+
+    def test_dead_server_restarted(self, local_server_plugin):
+        """A server that died should be replaced on the next use."""
+        servers = local_server_plugin._local_servers()
+        servers.processes[0].kill()
+        servers.processes[0].wait()
+
+        assert local_server_plugin._local_servers() is not servers
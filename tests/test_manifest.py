@@ -0,0 +1,178 @@
+"""Tests for the persistent build manifest."""
+import json
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import BuildManifest, DependencyGraph, PuElement
+
+
+@pytest.fixture
+def manifest_plugin(plugin, diagram_tree):
+    plugin.config["manifest_file"] = ".plantuml/manifest.json"
+    return plugin
+
+
+class TestBuildManifest:
+    """Tests for the BuildManifest store."""
+
+    def _diagram(self, tmp_path):
+        src = tmp_path / "a.puml"
+        src.write_text("@startuml\n@enduml\n")
+        out = tmp_path / "a.png"
+        out.write_bytes(b"image")
+        diagram = PuElement("a.puml", str(tmp_path))
+        diagram.out_file = str(out)
+        diagram.content_hash = "abc"
+        return diagram
+
+    def test_round_trip(self, tmp_path):
+        """A recorded diagram should be fresh after reloading the manifest."""
+        diagram = self._diagram(tmp_path)
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(diagram, False)
+        manifest.save()
+
+        reloaded = BuildManifest(tmp_path / "manifest.json", "fp")
+        assert reloaded.is_fresh(str(tmp_path / "a.puml"))
+
+    def test_other_fingerprint_ignored(self, tmp_path):
+        """A manifest written with other settings should be discarded."""
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(self._diagram(tmp_path), False)
+        manifest.save()
+
+        assert BuildManifest(tmp_path / "manifest.json", "other").entries == {}
+
+    def test_unchanged_manifest_not_rewritten(self, tmp_path):
+        """Saving the same entries again should keep the file and its mtime."""
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(self._diagram(tmp_path), False)
+        manifest.save()
+        os.utime(tmp_path / "manifest.json", (1000, 1000))
+
+        manifest.keep(str(tmp_path / "a.puml"))
+        manifest.save()
+        assert (tmp_path / "manifest.json").stat().st_mtime == 1000
+
+    def test_changed_source_not_fresh(self, tmp_path):
+        """Touching the source should invalidate the entry."""
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(self._diagram(tmp_path), False)
+        manifest.save()
+
+        os.utime(tmp_path / "a.puml", (1, 1))
+        assert not manifest.is_fresh(str(tmp_path / "a.puml"))
+
+    def test_missing_output_not_fresh(self, tmp_path):
+        """A deleted output should invalidate the entry."""
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(self._diagram(tmp_path), False)
+        manifest.save()
+
+        (tmp_path / "a.png").unlink()
+        assert not manifest.is_fresh(str(tmp_path / "a.puml"))
+
+    def test_changed_include_marks_dependents_dirty(self, tmp_path):
+        """begin() should mark every diagram whose include changed."""
+        include = tmp_path / "theme.puml"
+        include.write_text("' theme\n")
+        diagram = self._diagram(tmp_path)
+        diagram.includes = {str(include): include.stat().st_mtime}
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(diagram, False)
+        manifest.save()
+
+        graph = DependencyGraph()
+        graph.update(str(tmp_path / "a.puml"), diagram.includes)
+        manifest.begin(graph)
+        assert manifest.is_fresh(str(tmp_path / "a.puml"))
+
+        os.utime(include, (1, 1))
+        manifest.begin(graph)
+        assert not manifest.is_fresh(str(tmp_path / "a.puml"))
+
+    def test_corrupt_file_ignored(self, tmp_path):
+        """An unreadable manifest should start empty."""
+        (tmp_path / "manifest.json").write_text("{not json")
+        assert BuildManifest(tmp_path / "manifest.json", "fp").entries == {}
+
+    def test_unseen_entries_dropped(self, tmp_path):
+        """Diagrams not seen in a build should be removed on save."""
+        manifest = BuildManifest(tmp_path / "manifest.json", "fp")
+        manifest.record(self._diagram(tmp_path), False)
+        manifest.save()
+        manifest.begin(DependencyGraph())
+        manifest.save()
+
+        data = json.loads((tmp_path / "manifest.json").read_text())
+        assert data["diagrams"] == {}
+
+
+class TestPluginManifest:
+    """Tests for the manifest integration in on_pre_build."""
+
+    def test_records_includes_and_outputs(self, manifest_plugin, diagram_tree, fake_render):
+        """The manifest should list includes, outputs and a content hash."""
+        with patch.object(manifest_plugin, "_call_server", side_effect=fake_render):
+            manifest_plugin.on_pre_build({})
+
+        data = json.loads((diagram_tree.parent / ".plantuml" / "manifest.json").read_text())
+        entry = data["diagrams"][str(diagram_tree / "src" / "a.puml")]
+        assert list(entry["includes"]) == [str((diagram_tree / "include" / "style.puml").resolve())]
+        assert entry["outputs"] == [str(diagram_tree / "out" / "a.png")]
+        assert len(entry["hash"]) == 64
+
+    def test_unchanged_tree_not_read(self, manifest_plugin, diagram_tree, fake_render):
+        """A second build should not open any source file."""
+        with patch.object(manifest_plugin, "_call_server", side_effect=fake_render):
+            manifest_plugin.on_pre_build({})
+
+        with patch.object(manifest_plugin, "_readFile") as mock_read:
+            with patch.object(manifest_plugin, "_search_start_tag") as mock_search:
+                manifest_plugin.on_pre_build({})
+                mock_read.assert_not_called()
+                mock_search.assert_not_called()
+
+    def test_changed_include_rebuilds_dependent(self, manifest_plugin, diagram_tree, fake_render):
+        """Touching an include should only re-process the diagrams using it."""
+        with patch.object(manifest_plugin, "_call_server", side_effect=fake_render):
+            manifest_plugin.on_pre_build({})
+
+        include = diagram_tree / "include" / "style.puml"
+        stat = include.stat()
+        os.utime(include, (stat.st_atime, stat.st_mtime + 10))
+
+        with patch.object(manifest_plugin, "_call_server", side_effect=fake_render) as mock_server:
+            manifest_plugin.on_pre_build({})
+
+        rendered = [Path(args[1]).name for args, _ in mock_server.call_args_list]
+        assert rendered == ["a.png"]
+
+    def test_manifest_loaded_from_disk(self, manifest_plugin, diagram_tree, fake_render):
+        """A new plugin instance should pick up the manifest of an earlier build."""
+        with patch.object(manifest_plugin, "_call_server", side_effect=fake_render):
+            manifest_plugin.on_pre_build({})
+
+        manifest_plugin.manifest = None
+        with patch.object(manifest_plugin, "_readFile") as mock_read:
+            manifest_plugin.on_pre_build({})
+            mock_read.assert_not_called()
+
+    def test_failed_render_retried(self, manifest_plugin, diagram_tree):
+        """A diagram PlantUML failed on should not be recorded as current."""
+        manifest_plugin.config["render"] = "local"
+        (diagram_tree / "out").mkdir()
+        (diagram_tree / "out" / "b.png").write_bytes(b"old image")
+        os.utime(diagram_tree / "out" / "b.png", (1000, 1000))
+        (diagram_tree / "out" / "a.png").write_bytes(b"image")
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", return_value=1) as mock_call:
+            manifest_plugin.on_pre_build({})
+            manifest_plugin.manifest = None
+            manifest_plugin.on_pre_build({})
+
+        assert mock_call.call_count == 2
+        data = json.loads((diagram_tree.parent / ".plantuml" / "manifest.json").read_text())
+        assert list(data["diagrams"]) == [str(diagram_tree / "src" / "a.puml")]
@@ -0,0 +1,112 @@
+"""Tests for rendering several output formats from one expansion."""
+import json
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+
+@pytest.fixture
+def project(diagram_tree):
+    """The output folder of diagram_tree, with b.puml named "named"."""
+    (diagram_tree / "src" / "b.puml").write_text("@startuml named\nactor B\n@enduml\n")
+    return diagram_tree / "out"
+
+
+@pytest.fixture
+def formats_plugin(plugin):
+    plugin.config["output_format"] = ["svg", "png"]
+    return plugin
+
+
+def _build(plugin, fake_render):
+    """Builds and returns the requested URLs and the number of expansions"""
+    urls = []
+
+    def fake_server(diagram, out_file):
+        urls.append(plugin._server_url(diagram))
+        fake_render(diagram, out_file)
+
+    with patch.object(plugin, "_call_server", side_effect=fake_server):
+        with patch.object(plugin, "_readFile", wraps=plugin._readFile) as mock_read:
+            plugin.on_pre_build({})
+    return urls, mock_read.call_count
+
+
+class TestOutputFormats:
+    """Tests for a list in output_format."""
+
+    def test_one_expansion_per_diagram(self, formats_plugin, project, fake_render):
+        urls, expansions = _build(formats_plugin, fake_render)
+
+        assert expansions == 2
+        assert sorted(url.split("/")[-2] for url in urls) == ["png", "png", "svg", "svg"]
+        # Both formats are rendered from the same encoded diagram
+        assert len({url.split("/")[-1] for url in urls}) == 2
+        assert sorted(p.name for p in project.iterdir()) == ["a.png", "a.svg", "named.png", "named.svg"]
+
+    def test_staleness_per_format(self, formats_plugin, project, fake_render):
+        """Only the missing format should be rendered again."""
+        _build(formats_plugin, fake_render)
+        (project / "a.svg").unlink()
+
+        urls, _ = _build(formats_plugin, fake_render)
+
+        assert len(urls) == 1
+        assert urls[0].split("/")[-2] == "svg"
+
+    def test_up_to_date_not_expanded(self, formats_plugin, project, fake_render):
+        _build(formats_plugin, fake_render)
+        assert _build(formats_plugin, fake_render) == ([], 0)
+
+    def test_themes_in_every_format(self, formats_plugin, project, fake_render):
+        formats_plugin.config["theme_enabled"] = True
+        themes = project.parent / "themes"
+        themes.mkdir()
+        (themes / "light.puml").write_text("' light\n")
+        (themes / "dark.puml").write_text("' dark\n")
+        (project.parent / "src" / "a.puml").write_text("@startuml\n!include ../themes/light.puml\n@enduml\n")
+
+        _build(formats_plugin, fake_render)
+
+        names = sorted(p.name for p in project.iterdir())
+        assert names == [
+            "a.png", "a.svg", "a_dark.png", "a_dark.svg",
+            "named.png", "named.svg", "named_dark.png", "named_dark.svg",
+        ]
+
+    def test_gzip_only_for_svg(self, formats_plugin, project):
+        headers = []
+        with patch.object(formats_plugin, "_call_server", side_effect=lambda d, o: headers.append(
+            (Path(o).suffix, formats_plugin._request_headers(d)["accept-encoding"])
+        )):
+            formats_plugin.on_pre_build({})
+        assert sorted(set(headers)) == [(".png", "identity"), (".svg", "gzip")]
+
+    def test_manifest_records_every_format(self, formats_plugin, project, fake_render):
+        formats_plugin.config["manifest_file"] = "manifest.json"
+        _build(formats_plugin, fake_render)
+        manifest = json.loads((project.parent.parent / "manifest.json").read_text())
+        outputs = sorted(Path(o).name for entry in manifest["diagrams"].values() for o in entry["outputs"])
+        assert outputs == ["a.png", "a.svg", "named.png", "named.svg"]
+
+    def test_local_run_per_format(self, formats_plugin, project):
+        formats_plugin.config["render"] = "local"
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", return_value=0) as mock_call:
+            formats_plugin.on_pre_build({})
+        flags = sorted(arg for args, _ in mock_call.call_args_list for arg in args[0] if arg.startswith("-t"))
+        assert flags == ["-tpng", "-tsvg"]
+
+    def test_pipe_process_per_format(self, formats_plugin):
+        formats_plugin.config["render"] = "local-pipe"
+        svg = formats_plugin._pipe_renderer("svg")
+        png = formats_plugin._pipe_renderer("png")
+        assert (svg.output_format, png.output_format) == ("svg", "png")
+        assert formats_plugin._pipe_renderer("svg") is svg
+
+    def test_single_format_string(self, plugin):
+        assert plugin._output_formats() == ["png"]
+
+    def test_empty_list(self, formats_plugin):
+        formats_plugin.config["output_format"] = []
+        with pytest.raises(Exception, match="at least one format"):
+            formats_plugin._output_formats()
@@ -0,0 +1,97 @@
+"""Tests for writing the rendered images."""
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from mkdocs_build_plantuml_plugin.plantuml import PuElement
+
+
+@pytest.fixture
+def diagram(tmp_path):
+    diagram = PuElement("a.puml", str(tmp_path))
+    diagram.out_dir = str(tmp_path / "out")
+    diagram.out_files = [str(tmp_path / "out" / "a.png")]
+    return diagram
+
+
+def _age(path, seconds=100):
+    stat = path.stat()
+    os.utime(path, (stat.st_atime - seconds, stat.st_mtime - seconds))
+    return path.stat().st_mtime
+
+
+class TestWriteOutput:
+    """Tests for _write_output and _write_file."""
+
+    def test_writes_through_temporary_file(self, plugin, diagram, tmp_path):
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.replace", wraps=os.replace) as mock_replace:
+            plugin._write_output(diagram, diagram.out_file, b"image")
+
+        assert (tmp_path / "out" / "a.png").read_bytes() == b"image"
+        assert mock_replace.call_args[0][1] == tmp_path / "out" / "a.png"
+        assert os.listdir(tmp_path / "out") == ["a.png"]
+
+    def test_interrupted_write_keeps_old_image(self, plugin, diagram, tmp_path):
+        """A failing stream should neither touch the image nor leave a temporary file."""
+        plugin._write_output(diagram, diagram.out_file, b"old image")
+
+        def broken_stream():
+            yield b"new "
+            raise ConnectionError("connection lost")
+
+        with pytest.raises(ConnectionError):
+            plugin._write_file(tmp_path / "out" / "a.png", broken_stream())
+
+        assert (tmp_path / "out" / "a.png").read_bytes() == b"old image"
+        assert os.listdir(tmp_path / "out") == ["a.png"]
+
+    def test_chunks_streamed(self, plugin, tmp_path):
+        target = tmp_path / "out" / "b.svg"
+        assert plugin._write_file(target, iter([b"<svg>", b"</svg>"]))
+        assert target.read_bytes() == b"<svg></svg>"
+
+    def test_identical_content_not_written(self, plugin, diagram, tmp_path):
+        """The same bytes should not replace the file, only its mtime is updated."""
+        target = tmp_path / "out" / "a.png"
+        plugin._write_output(diagram, diagram.out_file, b"image")
+        inode = target.stat().st_ino
+        old_mtime = _age(target)
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.replace") as mock_replace:
+            assert not plugin._write_file(target, b"image")
+            assert not plugin._write_file(target, iter([b"ima", b"ge"]))
+        mock_replace.assert_not_called()
+        assert target.stat().st_ino == inode
+        assert target.stat().st_mtime > old_mtime
+        assert os.listdir(tmp_path / "out") == ["a.png"]
+
+    def test_identical_content_under_serve(self, plugin, diagram, tmp_path):
+        """Under mkdocs serve the mtime should stay, the image still counts as current."""
+        plugin.serve_server = MagicMock()
+        target = tmp_path / "out" / "a.png"
+        plugin._write_output(diagram, diagram.out_file, b"image")
+        old_mtime = _age(target)
+        (tmp_path / "a.puml").write_text("@startuml\n@enduml\n")
+
+        plugin._write_output(diagram, diagram.out_file, b"image")
+
+        assert target.stat().st_mtime == old_mtime
+        plugin._build_mtimes(diagram)
+        assert diagram.img_time >= diagram.src_time
+
+    def test_output_folder_created_once(self, plugin, diagram, tmp_path):
+        """mkdir should only run for the first image in a folder."""
+        with patch.object(Path, "mkdir", autospec=True, side_effect=Path.mkdir) as mock_mkdir:
+            for name in ["a.png", "b.png", "c.png"]:
+                plugin._write_output(diagram, str(tmp_path / "out" / name), name.encode())
+        assert mock_mkdir.call_count == 1
+        assert (tmp_path / "out" / "c.png").read_bytes() == b"c.png"
+
+    def test_theme_copy_atomic(self, plugin, tmp_path):
+        """The copy of the light image should go through the same writer."""
+        (tmp_path / "a.png").write_bytes(b"light")
+        with patch.object(plugin, "_write_file", wraps=plugin._write_file) as mock_write:
+            plugin._copy_output(str(tmp_path / "a.png"), str(tmp_path / "a_dark.png"))
+        assert mock_write.call_count == 1
+        assert (tmp_path / "a_dark.png").read_bytes() == b"light"
@@ -0,0 +1,185 @@
+"""Tests for the long-lived PlantUML process in -pipe mode."""
+import os
+import subprocess
+import sys
+import pytest
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import PipeRenderer, PuElement
+
+# Behaves like `plantuml -pipe -pipedelimitor X`: one "image" per diagram, followed by X.
+# A diagram containing "crash" kills the process once (a marker file remembers it),
+# one containing "hang" is never answered.
+FAKE_PLANTUML = r'''
+import sys
+args = sys.argv[1:]
+delimiter = args[args.index("-pipedelimitor") + 1].encode()
+fmt = [a for a in args if a.startswith("-t")][0][2:].encode()
+marker = args[0]
+lines = []
+for line in sys.stdin.buffer:
+    lines.append(line)
+    if line.strip() == b"@enduml":
+        source = b"".join(lines)
+        lines = []
+        if b"hang" in source:
+            continue
+        if b"crash" in source:
+            try:
+                open(marker, "x").close()
+                sys.exit(1)
+            except FileExistsError:
+                pass
+        sys.stdout.buffer.write(fmt + b":" + source + delimiter + b"\n")
+        sys.stdout.buffer.flush()
+'''
+
+
+@pytest.fixture
+def fake_bin(tmp_path):
+    script = tmp_path / "fake_plantuml.py"
+    script.write_text(FAKE_PLANTUML)
+    return [sys.executable, str(script), str(tmp_path / "crashed")]
+
+
+class TestPipeRenderer:
+    """Tests for PipeRenderer."""
+
+    def test_renders_diagrams_in_sequence(self, fake_bin):
+        """Every diagram should get its own image from the same process."""
+        renderer = PipeRenderer(fake_bin, "png")
+        try:
+            first = renderer.render("@startuml\nactor A\n@enduml\n")
+            process = renderer.process
+            second = renderer.render("@startuml\nactor B\n@enduml")
+        finally:
+            renderer.close()
+
+        assert first == b"png:@startuml\nactor A\n@enduml\n"
+        assert second == b"png:@startuml\nactor B\n@enduml\n"
+        assert renderer.process is None
+        assert process.returncode == 0
+
+    def test_process_reused(self, fake_bin):
+        """The JVM should only be started once."""
+        renderer = PipeRenderer(fake_bin, "svg")
+        try:
+            with patch("mkdocs_build_plantuml_plugin.plantuml.Popen", wraps=subprocess.Popen) as mock_popen:
+                for i in range(3):
+                    renderer.render(f"@startuml\nactor A{i}\n@enduml\n")
+        finally:
+            renderer.close()
+
+        assert mock_popen.call_count == 1
+        assert "-pipe" in mock_popen.call_args[0][0]
+        assert "-tsvg" in mock_popen.call_args[0][0]
+
+    def test_restarts_after_crash(self, fake_bin):
+        """A crashed process should be replaced and the diagram retried."""
+        renderer = PipeRenderer(fake_bin, "png")
+        try:
+            renderer.render("@startuml\nactor A\n@enduml\n")
+            image = renderer.render("@startuml\nactor crash\n@enduml\n")
+        finally:
+            renderer.close()
+
+        assert image == b"png:@startuml\nactor crash\n@enduml\n"
+
+    def test_only_first_block_sent(self, fake_bin):
+        """A second block in the source should not become the image of the next diagram."""
+        renderer = PipeRenderer(fake_bin, "png")
+        try:
+            first = renderer.render("@startuml\nactor A\n@enduml\n@startuml\nactor B\n@enduml\n")
+            second = renderer.render("@startuml\nactor C\n@enduml\n")
+        finally:
+            renderer.close()
+
+        assert first == b"png:@startuml\nactor A\n@enduml\n"
+        assert second == b"png:@startuml\nactor C\n@enduml\n"
+
+    def test_source_without_block_skipped(self, fake_bin):
+        """Without @startuml ... @enduml nothing should be sent, PlantUML would wait forever."""
+        renderer = PipeRenderer(fake_bin, "png")
+        with patch("mkdocs_build_plantuml_plugin.plantuml.Popen") as mock_popen:
+            assert renderer.render("just some notes\n") is None
+            assert renderer.render("@startuml\nactor A\n") is None
+        mock_popen.assert_not_called()
+
+    def test_timeout_restarts_process(self, fake_bin):
+        """A diagram that is never answered should time out and kill the process."""
+        renderer = PipeRenderer(fake_bin, "png", timeout=0.5)
+        try:
+            with pytest.raises(TimeoutError):
+                renderer.render("@startuml\nactor hang\n@enduml\n")
+            assert renderer.process is None
+            image = renderer.render("@startuml\nactor A\n@enduml\n")
+        finally:
+            renderer.close()
+
+        assert image == b"png:@startuml\nactor A\n@enduml\n"
+
+    def test_gives_up_after_second_crash(self):
+        """A diagram crashing every process should raise."""
+        renderer = PipeRenderer([sys.executable, "-c", "import sys; sys.exit(1)"], "png")
+        with pytest.raises(Exception, match="PlantUML process exited"):
+            renderer.render("@startuml\n@enduml\n")
+        assert renderer.process is None
+
+
+class TestPluginPipeRenderer:
+    """Tests for render: local-pipe in BuildPlantumlPlugin."""
+
+    def _stale_diagram(self, tmp_path):
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.out_dir = str(tmp_path / "out")
+        diagram.out_file = str(tmp_path / "out" / "test.png")
+        diagram.concat_file = "@startuml\nactor User\n@enduml\n"
+        diagram.src_time = 1000.0
+        return diagram
+
+    def test_convert_writes_image(self, plugin, tmp_path, fake_bin):
+        """_convert should write what the process returned."""
+        plugin.config["render"] = "local-pipe"
+        plugin.config["bin_path"] = " ".join(fake_bin)
+        try:
+            with patch("mkdocs_build_plantuml_plugin.plantuml.call") as mock_call:
+                plugin._convert(self._stale_diagram(tmp_path))
+                mock_call.assert_not_called()
+        finally:
+            plugin.on_shutdown()
+
+        assert (tmp_path / "out" / "test.png").read_bytes() == b"png:@startuml\nactor User\n@enduml\n"
+        assert plugin.pipe_renderers == {}
+
+    def test_process_kept_between_builds(self, plugin, tmp_path, fake_bin, monkeypatch):
+        """Rebuilds should reuse the running process."""
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        (src / "a.puml").write_text("@startuml\nactor A\n@enduml\n")
+        plugin.config["render"] = "local-pipe"
+        plugin.config["bin_path"] = " ".join(fake_bin)
+        plugin.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+
+        try:
+            plugin.on_pre_build({})
+            renderer = plugin.pipe_renderers["png"]
+            process = renderer.process
+            (src / "a.puml").write_text("@startuml\nactor B\n@enduml\n")
+            os.utime(src / "a.puml", (4000000000, 4000000000))
+            plugin.on_pre_build({})
+
+            assert plugin.pipe_renderers["png"] is renderer
+            assert renderer.process is process
+        finally:
+            plugin.on_shutdown()
+
+        assert (tmp_path / "diagrams" / "out" / "a.png").read_bytes().endswith(b"actor B\n@enduml\n")
+
+    def test_format_change_restarts(self, plugin, fake_bin):
+        """Another output format should replace the process."""
+        plugin.config["render"] = "local-pipe"
+        plugin.config["bin_path"] = " ".join(fake_bin)
+        first = plugin._pipe_renderer()
+        plugin.config["output_format"] = "svg"
+        assert plugin._pipe_renderer() is not first
@@ -0,0 +1,107 @@
+"""Tests for profiling the builds of the plugin."""
+import json
+import pstats
+import tracemalloc
+import pytest
+from unittest.mock import MagicMock, patch
+
+from mkdocs_build_plantuml_plugin.plantuml import LocalBatch
+
+_RENDER_CODE = LocalBatch._render.__code__
+
+
+@pytest.fixture
+def project(diagram_tree, monkeypatch):
+    """The working directory, without profiling from the environment."""
+    monkeypatch.delenv("MKDOCS_PLANTUML_PROFILE", raising=False)
+    return diagram_tree.parent
+
+
+@pytest.fixture
+def profiled_plugin(plugin, project):
+    plugin.config["profile_dir"] = "profiles"
+    return plugin
+
+
+def _build(plugin):
+    with patch("httplib2.Http") as mock_http_class:
+        mock_http_class.return_value.request.return_value = (MagicMock(status=200), b"image")
+        plugin.on_pre_build({})
+
+
+def _files(project, pattern):
+    return sorted((project / "profiles").glob(pattern))
+
+
+class TestProfiling:
+    """Tests for profile_dir and profile_samples."""
+
+    def test_off_by_default(self, plugin, project):
+        """Without profile_dir nothing should be profiled."""
+        with patch("mkdocs_build_plantuml_plugin.plantuml.cProfile.Profile") as mock_profile:
+            _build(plugin)
+        mock_profile.assert_not_called()
+        assert not (project / "profiles").exists()
+
+    def test_stats_and_snapshot_per_build(self, profiled_plugin, project):
+        """Every build should write its own stats and memory snapshot."""
+        _build(profiled_plugin)
+        _build(profiled_plugin)
+
+        stats_files = _files(project, "*.pstats")
+        assert len(stats_files) == 2
+        functions = {name for _, _, name in pstats.Stats(str(stats_files[0])).stats}
+        assert "_process_file" in functions
+        assert "on_pre_build" not in functions
+
+        snapshots = _files(project, "*.tracemalloc")
+        assert len(snapshots) == 2
+        tracemalloc.Snapshot.load(str(snapshots[0]))
+        assert not tracemalloc.is_tracing()
+        assert _files(project, "*.samples.jsonl") == []
+
+    def test_env_variable(self, plugin, project, monkeypatch):
+        """MKDOCS_PLANTUML_PROFILE should turn profiling on without the config."""
+        monkeypatch.setenv("MKDOCS_PLANTUML_PROFILE", "profiles")
+        _build(plugin)
+        assert len(_files(project, "*.pstats")) == 1
+
+    def test_samples(self, profiled_plugin, project):
+        """The sampled methods should be timed per call and restored afterwards."""
+        profiled_plugin.config["profile_samples"] = True
+        profiled_plugin.config["workers"] = 2
+        _build(profiled_plugin)
+
+        [samples] = _files(project, "*.samples.jsonl")
+        records = [json.loads(line) for line in samples.read_text().splitlines()]
+        calls = sorted((r["function"], r["diagram"].rsplit("/", 1)[-1]) for r in records)
+        assert calls == [
+            ("_call_server", "a.puml"), ("_call_server", "b.puml"),
+            ("_expand_incl_line_file", "a.puml"),
+            ("_readFile", "a.puml"), ("_readFile", "b.puml"),
+        ]
+        assert all(r["seconds"] >= 0 for r in records)
+        assert "_call_server" not in profiled_plugin.__dict__
+
+    def test_samples_local_batch(self, profiled_plugin, project):
+        """Every PlantUML run of render: local should be sampled with its diagrams."""
+        profiled_plugin.config["profile_samples"] = True
+        profiled_plugin.config["render"] = "local"
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", return_value=0):
+            profiled_plugin.on_pre_build({})
+
+        [samples] = _files(project, "*.samples.jsonl")
+        records = [json.loads(line) for line in samples.read_text().splitlines()]
+        [run] = [r for r in records if r["function"] == "_render"]
+        assert run["diagram"] is None
+        assert sorted(d.rsplit("/", 1)[-1] for d in run["diagrams"]) == ["a.puml", "b.puml"]
+        assert "_render" in LocalBatch.__dict__
+        assert LocalBatch._render.__code__ is _RENDER_CODE
+
+    def test_patched_method_kept(self, profiled_plugin, project):
+        """A method patched on the instance should be there again after the build."""
+        profiled_plugin.config["profile_samples"] = True
+        with patch.object(profiled_plugin, "_call_server") as mock_server:
+            profiled_plugin.on_pre_build({})
+            assert profiled_plugin._call_server is mock_server
+        assert mock_server.call_count == 2
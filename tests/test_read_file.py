@@ -1,9 +1,12 @@
 """Tests for _readFile function."""
 import pytest
 from pathlib import Path
+import base64
 import string
+import zlib
+from unittest.mock import patch
 
-from mkdocs_build_plantuml_plugin.plantuml import PuElement, plantuml_alphabet
+from mkdocs_build_plantuml_plugin.plantuml import PuElement, plantuml_alphabet, b64_to_plantuml
 
 
 class TestReadFile:
@@ -148,3 +151,50 @@ class TestReadFile:
         plugin._readFile(diagram2, False)
 
         assert diagram1.b64encoded == diagram2.b64encoded
+
+    def test_streaming_encoding_matches_one_shot(self, plugin, tmp_path):
+        """Incremental compression should give the same result as zlib.compress."""
+        include_file = tmp_path / "big.puml"
+        include_file.write_text("".join(f"skinparam Item{i} #{i:06d}\n" for i in range(10000)))
+        puml_content = "@startuml\n!include big.puml\nactor User\n@enduml\n"
+
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.root_dir = str(tmp_path)
+        diagram.src_file = puml_content.splitlines(keepends=True)
+
+        plugin._readFile(diagram, False)
+
+        expected = (
+            base64.b64encode(zlib.compress(diagram.concat_file.encode("utf-8"))[2:-4])
+            .translate(b64_to_plantuml)
+            .decode("utf-8")
+        )
+        assert diagram.b64encoded == expected
+        assert diagram.concat_file.count("\n") == 10004
+
+    def test_expansion_streamed_into_encoder(self, plugin, tmp_path):
+        """Without themes every chunk should be hashed before the next one is expanded."""
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.root_dir = str(tmp_path)
+        diagram.src_file = ["@startuml\n", "actor A\n", "actor B\n", "@enduml\n"]
+        updates = []
+
+        def expand(lines, *args):
+            for line in lines:
+                yield line
+                assert len(updates) == diagram.src_file.index(line) + 1
+
+        class Digest:
+            def update(self, data):
+                updates.append(data)
+
+            def hexdigest(self):
+                return "hash"
+
+        with patch.object(plugin, "_expand", side_effect=expand), \
+                patch("hashlib.sha256", return_value=Digest()):
+            plugin._readFile(diagram, False)
+
+        assert len(updates) == 4
+        assert diagram.template is None
+        assert diagram.concat_file == "".join(diagram.src_file)
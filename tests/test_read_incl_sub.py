@@ -1,12 +1,19 @@
-"""Tests for _read_incl_sub function."""
+"""Tests for _expand_incl_sub function."""
+import os
 import pytest
 from pathlib import Path
+from unittest.mock import patch
 
 from mkdocs_build_plantuml_plugin.plantuml import PuElement
 
 
+def _expand_sub(plugin, diagram, variant, inc_file_abs, inc_sub_name):
+    """Returns the text of an expanded !includesub"""
+    return "".join(plugin._select(plugin._expand_incl_sub(diagram, variant, inc_file_abs, inc_sub_name), variant))
+
+
 class TestReadInclSub:
-    """Tests for BuildPlantumlPlugin._read_incl_sub method."""
+    """Tests for BuildPlantumlPlugin._expand_incl_sub method."""
 
     def test_extracts_sub_content(self, plugin, tmp_path):
         """Content between !startsub and !endsub should be extracted."""
@@ -24,11 +31,8 @@ skinparam class {
 
         diagram = PuElement("test.puml", str(tmp_path))
         diagram.inc_time = 0
-        temp_file = ""
 
-        result = plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "MYSUB"
-        )
+        result = _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
 
         assert "BackgroundColor Yellow" in result
         # Header and footer should not be included
@@ -47,11 +51,8 @@ actor User
 
         diagram = PuElement("test.puml", str(tmp_path))
         diagram.inc_time = 0
-        temp_file = ""
 
-        result = plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "MYSUB"
-        )
+        result = _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
 
         assert "actor User" in result
 
@@ -66,18 +67,15 @@ content here
 
         diagram = PuElement("test.puml", str(tmp_path))
         diagram.inc_time = 0
-        temp_file = ""
 
-        plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "MYSUB"
-        )
+        _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
 
         # inc_time should be updated to file's mtime
         assert diagram.inc_time > 0
         assert diagram.inc_time == include_file.stat().st_mtime
 
     def test_sub_not_found_empty(self, plugin, tmp_path):
-        """Missing sub should return without the sub content."""
+        """A missing sub should expand to nothing."""
         include_file = tmp_path / "subs.puml"
         include_file.write_text("""
 !startsub OTHERSUB
@@ -87,15 +85,10 @@ other content
 
         diagram = PuElement("test.puml", str(tmp_path))
         diagram.inc_time = 0
-        temp_file = "existing content\n"
 
-        result = plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "NONEXISTENT"
-        )
+        result = _expand_sub(plugin, diagram, False, str(include_file), "NONEXISTENT")
 
-        # Only the existing content should be there
-        assert "existing content" in result
-        assert "other content" not in result
+        assert result == ""
 
     def test_multiple_subs_in_file(self, plugin, tmp_path):
         """Only the requested sub should be extracted."""
@@ -116,11 +109,8 @@ third content
 
         diagram = PuElement("test.puml", str(tmp_path))
         diagram.inc_time = 0
-        temp_file = ""
 
-        result = plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "SECOND"
-        )
+        result = _expand_sub(plugin, diagram, False, str(include_file), "SECOND")
 
         assert "second content" in result
         assert "first content" not in result
@@ -142,11 +132,8 @@ third content
         diagram = PuElement("test.puml", str(tmp_path))
         diagram.root_dir = str(tmp_path)
         diagram.inc_time = 0
-        temp_file = ""
 
-        result = plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "MYSUB"
-        )
+        result = _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
 
         assert "Nested content" in result
 
@@ -158,11 +145,101 @@ third content
         diagram = PuElement("test.puml", str(tmp_path))
         # Set a high initial inc_time
         diagram.inc_time = 9999999999.0
-        temp_file = ""
 
-        plugin._read_incl_sub(
-            diagram, temp_file, False, str(include_file), "MYSUB"
-        )
+        _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
 
         # inc_time should not be decreased
         assert diagram.inc_time == 9999999999.0
+
+    def test_file_parsed_once_for_many_subs(self, plugin, tmp_path):
+        """All subs of a file should come from a single read."""
+        include_file = tmp_path / "subs.puml"
+        include_file.write_text("".join(
+            f"!startsub SUB{i}\ncontent {i}\n!endsub\n" for i in range(20)
+        ))
+
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.inc_time = 0
+
+        opened = []
+        original_open = Path.open
+
+        def recording_open(self, *args, **kwargs):
+            opened.append(self.name)
+            return original_open(self, *args, **kwargs)
+
+        with patch.object(Path, "open", recording_open):
+            results = [
+                _expand_sub(plugin, diagram, False, str(include_file), f"SUB{i}")
+                for i in range(20)
+            ]
+
+        assert opened == ["subs.puml"]
+        assert results[7] == "content 7\n"
+
+    def test_index_refreshed_when_file_changes(self, plugin, tmp_path):
+        """A newer mtime should re-read the file."""
+        include_file = tmp_path / "subs.puml"
+        include_file.write_text("!startsub MYSUB\nold\n!endsub\n")
+
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.inc_time = 0
+        _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
+
+        include_file.write_text("!startsub MYSUB\nnew\n!endsub\n")
+        stat = include_file.stat()
+        os.utime(include_file, (stat.st_atime, stat.st_mtime + 10))
+
+        result = _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
+        assert result == "new\n"
+
+    def test_nested_startsub_is_content_of_outer(self, plugin, tmp_path):
+        """A !startsub inside another sub belongs to the outer sub's content."""
+        include_file = tmp_path / "subs.puml"
+        include_file.write_text("""!startsub OUTER
+outer line
+!startsub INNER
+inner line
+!endsub
+after
+""")
+
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.inc_time = 0
+
+        outer = _expand_sub(plugin, diagram, False, str(include_file), "OUTER")
+        inner = _expand_sub(plugin, diagram, False, str(include_file), "INNER")
+
+        assert outer == "outer line\n!startsub INNER\ninner line\n"
+        assert inner == "inner line\n"
+
+    def test_repeated_sub_concatenated(self, plugin, tmp_path):
+        """A sub name used twice should collect both blocks."""
+        include_file = tmp_path / "subs.puml"
+        include_file.write_text("""!startsub MYSUB
+first
+!endsub
+!startsub MYSUB
+second
+!endsub
+""")
+
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.inc_time = 0
+
+        result = _expand_sub(plugin, diagram, False, str(include_file), "MYSUB")
+        assert result == "first\nsecond\n"
+
+    def test_root_fallback_records_only_found_file(self, plugin, tmp_path):
+        """A missing primary location should not be recorded as an include."""
+        (tmp_path / "lib").mkdir()
+        (tmp_path / "lib" / "lib.puml").write_text("!startsub S\nactor Lib\n!endsub\n")
+        (tmp_path / "src" / "sub").mkdir(parents=True)
+
+        diagram = PuElement("a.puml", str(tmp_path / "src" / "sub"))
+        diagram.root_dir = str(tmp_path)
+        diagram.src_file = ["@startuml\n", "!includesub lib/lib.puml!S\n", "@enduml\n"]
+        plugin._readFile(diagram, False)
+
+        assert "actor Lib" in diagram.concat_file
+        assert list(diagram.includes) == [str((tmp_path / "lib" / "lib.puml").resolve())]
@@ -1,12 +1,17 @@
-"""Tests for _readIncludeLine function."""
+"""Tests for _expand_include_line function."""
 import pytest
 from pathlib import Path
 
 from mkdocs_build_plantuml_plugin.plantuml import PuElement
 
 
+def _expand_line(plugin, diagram, line, directory, variant):
+    """Returns the text of an expanded include line"""
+    return "".join(plugin._select(plugin._expand_include_line(diagram, line, directory, variant), variant))
+
+
 class TestReadIncludeLine:
-    """Tests for BuildPlantumlPlugin._readIncludeLine method."""
+    """Tests for BuildPlantumlPlugin._expand_include_line method."""
 
     def test_includeurl_passthrough(self, plugin, tmp_path):
         """!includeurl with URL should be passed through unchanged."""
@@ -15,9 +20,8 @@ class TestReadIncludeLine:
         diagram.inc_time = 0
 
         line = "!includeurl http://example.com/theme.puml"
-        temp_file = ""
 
-        result = plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+        result = _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert line in result
 
@@ -34,9 +38,8 @@ class TestReadIncludeLine:
         diagram.inc_time = 0
 
         line = "!include themes/light.puml"
-        temp_file = ""
 
-        result = plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+        result = _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "skinparam backgroundColor white" in result
 
@@ -47,9 +50,8 @@ class TestReadIncludeLine:
         diagram.inc_time = 0
 
         line = "!include http://example.com/theme.puml"
-        temp_file = ""
 
-        result = plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+        result = _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "!include http://example.com/theme.puml" in result
 
@@ -60,9 +62,8 @@ class TestReadIncludeLine:
         diagram.inc_time = 0
 
         line = "!include <C4/C4_Container>"
-        temp_file = ""
 
-        result = plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+        result = _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "!include <C4/C4_Container>" in result
 
@@ -73,10 +74,9 @@ class TestReadIncludeLine:
         diagram.inc_time = 0
 
         line = "!include nonexistent.puml"
-        temp_file = ""
 
         with pytest.raises(Exception) as exc_info:
-            plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+            _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "Include could not be resolved" in str(exc_info.value)
 
@@ -97,9 +97,8 @@ skinparam class {
         diagram.inc_time = 0
 
         line = "!includesub subs.puml!MYSUBNAME"
-        temp_file = ""
 
-        result = plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+        result = _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "BackgroundColor Yellow" in result
 
@@ -111,10 +110,9 @@ skinparam class {
 
         # Missing the ! separator between file and sub name
         line = "!includesub subs.puml"
-        temp_file = ""
 
         with pytest.raises(Exception) as exc_info:
-            plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+            _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "Invalid !includesub syntax" in str(exc_info.value)
 
@@ -134,9 +132,8 @@ skinparam class {
         diagram.inc_time = 0
 
         line = "!include themes/light.puml"
-        temp_file = ""
 
-        result = plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), True)
+        result = _expand_line(plugin, diagram, line, str(tmp_path), True)
 
         # Should have dark theme content, not light
         assert "skinparam dark true" in result
@@ -149,10 +146,9 @@ skinparam class {
 
         # Invalid include line (no matching pattern)
         line = "!include"
-        temp_file = ""
 
         with pytest.raises(Exception) as exc_info:
-            plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+            _expand_line(plugin, diagram, line, str(tmp_path), False)
 
         assert "Unknown include type" in str(exc_info.value)
 
@@ -167,9 +163,8 @@ skinparam class {
         diagram.inc_time = 0
 
         line = "!include include.puml"
-        temp_file = ""
 
-        plugin._readIncludeLine(diagram, line, temp_file, str(tmp_path), False)
+        _expand_line(plugin, diagram, line, str(tmp_path), False)
 
-        # inc_time should be updated via _read_incl_line_file
+        # inc_time should be updated via _expand_incl_line_file
         assert diagram.inc_time > 0
@@ -0,0 +1,182 @@
+"""Tests for the content addressed render cache."""
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+from mkdocs_build_plantuml_plugin.plantuml import PuElement, RenderCache
+
+
+class TestRenderCache:
+    """Tests for the RenderCache store."""
+
+    def test_key_depends_on_all_parts(self):
+        """Changing any part should change the key."""
+        base = RenderCache.key("@startuml\n@enduml\n", "png", "server", "light.puml")
+        assert base == RenderCache.key("@startuml\n@enduml\n", "png", "server", "light.puml")
+        assert base != RenderCache.key("@startuml\n@enduml\n", "svg", "server", "light.puml")
+        assert base != RenderCache.key("@startuml\n@enduml\n", "png", "server", "dark.puml")
+        # Parts are separated, so moving characters between them is a different key
+        assert RenderCache.key("ab", "c") != RenderCache.key("a", "bc")
+
+    def test_store_and_restore(self, tmp_path):
+        """A stored image should be restored to another location."""
+        cache = RenderCache(tmp_path / "cache", 1024)
+        image = tmp_path / "image.png"
+        image.write_bytes(b"PNG content")
+
+        cache.store("abcdef", image)
+        target = tmp_path / "out" / "copy.png"
+
+        assert cache.restore("abcdef", target) is True
+        assert target.read_bytes() == b"PNG content"
+
+    def test_restore_miss(self, tmp_path):
+        """An unknown key should not create the target."""
+        cache = RenderCache(tmp_path / "cache", 1024)
+        target = tmp_path / "out.png"
+
+        assert cache.restore("abcdef", target) is False
+        assert not target.exists()
+
+    def test_restored_file_is_not_the_entry(self, tmp_path):
+        """Overwriting a restored file must not change the cache entry."""
+        cache = RenderCache(tmp_path / "cache", 1024)
+        image = tmp_path / "image.png"
+        image.write_bytes(b"PNG content")
+        cache.store("abcdef", image)
+
+        target = tmp_path / "copy.png"
+        cache.restore("abcdef", target)
+        target.write_bytes(b"changed")
+
+        other = tmp_path / "other.png"
+        cache.restore("abcdef", other)
+        assert other.read_bytes() == b"PNG content"
+
+    def test_restore_replaces_link(self, tmp_path):
+        """A target hardlinked to another image should be replaced, not written into."""
+        cache = RenderCache(tmp_path / "cache", 1024)
+        image = tmp_path / "image.png"
+        image.write_bytes(b"PNG content")
+        cache.store("abcdef", image)
+
+        other = tmp_path / "other.png"
+        other.write_bytes(b"other")
+        target = tmp_path / "target.png"
+        os.link(other, target)
+
+        cache.restore("abcdef", target)
+        assert target.read_bytes() == b"PNG content"
+        assert other.read_bytes() == b"other"
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """Oldest entries should go first once the cache is too big."""
+        cache = RenderCache(tmp_path / "cache", 25)
+        image = tmp_path / "image.png"
+        image.write_bytes(b"x" * 10)
+        for i, key in enumerate(["aa1", "bb2", "cc3"]):
+            cache.store(key, image)
+            os.utime(cache._entry(key), (1000 + i, 1000 + i))
+
+        # Using the oldest entry makes it the most recent one
+        cache.restore("aa1", tmp_path / "restored.png")
+        cache.evict()
+
+        assert cache._entry("aa1").exists()
+        assert not cache._entry("bb2").exists()
+        assert cache._entry("cc3").exists()
+
+
+class TestPluginRenderCache:
+    """Tests for the render cache integration in BuildPlantumlPlugin."""
+
+    def _stale_diagram(self, tmp_path):
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.out_dir = str(tmp_path / "out")
+        diagram.out_file = str(tmp_path / "out" / "test.png")
+        diagram.out_file_dark = str(tmp_path / "out" / "test_dark.png")
+        diagram.concat_file = "@startuml\nactor User\n@enduml\n"
+        diagram.b64encoded = "EncodedContent"
+        diagram.src_time = 1000.0
+        return diagram
+
+    def test_miss_renders_and_stores(self, plugin, tmp_path):
+        """A cache miss should call the server and fill the cache."""
+        plugin.render_cache = RenderCache(tmp_path / "cache", 1024 * 1024)
+        diagram = self._stale_diagram(tmp_path)
+
+        with patch('httplib2.Http') as mock_http_class:
+            mock_http_class.return_value.request.return_value = (
+                MagicMock(status=200), b"PNG content"
+            )
+            plugin._convert(diagram, False)
+
+        key = plugin._cache_key(diagram, False)
+        assert plugin.render_cache._entry(key).read_bytes() == b"PNG content"
+
+    def test_hit_skips_server(self, plugin, tmp_path):
+        """A cache hit should restore the image without calling the server."""
+        plugin.render_cache = RenderCache(tmp_path / "cache", 1024 * 1024)
+        diagram = self._stale_diagram(tmp_path)
+        image = tmp_path / "cached.png"
+        image.write_bytes(b"cached PNG")
+        plugin.render_cache.store(plugin._cache_key(diagram, False), image)
+
+        with patch.object(plugin, '_call_server') as mock_server:
+            plugin._convert(diagram, False)
+            mock_server.assert_not_called()
+
+        assert Path(diagram.out_file).read_bytes() == b"cached PNG"
+
+    def test_dark_variant_cached_separately(self, plugin_with_theme, tmp_path):
+        """Light and dark renders must not share an entry."""
+        plugin = plugin_with_theme
+        plugin.render_cache = RenderCache(tmp_path / "cache", 1024 * 1024)
+        diagram = self._stale_diagram(tmp_path)
+        image = tmp_path / "cached.png"
+        image.write_bytes(b"light PNG")
+        plugin.render_cache.store(plugin._cache_key(diagram, False), image)
+
+        with patch.object(plugin, '_call_server') as mock_server:
+            plugin._convert(diagram, True)
+            mock_server.assert_called_once_with(diagram, diagram.out_file_dark)
+
+    def test_error_response_not_cached(self, plugin, tmp_path):
+        """Images from non-200 responses should not be stored."""
+        plugin.render_cache = RenderCache(tmp_path / "cache", 1024 * 1024)
+        diagram = self._stale_diagram(tmp_path)
+
+        with patch('httplib2.Http') as mock_http_class:
+            mock_http_class.return_value.request.return_value = (
+                MagicMock(status=400), b"Error image"
+            )
+            plugin._convert(diagram, False)
+
+        assert not plugin.render_cache._entry(plugin._cache_key(diagram, False)).exists()
+
+    def test_key_depends_on_server(self, plugin, tmp_path):
+        """Another server should not reuse the cached images."""
+        diagram = self._stale_diagram(tmp_path)
+        key = plugin._cache_key(diagram, False)
+        plugin.config["server"] = "https://custom.plantuml.server/api"
+        assert plugin._cache_key(diagram, False) != key
+
+    def test_fresh_checkout_uses_cache(self, plugin, tmp_path, monkeypatch):
+        """Deleting all outputs should be fixed from the cache alone."""
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        (src / "a.puml").write_text("@startuml\nactor A\n@enduml\n")
+        plugin.config["diagram_root"] = "diagrams"
+        plugin.config["cache_dir"] = ".cache"
+        monkeypatch.chdir(tmp_path)
+
+        with patch('httplib2.Http') as mock_http_class:
+            mock_http = mock_http_class.return_value
+            mock_http.request.return_value = (MagicMock(status=200), b"PNG content")
+            plugin.on_pre_build({})
+            (tmp_path / "diagrams" / "out" / "a.png").unlink()
+            plugin.on_pre_build({})
+
+        assert mock_http.request.call_count == 1
+        assert (tmp_path / "diagrams" / "out" / "a.png").read_bytes() == b"PNG content"
@@ -0,0 +1,121 @@
+"""Tests for concurrent server rendering with the RenderPool."""
+import logging
+import threading
+import time
+import pytest
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import PuElement, RenderPool, log
+
+
+def _diagram(tmp_path, name):
+    diagram = PuElement(name, str(tmp_path))
+    diagram.out_dir = str(tmp_path / "out")
+    return diagram
+
+
+class TestRenderPool:
+    """Tests for the RenderPool helper."""
+
+    def test_jobs_run_concurrently(self, tmp_path):
+        """Jobs should overlap instead of running one after another."""
+        barrier = threading.Barrier(4, timeout=5)
+
+        def job(diagram, out_file):
+            barrier.wait()
+
+        pool = RenderPool(4)
+        for i in range(4):
+            pool.submit(job, _diagram(tmp_path, f"d{i}.puml"), f"d{i}.png")
+        pool.join()
+
+    def test_logs_replayed_in_submission_order(self, tmp_path, caplog):
+        """Log records from workers should appear in submission order."""
+        def job(diagram, out_file):
+            # The first job finishes last
+            if diagram.file == "d0.puml":
+                time.sleep(0.1)
+            log.warning(f"rendered {diagram.file}")
+
+        pool = RenderPool(4)
+        with caplog.at_level(logging.WARNING):
+            for i in range(4):
+                pool.submit(job, _diagram(tmp_path, f"d{i}.puml"), f"d{i}.png")
+            pool.join()
+
+        messages = [r.getMessage() for r in caplog.records]
+        assert messages == [f"rendered d{i}.puml" for i in range(4)]
+
+    def test_failures_reported_and_raised(self, tmp_path, caplog):
+        """All failures should be reported and the first one raised."""
+        def job(diagram, out_file):
+            if diagram.file != "ok.puml":
+                raise Exception(f"boom {diagram.file}")
+
+        pool = RenderPool(2)
+        with caplog.at_level(logging.ERROR):
+            for name in ["b.puml", "ok.puml", "a.puml"]:
+                pool.submit(job, _diagram(tmp_path, name), name + ".png")
+            with pytest.raises(Exception) as exc_info:
+                pool.join()
+
+        assert "2 of 3 diagrams failed" in caplog.text
+        # Failures are sorted by source file, so the raised one is deterministic
+        assert "boom a.puml" in str(exc_info.value)
+        assert caplog.text.index("a.puml ->") < caplog.text.index("b.puml ->")
+
+    def test_filter_removed_after_join(self, tmp_path):
+        """The log filter should be detached once the pool is done."""
+        pool = RenderPool(2)
+        pool.join()
+        assert pool not in log.filters
+
+
+class TestDispatchServer:
+    """Tests for BuildPlantumlPlugin._dispatch_server."""
+
+    def test_direct_call_without_pool(self, plugin, tmp_path):
+        """Without a pool the server is called synchronously."""
+        diagram = _diagram(tmp_path, "test.puml")
+
+        with patch.object(plugin, "_call_server") as mock_server:
+            plugin._dispatch_server(diagram, "test.png")
+            mock_server.assert_called_once_with(diagram, "test.png")
+
+    def test_pool_gets_snapshot(self, plugin, tmp_path):
+        """Queued jobs must not see later changes to the diagram."""
+        plugin.render_pool = RenderPool(2)
+        diagram = _diagram(tmp_path, "test.puml")
+        diagram.b64encoded = "light"
+        seen = []
+
+        with patch.object(plugin, "_call_server", side_effect=lambda d, o: seen.append(d.b64encoded)):
+            plugin._dispatch_server(diagram, "test.png")
+            diagram.b64encoded = "dark"
+            plugin._dispatch_server(diagram, "test_dark.png")
+            plugin.render_pool.join()
+
+        assert sorted(seen) == ["dark", "light"]
+
+    def test_on_pre_build_uses_pool(self, plugin, tmp_path, monkeypatch):
+        """on_pre_build should render all diagrams through the pool."""
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        for i in range(3):
+            (src / f"d{i}.puml").write_text(f"@startuml\nactor A{i}\n@enduml\n")
+
+        plugin.config["diagram_root"] = "diagrams"
+        plugin.config["workers"] = 3
+        monkeypatch.chdir(tmp_path)
+
+        threads = set()
+
+        def fake_call_server(diagram, out_file):
+            threads.add(threading.current_thread().name)
+
+        with patch.object(plugin, "_call_server", side_effect=fake_call_server) as mock_server:
+            plugin.on_pre_build({})
+
+        assert mock_server.call_count == 3
+        assert threading.current_thread().name not in threads
+        assert plugin.render_pool is None
@@ -0,0 +1,133 @@
+"""Tests for finding the diagram roots with allow_multiple_roots."""
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import GitIgnore
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """A tree with diagram roots in several places."""
+    for path in [
+        "a/docs/diagrams/src",
+        "b/nested/docs/diagrams/src",
+        "node_modules/pkg/docs/diagrams/src",
+        "build/docs/diagrams/src",
+        ".git/docs/diagrams",
+    ]:
+        (tmp_path / path).mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def _roots(plugin):
+    return sorted(Path(root.root_dir).relative_to(Path.cwd()).as_posix() for root in plugin._find_diagram_roots())
+
+
+def _os_walk_roots(top, diagram_root, exclude_dirs):
+    """The search as it was done before"""
+    roots = []
+    for subdir, dirs, _ in os.walk(top):
+        dirs[:] = [d for d in dirs if d not in exclude_dirs]
+        for directory in dirs:
+            if f"{subdir}/{directory}".endswith(diagram_root):
+                roots.append(f"{subdir}/{directory}")
+    return roots
+
+
+@pytest.fixture
+def multi_plugin(plugin):
+    plugin.config["allow_multiple_roots"] = True
+    return plugin
+
+
+class TestRootDiscovery:
+    """Tests for _find_diagram_roots."""
+
+    def test_same_roots_as_os_walk(self, multi_plugin, repo):
+        """By default the roots should be the ones os.walk found, in the same order."""
+        (repo / ".gitignore").write_text("node_modules\nbuild\n")
+        expected = _os_walk_roots(str(repo), "docs/diagrams", [".git"])
+        assert [root.root_dir for root in multi_plugin._find_diagram_roots()] == expected
+
+    def test_glob_excludes(self, multi_plugin, repo):
+        """exclude_dirs should accept glob patterns."""
+        multi_plugin.config["exclude_dirs"] = [".git", "node_*", "b/*"]
+        assert _roots(multi_plugin) == ["a/docs/diagrams", "build/docs/diagrams"]
+
+    def test_gitignore_honoured(self, multi_plugin, repo):
+        """Folders ignored by git should not be searched."""
+        multi_plugin.config["respect_gitignore"] = True
+        (repo / ".gitignore").write_text("# generated\nnode_modules/\n/build\n")
+        assert _roots(multi_plugin) == ["a/docs/diagrams", "b/nested/docs/diagrams"]
+
+    def test_nested_gitignore(self, multi_plugin, repo):
+        """A .gitignore in a subfolder should only apply below it."""
+        multi_plugin.config["respect_gitignore"] = True
+        (repo / "b" / ".gitignore").write_text("nested\n")
+        (repo / ".gitignore").write_text("node_modules\nbuild\n")
+        assert _roots(multi_plugin) == ["a/docs/diagrams"]
+
+    def test_cached_until_folder_changes(self, multi_plugin, repo):
+        """A second search should only stat the folders until one of them changed."""
+        first = _roots(multi_plugin)
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.scandir", wraps=os.scandir) as mock_scandir:
+            assert _roots(multi_plugin) == first
+        mock_scandir.assert_not_called()
+
+        (repo / "c" / "docs" / "diagrams").mkdir(parents=True)
+        os.utime(repo, ns=(0, 0))
+        assert _roots(multi_plugin) == sorted(first + ["c/docs/diagrams"])
+
+    def test_gitignore_change_searches_again(self, multi_plugin, repo):
+        """Editing a .gitignore should invalidate the cached roots."""
+        multi_plugin.config["respect_gitignore"] = True
+        (repo / ".gitignore").write_text("build\n")
+        assert "build/docs/diagrams" not in _roots(multi_plugin)
+        (repo / ".gitignore").write_text("node_modules\n")
+        os.utime(repo / ".gitignore", ns=(0, 0))
+        assert "build/docs/diagrams" in _roots(multi_plugin)
+
+    def test_explicit_roots_skip_walk(self, multi_plugin, repo):
+        """With diagram_roots no folder should be listed."""
+        multi_plugin.config["diagram_roots"] = ["a/docs/diagrams", "build/docs/diagrams"]
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.scandir") as mock_scandir:
+            with patch("mkdocs_build_plantuml_plugin.plantuml.os.walk") as mock_walk:
+                roots = [root.root_dir for root in multi_plugin._find_diagram_roots()]
+        assert roots == [str(repo / "a/docs/diagrams"), str(repo / "build/docs/diagrams")]
+        mock_scandir.assert_not_called()
+        mock_walk.assert_not_called()
+
+
+class TestGitIgnore:
+    """Tests for the folder rules of GitIgnore."""
+
+    def _rules(self, tmp_path, text, rel_dir=""):
+        (tmp_path / ".gitignore").write_text(text)
+        return GitIgnore().extend(str(tmp_path), rel_dir, {})
+
+    def test_name_matches_anywhere(self, tmp_path):
+        rules = self._rules(tmp_path, "dist\n")
+        assert rules.ignored("dist") and rules.ignored("a/b/dist")
+        assert not rules.ignored("distribution")
+
+    def test_anchored(self, tmp_path):
+        rules = self._rules(tmp_path, "/out\nsite/cache\n", rel_dir="docs/")
+        assert rules.ignored("docs/out") and rules.ignored("docs/site/cache")
+        assert not rules.ignored("docs/x/out")
+
+    def test_double_star_and_negation(self, tmp_path):
+        rules = self._rules(tmp_path, "**/tmp*\n!tmp-keep\n")
+        assert rules.ignored("a/tmp1")
+        assert not rules.ignored("a/tmp-keep")
+
+    def test_character_class(self, tmp_path):
+        rules = self._rules(tmp_path, "v[0-9]\nx[!a]\n")
+        assert rules.ignored("v1") and not rules.ignored("va")
+        assert rules.ignored("xb") and not rules.ignored("xa")
+
+    def test_no_file(self, tmp_path):
+        assert not GitIgnore().extend(str(tmp_path), "", {}).ignored("anything")
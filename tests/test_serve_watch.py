@@ -0,0 +1,241 @@
+"""Tests for the incremental rebuilds under mkdocs serve."""
+import json
+import os
+import time
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from mkdocs_build_plantuml_plugin.plantuml import ChangeWatcher
+
+
+class FakeWatcher:
+    """Hands out the changes a test prepared instead of watching the file system"""
+
+    def __init__(self):
+        self.changed = set()
+        self.rescan = False
+        self.watched = []
+
+    def watch(self, directory, sources):
+        self.watched.append((directory, sources))
+
+    def take(self):
+        changed, self.changed = self.changed, set()
+        rescan, self.rescan = self.rescan, False
+        return changed, rescan
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def project(diagram_tree):
+    """A third diagram in a sub folder, also including the style file."""
+    (diagram_tree / "src" / "sub").mkdir()
+    (diagram_tree / "src" / "sub" / "c.puml").write_text("@startuml\n!include ../../include/style.puml\n@enduml\n")
+    return diagram_tree
+
+
+@pytest.fixture
+def serve_plugin(plugin, project, fake_render, monkeypatch):
+    """A plugin after the first build of `mkdocs serve`."""
+    monkeypatch.setattr(plugin, "_call_server", fake_render)
+    _build(plugin)
+    # Changed files get the current time, so everything else has to be older
+    past = time.time() - 100
+    for path in project.rglob("*"):
+        os.utime(path, (past, past))
+    plugin.watcher = FakeWatcher()
+    plugin.on_serve(MagicMock(), {}, None)
+    return plugin
+
+
+def _build(plugin):
+    """Builds and returns the names of the diagrams that were processed"""
+    with patch.object(plugin, "_process_file", wraps=plugin._process_file) as mock_process:
+        plugin.on_pre_build({})
+    return sorted(args[2] for args, _ in mock_process.call_args_list)
+
+
+def _expanded(plugin):
+    """Builds and returns the names of the diagrams that were expanded"""
+    with patch.object(plugin, "_readFile", wraps=plugin._readFile) as mock_read:
+        plugin.on_pre_build({})
+    return sorted({args[0].file for args, _ in mock_read.call_args_list})
+
+
+def _change(plugin, path):
+    os.utime(path)
+    plugin.watcher.changed.add(str(path))
+
+
+class TestIncrementalRebuild:
+    """Tests for rebuilding only what the changed files affect."""
+
+    def test_folders_watched(self, serve_plugin, project):
+        """The source folder and the include folders should be given to livereload."""
+        server = serve_plugin.serve_server
+        watched = sorted((args[0], kwargs["recursive"]) for args, kwargs in server.watch.call_args_list)
+        src = str(Path.cwd() / "diagrams" / "src")
+        include = str((project / "include").resolve())
+        assert watched == sorted([(src, True), (include, False)])
+        assert (src, True) in serve_plugin.watcher.watched
+        assert (include, False) in serve_plugin.watcher.watched
+
+    def test_nothing_changed(self, serve_plugin, project):
+        """Without reported changes every diagram should be checked, none expanded."""
+        with patch.object(serve_plugin, "_find_diagram_roots") as mock_find:
+            assert _expanded(serve_plugin) == []
+        mock_find.assert_not_called()
+
+    def test_unreported_change(self, serve_plugin, project):
+        """A change the watcher missed should be found by its mtime."""
+        os.utime(project / "src" / "b.puml")
+        assert _expanded(serve_plugin) == ["b.puml"]
+
+    def test_deleted_output_without_changes(self, serve_plugin, project):
+        """A deleted image should be rendered again."""
+        (project / "out" / "b.png").unlink()
+        assert _expanded(serve_plugin) == ["b.puml"]
+        assert (project / "out" / "b.png").exists()
+
+    def test_deleted_output_with_changes(self, serve_plugin, project):
+        """The images of unchanged diagrams should be checked as well."""
+        (project / "out" / "b.png").unlink()
+        _change(serve_plugin, project / "src" / "a.puml")
+        assert _build(serve_plugin) == ["a.puml", "b.puml"]
+        assert (project / "out" / "b.png").exists()
+
+    def test_changed_source(self, serve_plugin, project):
+        """Only the changed diagram should be processed."""
+        _change(serve_plugin, project / "src" / "b.puml")
+        assert _build(serve_plugin) == ["b.puml"]
+
+    def test_changed_include(self, serve_plugin, project):
+        """The dependents of a changed include should be processed."""
+        _change(serve_plugin, project / "include" / "style.puml")
+        assert _build(serve_plugin) == ["a.puml", "c.puml"]
+
+    def test_new_diagram(self, serve_plugin, project):
+        """A new file in a known folder should be picked up without walking."""
+        (project / "src" / "d.puml").write_text("@startuml\nactor D\n@enduml\n")
+        serve_plugin.watcher.changed.add(str(Path.cwd() / "diagrams" / "src" / "d.puml"))
+        assert _build(serve_plugin) == ["d.puml"]
+        assert (project / "out" / "d.png").exists()
+
+    def test_deleted_diagram(self, serve_plugin, project):
+        """A deleted diagram should be forgotten by the graph."""
+        src_file = str(Path.cwd() / "diagrams" / "src" / "sub" / "c.puml")
+        (project / "src" / "sub" / "c.puml").unlink()
+        serve_plugin.watcher.changed.add(src_file)
+
+        assert _build(serve_plugin) == []
+        assert src_file not in serve_plugin.diagram_index
+        assert src_file not in serve_plugin.dependency_graph.includes
+        assert str(Path.cwd() / "diagrams" / "src" / "a.puml") in serve_plugin.dependency_graph.includes
+
+    def test_rescan_walks_again(self, serve_plugin, project):
+        """A folder change should lead to a full walk."""
+        (project / "src" / "new").mkdir()
+        (project / "src" / "new" / "e.puml").write_text("@startuml\nactor E\n@enduml\n")
+        serve_plugin.watcher.rescan = True
+        assert _build(serve_plugin) == ["a.puml", "b.puml", "c.puml", "e.puml"]
+
+    def test_settings_change_walks_again(self, serve_plugin, project):
+        """Another output format should lead to a full walk."""
+        serve_plugin.config["output_format"] = "svg"
+        assert _build(serve_plugin) == ["a.puml", "b.puml", "c.puml"]
+        assert (project / "out" / "b.svg").exists()
+
+    def test_discovery_change_walks_again(self, serve_plugin, project):
+        """Other file patterns should lead to a full walk with the new selection."""
+        serve_plugin.config["include_patterns"] = ["sub/**"]
+        assert _build(serve_plugin) == ["c.puml"]
+        assert set(serve_plugin.diagram_index) == {str(Path.cwd() / "diagrams" / "src" / "sub" / "c.puml")}
+
+    def test_root_change_walks_again(self, serve_plugin, project, tmp_path):
+        """Another diagram_root should be searched for diagrams."""
+        (tmp_path / "other" / "src").mkdir(parents=True)
+        (tmp_path / "other" / "src" / "o.puml").write_text("@startuml\nactor O\n@enduml\n")
+        serve_plugin.config["diagram_root"] = "other"
+        assert _build(serve_plugin) == ["o.puml"]
+
+    def test_manifest_keeps_unchanged(self, serve_plugin, project):
+        """Diagrams that were not looked at should stay in the manifest."""
+        serve_plugin.config["manifest_file"] = ".manifest.json"
+        serve_plugin.watcher.rescan = True
+        _build(serve_plugin)
+
+        _change(serve_plugin, project / "src" / "b.puml")
+        assert _build(serve_plugin) == ["b.puml"]
+        saved = json.loads((project.parent / ".manifest.json").read_text())
+        assert len(saved["diagrams"]) == 3
+
+
+    def test_failed_render_retried(self, serve_plugin, project):
+        """A diagram the server refused should be rendered again on the next rebuild."""
+        def build(status):
+            mock_http.request.reset_mock()
+            mock_http.request.return_value = (MagicMock(status=status), b"image %d" % status)
+            serve_plugin.on_pre_build({})
+            return mock_http.request.call_count
+
+        # Through the real _call_server this time
+        del serve_plugin._call_server
+        _change(serve_plugin, project / "src" / "b.puml")
+        with patch("httplib2.Http") as mock_http_class:
+            mock_http = mock_http_class.return_value
+            assert build(509) == 1
+            assert build(509) == 1
+            assert build(200) == 1
+            assert build(200) == 0
+        assert (project / "out" / "b.png").read_bytes() == b"image 200"
+
+    def test_changes_kept_when_build_fails(self, serve_plugin, project):
+        """An exception should not lose the changes taken from the watcher."""
+        _change(serve_plugin, project / "src" / "b.puml")
+        with patch.object(serve_plugin, "_call_server", side_effect=Exception("connection refused")):
+            with pytest.raises(Exception, match="connection refused"):
+                serve_plugin.on_pre_build({})
+        assert _expanded(serve_plugin) == ["b.puml"]
+
+
+class TestChangeWatcher:
+    """Tests for ChangeWatcher on the real file system."""
+
+    def _wait_for(self, watcher, condition):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with watcher.lock:
+                if condition():
+                    return
+            time.sleep(0.02)
+
+    def test_file_changes_collected(self, tmp_path):
+        """Written files should be reported once."""
+        watcher = ChangeWatcher()
+        try:
+            watcher.watch(str(tmp_path), True)
+            (tmp_path / "a.puml").write_text("@startuml\n@enduml\n")
+            self._wait_for(watcher, lambda: watcher.changed)
+            changed, rescan = watcher.take()
+        finally:
+            watcher.close()
+
+        assert changed == {str(tmp_path / "a.puml")}
+        assert not rescan
+        assert watcher.take() == (set(), False)
+
+    def test_new_folder_needs_rescan(self, tmp_path):
+        """A folder created in a source folder should ask for a full walk."""
+        watcher = ChangeWatcher()
+        try:
+            watcher.watch(str(tmp_path), True)
+            (tmp_path / "sub").mkdir()
+            self._wait_for(watcher, lambda: watcher.rescan)
+            _, rescan = watcher.take()
+        finally:
+            watcher.close()
+
+        assert rescan
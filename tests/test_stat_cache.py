@@ -0,0 +1,103 @@
+"""Tests for the per-build stat and resolve cache."""
+import logging
+import os
+import pytest
+from pathlib import Path
+from unittest.mock import patch
+
+from mkdocs_build_plantuml_plugin.plantuml import StatCache
+
+
+@pytest.fixture
+def project(diagram_tree):
+    """Three diagrams sharing one include."""
+    for name in "bc":
+        (diagram_tree / "src" / f"{name}.puml").write_text(
+            f"@startuml\n!include ../include/style.puml\nactor {name}\n@enduml\n"
+        )
+    return diagram_tree
+
+
+class TestStatCache:
+    """Tests for StatCache."""
+
+    def test_stat_once(self, tmp_path):
+        path = tmp_path / "a.puml"
+        path.write_text("x")
+        cache = StatCache()
+        cache.begin()
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.stat", wraps=os.stat) as mock_stat:
+            assert cache.mtime(path) == cache.stat(str(path)).st_mtime
+            assert cache.exists(path)
+        assert mock_stat.call_count == 1
+        assert (cache.lookups, cache.calls) == (3, 1)
+
+    def test_missing_file(self, tmp_path):
+        """A missing file should raise every time but be looked up once."""
+        cache = StatCache()
+        cache.begin()
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.stat", wraps=os.stat) as mock_stat:
+            for _ in range(2):
+                with pytest.raises(FileNotFoundError):
+                    cache.stat(tmp_path / "missing.puml")
+            assert cache.mtime(tmp_path / "missing.puml") is None
+        assert mock_stat.call_count == 1
+
+    def test_resolve_once(self, tmp_path):
+        cache = StatCache()
+        cache.begin()
+        with patch.object(Path, "resolve", autospec=True, side_effect=lambda p: p) as mock_resolve:
+            cache.resolve(tmp_path / "x" / ".." / "a.puml")
+            cache.resolve(str(tmp_path / "x" / ".." / "a.puml"))
+        assert mock_resolve.call_count == 1
+
+    def test_invalidate(self, tmp_path):
+        """A file written during the build should be stat'ed again."""
+        path = tmp_path / "a.png"
+        cache = StatCache()
+        cache.begin()
+        assert cache.mtime(path) is None
+        path.write_bytes(b"image")
+        cache.invalidate(path)
+        assert cache.mtime(path) == path.stat().st_mtime
+
+    def test_inactive_outside_build(self, tmp_path):
+        """Without a build every lookup should go to the file system."""
+        path = tmp_path / "a.puml"
+        cache = StatCache()
+        cache.begin()
+        cache.end()
+        assert cache.mtime(path) is None
+        path.write_text("x")
+        assert cache.mtime(path) is not None
+        assert cache.lookups == 0
+
+
+class TestPluginStatCache:
+    """Tests for the stat cache in on_pre_build."""
+
+    def _build(self, plugin):
+        with patch.object(plugin, "_call_server"):
+            plugin.on_pre_build({})
+
+    def test_shared_include_stat_and_resolved_once(self, plugin, project):
+        include = str((project / "include" / "style.puml").resolve())
+        resolved = []
+        original_resolve = Path.resolve
+
+        def recording_resolve(self, *args, **kwargs):
+            resolved.append(str(self))
+            return original_resolve(self, *args, **kwargs)
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.os.stat", wraps=os.stat) as mock_stat:
+            with patch.object(Path, "resolve", recording_resolve):
+                self._build(plugin)
+
+        assert [args[0] for args, _ in mock_stat.call_args_list].count(include) == 1
+        assert len([p for p in resolved if p.endswith("style.puml")]) == 1
+
+    def test_savings_logged(self, plugin, project, caplog):
+        with caplog.at_level(logging.DEBUG, logger="mkdocs.plugins.mkdocs_build_plantuml_plugin.plantuml"):
+            self._build(plugin)
+        assert any("system calls" in r.getMessage() and "saved" in r.getMessage() for r in caplog.records)
+        assert not plugin.stat_cache.active
@@ -0,0 +1,273 @@
+"""Tests for expanding the light and the dark variant in one pass."""
+import time
+import pytest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from mkdocs_build_plantuml_plugin.plantuml import PuElement, ThemeChoice
+
+
+@pytest.fixture
+def themes(tmp_path):
+    """Theme files, and a style file that includes the light theme."""
+    themes = tmp_path / "themes"
+    themes.mkdir()
+    (themes / "light.puml").write_text("' light\n")
+    (themes / "dark.puml").write_text("' dark\n")
+    (tmp_path / "style.puml").write_text("skinparam Padding 4\n!include themes/light.puml\n")
+    return themes
+
+
+def _diagram(tmp_path, lines):
+    diagram = PuElement("test.puml", str(tmp_path))
+    diagram.root_dir = str(tmp_path)
+    diagram.src_file = ["@startuml\n", *lines, "actor User\n", "@enduml\n"]
+    return diagram
+
+
+def _opened_files(func):
+    opened = []
+    original_open = Path.open
+
+    def recording_open(self, *args, **kwargs):
+        opened.append(self.name)
+        return original_open(self, *args, **kwargs)
+
+    with patch.object(Path, "open", recording_open):
+        func()
+    return opened
+
+
+class TestThemeTemplate:
+    """Tests for the theme choices in the expansion."""
+
+    def test_dark_variant_without_reading_again(self, plugin_with_theme, tmp_path, themes):
+        """The dark pass should not open any file."""
+        diagram = _diagram(tmp_path, ["!include themes/light.puml\n"])
+        plugin_with_theme._readFile(diagram, False)
+        light = diagram.concat_file
+
+        opened = _opened_files(lambda: plugin_with_theme._readFile(diagram, True))
+
+        assert opened == []
+        assert "' light" in light and "' dark" not in light
+        assert "' dark" in diagram.concat_file and "' light" not in diagram.concat_file
+
+    def test_nested_theme_include(self, plugin_with_theme, tmp_path, themes):
+        """A theme include inside another include should be swapped as well."""
+        diagram = _diagram(tmp_path, ["!include style.puml\n"])
+        plugin_with_theme._readFile(diagram, False)
+        assert "' light" in diagram.concat_file
+        plugin_with_theme._readFile(diagram, True)
+
+        assert "skinparam Padding 4" in diagram.concat_file
+        assert "' dark" in diagram.concat_file and "' light" not in diagram.concat_file
+
+    def test_same_as_separate_dark_expansion(self, plugin_with_theme, tmp_path, themes):
+        """Selecting the dark variant should give the text of a dark-only expansion."""
+        lines = ["!include style.puml\n", "!include themes/light.puml\n"]
+        diagram = _diagram(tmp_path, lines)
+        plugin_with_theme._readFile(diagram, False)
+        plugin_with_theme._readFile(diagram, True)
+
+        plugin_with_theme.include_cache.entries = {}
+        separate = _diagram(tmp_path, lines)
+        plugin_with_theme._readFile(separate, True)
+
+        assert diagram.concat_file == separate.concat_file
+        assert diagram.b64encoded == separate.b64encoded
+
+    def test_dark_theme_recorded_as_include(self, plugin_with_theme, tmp_path, themes):
+        """Editing the dark theme should make the diagram stale."""
+        diagram = _diagram(tmp_path, ["!include themes/light.puml\n"])
+        plugin_with_theme._readFile(diagram, False)
+
+        assert str((themes / "dark.puml").resolve()) in diagram.includes
+        assert str((themes / "light.puml").resolve()) in diagram.includes
+
+    def test_no_choices_without_themes(self, plugin, tmp_path, themes):
+        """With themes disabled the dark theme should not be read."""
+        diagram = _diagram(tmp_path, ["!include themes/light.puml\n"])
+        opened = _opened_files(lambda: plugin._readFile(diagram, False))
+
+        assert "dark.puml" not in opened
+        assert diagram.template is None
+
+    def test_template_keeps_choice(self, plugin_with_theme, tmp_path, themes):
+        """The template should hold one choice per theme include."""
+        diagram = _diagram(tmp_path, ["!include themes/light.puml\n"])
+        plugin_with_theme._readFile(diagram, False)
+
+        choices = [c for c in diagram.template if isinstance(c, ThemeChoice)]
+        assert len(choices) == 1
+        assert choices[0].variants == (("' light\n",), ("' dark\n",))
+
+
+class TestLocalThemes:
+    """Tests for dark mode with render: local."""
+
+    def test_dark_rendered_through_pipe(self, plugin_with_theme, tmp_path, monkeypatch):
+        """The light image should be batched and the dark source piped in."""
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        (tmp_path / "diagrams" / "themes").mkdir()
+        (tmp_path / "diagrams" / "themes" / "light.puml").write_text("' light\n")
+        (tmp_path / "diagrams" / "themes" / "dark.puml").write_text("' dark\n")
+        (src / "a.puml").write_text("@startuml\n!include ../themes/light.puml\nactor A\n@enduml\n")
+        plugin_with_theme.config["render"] = "local"
+        plugin_with_theme.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+
+        with patch("mkdocs_build_plantuml_plugin.plantuml.call", return_value=0) as mock_call:
+            with patch("mkdocs_build_plantuml_plugin.plantuml.PipeRenderer.render", return_value=b"dark PNG") as mock_render:
+                plugin_with_theme.on_pre_build({})
+
+        assert mock_call.call_count == 1
+        assert "' dark" in mock_render.call_args[0][0]
+        assert (tmp_path / "diagrams" / "out" / "a_dark.png").read_bytes() == b"dark PNG"
+
+
+class TestThemeAgnosticDiagrams:
+    """Tests for diagrams whose dark source equals the light one."""
+
+    @pytest.fixture
+    def project(self, plugin_with_theme, tmp_path, monkeypatch):
+        src = tmp_path / "diagrams" / "src"
+        themes = tmp_path / "diagrams" / "themes"
+        src.mkdir(parents=True)
+        themes.mkdir()
+        (themes / "light.puml").write_text("' light\n")
+        (themes / "dark.puml").write_text("' dark\n")
+        (src / "themed.puml").write_text("@startuml\n!include ../themes/light.puml\nactor A\n@enduml\n")
+        (src / "plain.puml").write_text("@startuml\nactor B\n@enduml\n")
+        plugin_with_theme.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+        return tmp_path / "diagrams" / "out"
+
+    def test_hash_shows_theme_use(self, plugin_with_theme, tmp_path, themes):
+        """Only a diagram using the theme should get another dark hash."""
+        plain = _diagram(tmp_path, [])
+        plugin_with_theme._readFile(plain, False)
+        encoded = plain.b64encoded
+        plugin_with_theme._readFile(plain, True)
+        assert plain.variant_hashes[1] == plain.content_hash
+        assert plain.b64encoded == encoded
+
+        themed = _diagram(tmp_path, ["!include themes/light.puml\n"])
+        plugin_with_theme._readFile(themed, False)
+        plugin_with_theme._readFile(themed, True)
+        assert themed.variant_hashes[1] != themed.content_hash
+
+    def test_dark_image_copied(self, plugin_with_theme, project):
+        """Only the themed diagram should be rendered twice."""
+        def fake_server(diagram, out_file):
+            Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+            Path(out_file).write_bytes(diagram.b64encoded.encode())
+
+        with patch.object(plugin_with_theme, "_call_server", side_effect=fake_server) as mock_server:
+            plugin_with_theme.on_pre_build({})
+
+        rendered = sorted(Path(args[1]).name for args, _ in mock_server.call_args_list)
+        assert rendered == ["plain.png", "themed.png", "themed_dark.png"]
+        assert (project / "plain_dark.png").read_bytes() == (project / "plain.png").read_bytes()
+        assert plugin_with_theme.theme_copies is None
+
+    def test_copy_waits_for_render_pool(self, plugin_with_theme, project):
+        """With workers, the copy should happen after the light image was written."""
+        plugin_with_theme.config["workers"] = 4
+
+        def slow_server(diagram, out_file):
+            time.sleep(0.05)
+            Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+            Path(out_file).write_bytes(b"image " + Path(out_file).name.encode())
+
+        with patch.object(plugin_with_theme, "_call_server", side_effect=slow_server):
+            plugin_with_theme.on_pre_build({})
+
+        assert (project / "plain_dark.png").read_bytes() == b"image plain.png"
+
+    def test_failed_copy_rendered_again(self, plugin_with_theme, project):
+        """A copy of an error image should be replaced once the light image renders."""
+        def build(status):
+            mock_http.request.return_value = (MagicMock(status=status), b"image %d" % status)
+            plugin_with_theme.on_pre_build({})
+
+        with patch("httplib2.Http") as mock_http_class:
+            mock_http = mock_http_class.return_value
+            build(500)
+            assert (project / "plain_dark.png").read_bytes() == b"image 500"
+            build(200)
+
+        assert (project / "plain.png").read_bytes() == b"image 200"
+        assert (project / "plain_dark.png").read_bytes() == b"image 200"
+
+
+class TestThemeVariants:
+    """Tests for more theme variants than light and dark."""
+
+    VARIANTS = [
+        {"name": "dark", "theme": "dark.puml", "suffix": "_dark"},
+        {"name": "contrast", "theme": "contrast.puml"},
+        {"name": "print", "theme": "print.puml", "suffix": ".print"},
+    ]
+
+    @pytest.fixture
+    def variant_plugin(self, plugin_with_theme, themes):
+        (themes / "contrast.puml").write_text("' contrast\n")
+        (themes / "print.puml").write_text("' print\n")
+        plugin_with_theme.config["theme_variants"] = self.VARIANTS
+        return plugin_with_theme
+
+    def test_default_variants(self, plugin):
+        """Without a list, light and dark should come from theme_light and theme_dark."""
+        assert [tuple(v) for v in plugin._variants()] == [
+            ("light", "light.puml", ""),
+            ("dark", "dark.puml", "_dark"),
+        ]
+
+    def test_output_names(self, variant_plugin, tmp_path):
+        """Every variant should get its own suffix, the name is the default one."""
+        diagram = PuElement("test.puml", str(tmp_path))
+        diagram.out_dir = str(tmp_path / "out")
+        variant_plugin._build_out_filename(diagram)
+
+        assert [Path(f).name for f in diagram.out_files] == [
+            "test.png", "test_dark.png", "test_contrast.png", "test.print.png",
+        ]
+
+    def test_every_variant_from_one_read(self, variant_plugin, tmp_path, themes):
+        """Each theme file should be read once, the variants are selected afterwards."""
+        diagram = _diagram(tmp_path, ["!include style.puml\n"])
+        sources = []
+
+        def read_all():
+            for variant in range(4):
+                variant_plugin._readFile(diagram, variant)
+                sources.append(diagram.concat_file)
+
+        opened = _opened_files(read_all)
+
+        assert sorted(opened) == ["contrast.puml", "dark.puml", "light.puml", "print.puml", "style.puml"]
+        for source, theme in zip(sources, ["light", "dark", "contrast", "print"]):
+            assert f"' {theme}\n" in source
+            assert source.count("' ") == 1
+
+    def test_build_renders_all_variants(self, variant_plugin, tmp_path, monkeypatch):
+        """on_pre_build should render one image per variant."""
+        src = tmp_path / "diagrams" / "src"
+        src.mkdir(parents=True)
+        (src / "a.puml").write_text("@startuml\n!include ../../themes/light.puml\nactor A\n@enduml\n")
+        variant_plugin.config["diagram_root"] = "diagrams"
+        monkeypatch.chdir(tmp_path)
+
+        with patch.object(variant_plugin, "_call_server") as mock_server:
+            variant_plugin.on_pre_build({})
+
+        rendered = [Path(args[1]).name for args, _ in mock_server.call_args_list]
+        assert rendered == ["a.png", "a_dark.png", "a_contrast.png", "a.print.png"]
+
+    def test_invalid_entry(self, plugin_with_theme):
+        """An entry without a theme should be reported."""
+        plugin_with_theme.config["theme_variants"] = [{"name": "print"}]
+        with pytest.raises(Exception, match="need a name and a theme"):
+            plugin_with_theme._variants()